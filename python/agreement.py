@@ -1,64 +1,250 @@
 #!/usr/bin/env python
 """
 Program to extract a csv from retrieved annotations after the second round so proper IAA can be calculated
-This also calculates some basic IAA.
+This also calculates IAA: observed agreement, Cohen's kappa for every pair of annotators, Fleiss' kappa and
+Krippendorff's alpha over all annotators, per-label agreement and confusion matrices (see iaa.py).
+Items can have any number of annotations, only items with at least two annotations contribute to the IAA.
+The csv only contains the items with exactly two annotations, in each row the annotators are ordered by id.
+Input files can also be columnar stores (.cols), of which only the label columns get read. From JSON files, only
+the annNN_label fields get decoded (see dataio.iter_fields), the other fields are skipped.
+With --bootstrap N, confidence intervals for all statistics are estimated from N bootstrap resamples of the items.
+With --watch PREFIX, the completion files of all label-studio projects PREFIX_N are checked every --interval seconds
+instead, and the statistics are updated with each new, changed or removed completion file (see
+iaa.IncrementalAgreement), without reading any of the other files again. Each time something changed, a summary
+is logged and the statistics are saved to --outstats, if specified.
+With --ledger FILE, the labels are taken from the ledger written by retrieve-annotated.py --ledger instead (see
+ledger.py), for all rounds or the rounds given with --rounds: the labels of each item from all annotators in those
+rounds are found by the item id, whichever round's files they came from.
 """
 
+import os
+import sys
 import json
+import time
 import argparse
 import runutils
-import random
-import sys
+import numpy as np
+import iaa
+import dataio
+import colstore
+import pipeline
+import ledger
+
+
+def cistr(interval):
+    """
+    Format a confidence interval for logging.
+    :param interval: list [lower, upper] or None
+    :return: the formatted interval or an empty string if interval is None
+    """
+    if interval is None:
+        return ""
+    return f" [{interval[0]}, {interval[1]}]"
+
+
+def annotator_labels(item):
+    """
+    Get the labels of an item, as used by iaa.encode.
+    :return: map from annotator name (annNN) to label
+    """
+    return {k[:-6]: v for k, v in item.items() if iaa.is_label_key(k)}
+
+
+def save_stats(stats, labels, outfile):
+    """
+    Save the statistics to a JSON file, replacing the file only once it has been written completely.
+    """
+    with dataio.atomic_open(outfile, "wt") as outfp:
+        json.dump(dict(iaa.stats2json(stats), labels=labels), outfp)
+
+
+def poll(projpref, inc, known):
+    """
+    Check the completion files of all projects with the prefix once and update the statistics for the files which
+    are new, have changed or are gone. Only the directory entries are checked for the other files.
+    :param projpref: project directory prefix
+    :param inc: iaa.IncrementalAgreement instance
+    :param known: map from completion file to a tuple (modification time and size, labels or None), gets updated
+    :return: number of files which were new, changed or gone
+    """
+    n_changed = 0
+    seen = set()
+    for annnr, d in pipeline.find_projects(projpref):
+        compldir = os.path.join(d, "completions")
+        if not os.path.isdir(compldir):
+            continue
+        for entry in os.scandir(compldir):
+            if not entry.name.endswith(".json"):
+                continue
+            seen.add(entry.path)
+            st = entry.stat()
+            stamp = (st.st_mtime_ns, st.st_size)
+            old = known.get(entry.path)
+            if old is not None and old[0] == stamp:
+                continue
+            item = pipeline.retrieve_file(entry.path, annnr)
+            annlabels = annotator_labels(item) if item is not None else None
+            if old is not None and old[1] is not None:
+                inc.remove(old[1])
+            if annlabels is not None:
+                inc.add(annlabels)
+            known[entry.path] = (stamp, annlabels)
+            n_changed += 1
+    for path in [p for p in known if p not in seen]:
+        if known[path][1] is not None:
+            inc.remove(known[path][1])
+        del known[path]
+        n_changed += 1
+    return n_changed
+
+
+def watch(projpref, labels, interval=10.0, outstats=None, maxpolls=0):
+    """
+    Keep checking the completion files of all projects with the prefix and log and save the updated statistics
+    whenever something changed.
+    :param projpref: project directory prefix
+    :param labels: list of known labels
+    :param interval: seconds to wait between checks
+    :param outstats: if not None, save the statistics to this file after each change
+    :param maxpolls: stop after that many checks, 0 to keep checking until interrupted
+    """
+    logger = runutils.ensurelogger()
+    inc = iaa.IncrementalAgreement(labels)
+    known = {}
+    npolls = 0
+    try:
+        while True:
+            with runutils.stage("poll"):
+                n_changed = poll(projpref, inc, known)
+            npolls += 1
+            if n_changed > 0:
+                runutils.count("files_changed", n_changed)
+                stats = inc.agreement()
+                logger.info(f"Files changed: {n_changed}, items: {stats['items']}, "
+                            f"with 2+ annotations: {stats['items_multi']}, pairs: {stats['pairs']}, "
+                            f"equal proportion: {stats['observed_agreement']}, "
+                            f"Fleiss' kappa: {stats['fleiss_kappa']}, "
+                            f"Krippendorff's alpha: {stats['krippendorff_alpha']}")
+                for pair in stats["pairwise"]:
+                    a, b = pair["annotators"]
+                    logger.info(f"Pair {a}/{b}: items={pair['items']}, equal proportion={pair['observed_agreement']}, "
+                                f"Cohen's kappa={pair['cohen_kappa']}")
+                if outstats:
+                    save_stats(stats, inc.labels, outstats)
+            if maxpolls and npolls >= maxpolls:
+                break
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
 
 
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
     parser.add_argument("--infiles", nargs="+", help="One or more files retrieved from their projects")
-    parser.add_argument("--outcsv", required=True, help="Output CSV file")
+    parser.add_argument("--outcsv", type=str, default=None, help="Output CSV file (required unless --watch is used)")
+    parser.add_argument("--outstats", type=str, default=None,
+                        help="If specified, save all agreement statistics and confusion matrices to this JSON file")
+    parser.add_argument("--bootstrap", type=int, default=0,
+                        help="Number of bootstrap resamples for confidence intervals, 0 for none (0)")
+    parser.add_argument("--level", type=float, default=0.95, help="Confidence level for the intervals (0.95)")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed for bootstrapping (default: 42)")
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes for bootstrapping (1)")
+    parser.add_argument("--watch", type=str, default=None,
+                        help="Instead of reading --infiles, keep updating the statistics from the completion files "
+                             "of all projects with this directory prefix")
+    parser.add_argument("--interval", type=float, default=10.0, help="With --watch, seconds between checks (10)")
+    parser.add_argument("--maxpolls", type=int, default=0,
+                        help="With --watch, stop after that many checks, 0 to run until interrupted (0)")
+    parser.add_argument("--ledger", type=str, default=None,
+                        help="Instead of reading --infiles, get the labels of all items from this ledger (see ledger.py)")
+    parser.add_argument("--rounds", nargs="+", type=int, default=None,
+                        help="With --ledger, only use the labels from these rounds (all rounds)")
+    runutils.add_metrics_args(parser)
     args = parser.parse_args()
 
+    if args.watch is None and ((not args.infiles and args.ledger is None) or not args.outcsv):
+        parser.error("--infiles or --ledger, and --outcsv are required unless --watch is used")
+    if args.ledger is not None and not os.path.exists(args.ledger):
+        parser.error(f"ledger {args.ledger} does not exist")
+
     logger = runutils.set_logger(args)
     runutils.run_start()
 
-    all = []
+    # the label codec from the label-studio config, so the label order is the same for all inputs
+    labels = colstore.Codec.from_config().values
+    if args.watch is not None:
+        logger.info(f"Watching the completions of projects {args.watch}_N every {args.interval}s")
+        watch(args.watch, labels, args.interval, args.outstats, args.maxpolls)
+        runutils.run_stop()
+        sys.exit(0)
+    parts = []
     n_total = 0
-    outfp = open(args.outcsv, "wt")
-    ntotal = 0
-    nequal = 0
-    for infile in args.infiles:
-        with open(infile, "rt", encoding="utf8") as reader:
-            objs = json.load(reader)
-            n_in = len(objs)
+    with runutils.stage("read"):
+        if args.ledger is not None:
+            with ledger.Ledger(args.ledger) as led:
+                objs = led.labels(set(args.rounds) if args.rounds else None)
+            n_total = len(objs)
+            parts.append(iaa.encode(objs, labels))
+            objs = None
+            logger.info(f"Loaded the labels of {n_total} items from ledger {args.ledger}")
+        for infile in args.infiles or []:
+            if colstore.is_store(infile):
+                # only the label columns get read
+                store = colstore.Store(infile)
+                n_in = len(store)
+                parts.append(iaa.from_columns({a: store.array(a + "_label") for a in store.annotators()},
+                                              store.labels.values, n_in))
+            else:
+                objs = dataio.load_fields(infile, iaa.is_label_key)
+                n_in = len(objs)
+                parts.append(iaa.encode(objs, labels))
+                objs = None
             n_total += n_in
             logger.info(f"Loaded {n_in} items from {infile}")
-            # assign each item from the set to all annotators not already in the assigned list
-            for i, obj in enumerate(objs):
-                all.append(obj)
-                # logger.info(f"DEBUG: checking object {i}")
-                labels = []
-                annotators = []
-                # for each field in the object, check if it is a label annotation by some annotator
-                for k in obj:
-                    if k.endswith("_label") and k.startswith("ann"):
-                        # logger.info(f"DEBUG: got label key: {k}")
-                        l = obj.get(k)
-                        if not l:
-                            logger.warning(f"Empty label in file {infile} for item {i} of {len(objs)}, ignoring")
-                            continue
-                        a = k[:5]
-                        labels.append(l)
-                        annotators.append(a)
-                if len(labels) != 2:
-                    logger.warning(f"Not exactly two annotators in  {infile} for item {i} of {len(objs)} but {len(labels)}, ignoring")
-                else:
-                    ntotal += 1
-                    # only consider/output the ones which have exactly two annotations
-                    print(labels[0],labels[1],annotators[0],annotators[1], file=outfp, sep=",")
-                    if labels[0] == labels[1]:
-                        nequal += 1
-    logger.info(f"Total annotation pairs: {ntotal}")
-    logger.info(f"Equal annotation pairs: {nequal}")
-    if ntotal > 0:
-        logger.info(f"Equal proportion:       {nequal/ntotal}")
-    runutils.run_stop()
\ No newline at end of file
+        anns = iaa.concat(parts)
+        parts = None
+    runutils.count("items_read", n_total)
+    runutils.count("annotations", len(anns.items))
+
+    # only consider/output the ones which have exactly two annotations for the csv
+    slotanns, slotcodes = iaa.item_slots(anns)
+    per_item = (slotanns >= 0).sum(axis=1)
+    two = np.nonzero(per_item == 2)[0]
+    with dataio.atomic_open(args.outcsv, "wt") as outfp:
+        for i in two:
+            print(anns.labels[slotcodes[i, 0]], anns.labels[slotcodes[i, 1]],
+                  anns.annotators[slotanns[i, 0]], anns.annotators[slotanns[i, 1]], file=outfp, sep=",")
+    n_fewer = int((per_item < 2).sum())
+    if n_fewer > 0:
+        logger.warning(f"Items with fewer than two annotations, ignored: {n_fewer}")
+
+    with runutils.stage("agreement"):
+        stats = iaa.agreement(anns)
+    if args.bootstrap > 0:
+        logger.info(f"Bootstrapping {args.level} confidence intervals from {args.bootstrap} resamples")
+        with runutils.stage("bootstrap"):
+            ci = iaa.bootstrap(anns, args.bootstrap, seed=args.seed, level=args.level, workers=args.workers)
+        stats["ci"] = ci
+        ci_label = ci["per_label"]
+        ci_pair = {tuple(p["annotators"]): p for p in ci["pairwise"]}
+    else:
+        ci = None
+    logger.info(f"Total items:                  {n_total}")
+    logger.info(f"Items with 2+ annotations:    {stats['items_multi']}")
+    logger.info(f"Items with 2 annotations:     {len(two)}")
+    logger.info(f"Total annotation pairs:       {stats['pairs']}")
+    logger.info(f"Equal proportion:             {stats['observed_agreement']}{cistr(ci and ci['observed_agreement'])}")
+    logger.info(f"Fleiss' kappa:                {stats['fleiss_kappa']}{cistr(ci and ci['fleiss_kappa'])}")
+    logger.info(f"Krippendorff's alpha:         {stats['krippendorff_alpha']}{cistr(ci and ci['krippendorff_alpha'])}")
+    for label, agr in stats["per_label"].items():
+        logger.info(f"Agreement for label {label}: {agr}{cistr(ci and ci_label[label])}")
+    for pair in stats["pairwise"]:
+        a, b = pair["annotators"]
+        logger.info(f"Pair {a}/{b}: items={pair['items']}, "
+                    f"equal proportion={pair['observed_agreement']}{cistr(ci and ci_pair[(a, b)]['observed_agreement'])}, "
+                    f"Cohen's kappa={pair['cohen_kappa']}{cistr(ci and ci_pair[(a, b)]['cohen_kappa'])}")
+    if args.outstats:
+        save_stats(stats, anns.labels, args.outstats)
+        logger.info(f"Statistics saved to {args.outstats}")
+    runutils.run_stop()
@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+"""
+Program to benchmark the data preparation and retrieval programs on synthetic data.
+For each requested number of items, this generates (with a fixed random seed) an input file of items which look
+like the Poynter data, with all the fields required by prepare-split-data.py, and then runs, each with
+--metrics-json:
+* split: prepare-split-data.py on the generated input
+* assign: prepare-assign-data.py for the first sets (one for each annotator)
+* retrieve: retrieve-annotated.py --batch on generated label-studio project directories which contain
+  completions/*.json files for all the items in the sets, a fraction of the sets (--overlap) is also
+  annotated by a second annotator
+* reassign: reassign.py on the retrieved files
+* agreement: agreement.py on the retrieved files
+The wall clock time and peak memory (RSS) of each run are saved to the results file (--out) and compared to the
+baselines file: if a run takes more time or memory than the baseline plus the tolerance, this is logged
+and the program exits with status 1. Use --update-baselines to save the results as the new baselines.
+NOTE: baselines only make sense for runs on the same machine.
+"""
+
+import os
+import sys
+import json
+import glob
+import shutil
+import random
+import argparse
+import tempfile
+import subprocess
+import time
+import zlib
+import runutils
+import dataio
+
+DEFAULT_SIZES = "10000,100000,1000000"
+DEFAULT_BASELINES = "benchmark/baselines.json"
+SCRIPTDIR = os.path.dirname(os.path.abspath(__file__))
+
+WORDS = ("covid coronavirus virus vaccine lockdown mask hospital government minister president china wuhan "
+         "bill gates 5g cure garlic water drink hot lemon test doctors nurses died patients cases spread "
+         "outbreak quarantine people video photo shows claims says new study shared facebook whatsapp twitter "
+         "post message false fake viral social media army police streets city country world health "
+         "organization who scientists lab created bat market infected thousands million border closed").split()
+LANGS = ["en"] * 16 + ["es", "fr", "pt", "hi"]
+COUNTRIES = ["United States", "India", "Spain", "Brazil", "France", "Italy", "United Kingdom", "Philippines",
+             "Nigeria", "South Africa", "Germany", "Argentina", "Colombia", "Indonesia", "Turkey"]
+ORGS = ["PolitiFact", "FactCheck.org", "Full Fact", "AFP", "Maldita.es", "Boom", "Vera Files", "Africa Check",
+        "Newtral", "Lupa", "Chequeado", "Correctiv", "Teyit", "Snopes", "Les Decodeurs"]
+RATINGS = ["False", "Misleading", "Partly false", "No evidence", "Mostly false", "Explanatory"]
+LABELS = ["PubAuthAction", "CommSpread", "GenMedAdv", "PromActs", "Consp", "VirTrans", "VirOrgn", "PubPrep",
+          "Vacc", "Prot", "None"]
+
+
+def words(rnd, nmin, nmax):
+    return " ".join(rnd.choice(WORDS) for _ in range(rnd.randint(nmin, nmax)))
+
+
+def generate_items(n, seed=42, missing=0.02):
+    """
+    Generate n items which look like the items in the Poynter data.
+    :param n: number of items
+    :param seed: random seed, the same seed always gives the same items
+    :param missing: fraction of items where one of the required fields is empty
+    :return: generator of items
+    """
+    rnd = random.Random(seed)
+    for i in range(n):
+        item = {
+            "Claim": words(rnd, 8, 40),
+            "Explaination": words(rnd, 15, 80),
+            "Link": f"https://www.poynter.org/?ifcn_misinformation=claim-{i}",
+            "Source": f"https://factcheck.example.org/{rnd.randrange(10**9)}/{i}",
+            "Source_Lang": rnd.choice(LANGS),
+            "Date": f"2020/{rnd.randint(1, 12):02d}/{rnd.randint(1, 28):02d}",
+            "Country": rnd.choice(COUNTRIES),
+            "Factcheck_Org": rnd.choice(ORGS),
+            "Label": rnd.choice(RATINGS),
+        }
+        if rnd.random() < missing:
+            item[rnd.choice(list(item))] = ""
+        yield item
+
+
+def write_completions(projdir, items, annnr, rnd, truth):
+    """
+    Create a label-studio project directory with a completion file for each item, like retrieve-annotated.py
+    expects them. The annotator chooses the "true" label of the item most of the time.
+    :param projdir: project directory to create
+    :param items: the items, as they were given to the annotator
+    :param annnr: the annotator number
+    :param rnd: random generator
+    :param truth: function to get the true label for an item
+    """
+    completions = os.path.join(projdir, "completions")
+    os.makedirs(completions)
+    for i, item in enumerate(items):
+        label = truth(item) if rnd.random() < 0.7 else rnd.choice(LABELS)
+        result = [
+            {"from_name": "label", "to_name": "html", "type": "choices", "value": {"choices": [label]}},
+            {"from_name": "rating", "to_name": "html", "type": "choices",
+             "value": {"choices": [str(rnd.randint(0, 9))]}},
+        ]
+        if rnd.random() < 0.1:
+            result.append({"from_name": "remark", "to_name": "html", "type": "textarea",
+                           "value": {"text": [words(rnd, 2, 8)]}})
+        data = dict(item, assigned=item["assigned"] + [annnr])
+        compl = {"id": i, "data": data, "completions": [{
+            "id": i * 1000 + 1, "result": result, "created_at": 1590000000 + i * 60,
+            "lead_time": rnd.uniform(5, 120)}]}
+        with open(os.path.join(completions, f"{i}.json"), "wt", encoding="utf8") as outfp:
+            outfp.write(json.dumps(compl))
+
+
+def generate_projects(setspref, projpref, nann, overlap, seed=42):
+    """
+    Create annotated project directories projpref_0 .. projpref_(nann-1) from all the sets created by
+    prepare-split-data.py: the sets are given to the annotators in turn and a fraction of the sets is also given
+    to the next annotator.
+    :return: total number of completion files
+    """
+    rnd = random.Random(seed)
+    manifest = dataio.load_sets_manifest(setspref)
+    perann = [[] for _ in range(nann)]
+    every = round(1 / overlap) if overlap > 0 else 0
+    for i, setnr in enumerate(sorted(manifest["sets"])):
+        items = dataio.load_items(manifest["sets"][setnr]["file"])
+        perann[i % nann].extend(items)
+        if every and i % every == 0:
+            perann[(i + 1) % nann].extend(items)
+    # the true label of an item only depends on the claim, so it is the same for all annotators
+    truth = lambda item: LABELS[zlib.crc32(item["Claim"].encode("utf8")) % len(LABELS)]
+    for annnr, items in enumerate(perann):
+        write_completions(f"{projpref}_{annnr}", items, annnr, rnd, truth)
+    return sum(len(items) for items in perann)
+
+
+def run_step(name, script, scriptargs, workdir):
+    """
+    Run one of the programs with --metrics-json and return its time and peak memory.
+    """
+    logger = runutils.ensurelogger()
+    mfile = os.path.join(workdir, f"metrics_{name}.json")
+    cmd = [sys.executable, os.path.join(SCRIPTDIR, script)] + scriptargs + ["--metrics-json", mfile]
+    logger.info(f"Running {name}: {' '.join(cmd)}")
+    start = time.perf_counter()
+    with open(os.path.join(workdir, f"{name}.out"), "wt") as outfp:
+        ret = subprocess.run(cmd, stdout=outfp, stderr=subprocess.STDOUT).returncode
+    seconds = time.perf_counter() - start
+    if ret != 0:
+        raise Exception(f"Step {name} failed with exit code {ret}, see {workdir}/{name}.out")
+    with open(mfile, "rt", encoding="utf8") as infp:
+        metrics = json.load(infp)
+    logger.info(f"Step {name}: {seconds:.2f}s, peak RSS {metrics['peak_rss']/(1024*1024):.1f} MB")
+    return {"seconds": seconds, "peak_rss": metrics["peak_rss"], "stages": metrics["stages"],
+            "counters": metrics["counters"]}
+
+
+def run_size(n, workdir, args):
+    """
+    Generate the data for n items and run all steps on it.
+    :return: map from step name to result
+    """
+    logger = runutils.ensurelogger()
+    for d in ["sets", "assign", "projects", "retrieved", "reassign", "agreement"]:
+        os.makedirs(os.path.join(workdir, d))
+    infile = os.path.join(workdir, "input.json")
+    with runutils.stage("generate"):
+        with open(infile, "wt", encoding="utf8") as outfp:
+            dataio.write_json_array(outfp, generate_items(n, seed=args.seed))
+    results = {}
+    setspref = os.path.join(workdir, "sets", "data")
+    results["split"] = run_step("split", "prepare-split-data.py", [infile, setspref, "-s", str(args.s)], workdir)
+    nsets = len(dataio.load_sets_manifest(setspref)["sets"])
+    nann = min(args.annotators, nsets)
+    results["assign"] = run_step("assign", "prepare-assign-data.py",
+                                 [setspref, os.path.join(workdir, "assign", "data"), "0", str(nann)], workdir)
+    projpref = os.path.join(workdir, "projects", "proj")
+    with runutils.stage("generate"):
+        nfiles = generate_projects(setspref, projpref, nann, args.overlap, seed=args.seed)
+    logger.info(f"Generated {nfiles} completion files for {nann} annotators")
+    retrpref = os.path.join(workdir, "retrieved", "data")
+    results["retrieve"] = run_step("retrieve", "retrieve-annotated.py",
+                                   [projpref, retrpref, "--batch", "--workers", str(args.workers)], workdir)
+    retrieved = sorted(f for f in glob.glob(retrpref + "_ann*.json") if not f.endswith(".manifest.json"))
+    newanns = [str(nann + i) for i in range(nann)]
+    results["reassign"] = run_step("reassign", "reassign.py",
+                                   ["--infiles"] + retrieved + ["--outpref", os.path.join(workdir, "reassign", "data"),
+                                    "--annotators"] + newanns, workdir)
+    results["agreement"] = run_step("agreement", "agreement.py",
+                                    ["--infiles"] + retrieved +
+                                    ["--outcsv", os.path.join(workdir, "agreement", "pairs.csv")], workdir)
+    return results
+
+
+def compare(results, baselines, tolerance, memtolerance, minseconds):
+    """
+    Compare the results to the baselines.
+    :return: list of messages, one for each regression
+    """
+    regressions = []
+    for size, steps in results.items():
+        for step, res in steps.items():
+            base = baselines.get(size, {}).get(step)
+            if base is None:
+                continue
+            maxsecs = max(base["seconds"] * (1 + tolerance), base["seconds"] + minseconds)
+            if res["seconds"] > maxsecs:
+                regressions.append(f"{step} with {size} items: {res['seconds']:.2f}s, baseline {base['seconds']:.2f}s")
+            if res["peak_rss"] > base["peak_rss"] * (1 + memtolerance):
+                regressions.append(f"{step} with {size} items: peak RSS {res['peak_rss']/(1024*1024):.1f} MB, "
+                                   f"baseline {base['peak_rss']/(1024*1024):.1f} MB")
+    return regressions
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=str, default=DEFAULT_SIZES,
+                        help=f"Comma separated numbers of items to benchmark with ({DEFAULT_SIZES})")
+    parser.add_argument("--out", type=str, default=None, help="Save the results to this JSON file")
+    parser.add_argument("--baselines", type=str, default=DEFAULT_BASELINES,
+                        help=f"Baselines to compare to ({DEFAULT_BASELINES})")
+    parser.add_argument("--update-baselines", action="store_true",
+                        help="Save the results as new baselines instead of comparing")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="Fraction by which a step may be slower than the baseline (0.25)")
+    parser.add_argument("--memtolerance", type=float, default=0.25,
+                        help="Fraction by which a step may use more memory than the baseline (0.25)")
+    parser.add_argument("--minseconds", type=float, default=1.0,
+                        help="A step is never considered slower if it is slower than the baseline by less than this (1.0)")
+    parser.add_argument("--workdir", type=str, default=None,
+                        help="Directory for the generated data, kept after the run (default: temporary directory)")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed for the data (42)")
+    parser.add_argument("-s", type=int, default=25, help="Set size for splitting (25)")
+    parser.add_argument("--annotators", type=int, default=20, help="Number of annotators (20)")
+    parser.add_argument("--overlap", type=float, default=0.2,
+                        help="Fraction of sets which also get annotated by a second annotator (0.2)")
+    parser.add_argument("--workers", type=int, default=4, help="Number of worker processes for retrieval (4)")
+    runutils.add_metrics_args(parser)
+    args = parser.parse_args()
+
+    logger = runutils.set_logger(args)
+    runutils.run_start()
+
+    sizes = [int(s) for s in args.sizes.split(",")]
+    results = {}
+    for n in sizes:
+        if args.workdir:
+            workdir = os.path.join(args.workdir, f"items{n}")
+            if os.path.exists(workdir):
+                shutil.rmtree(workdir)
+            os.makedirs(workdir)
+        else:
+            workdir = tempfile.mkdtemp(prefix=f"benchmark{n}_")
+        logger.info(f"Benchmarking with {n} items in {workdir}")
+        try:
+            results[str(n)] = run_size(n, workdir, args)
+        finally:
+            if not args.workdir:
+                shutil.rmtree(workdir)
+    if args.out:
+        with open(args.out, "wt", encoding="utf8") as outfp:
+            json.dump(results, outfp, indent=2)
+        logger.info(f"Results saved to {args.out}")
+    for size, steps in results.items():
+        for step, res in steps.items():
+            logger.info(f"{size:>8} items {step:<10} {res['seconds']:9.2f}s {res['peak_rss']/(1024*1024):9.1f} MB")
+
+    if args.update_baselines:
+        baselines = {}
+        if os.path.exists(args.baselines):
+            with open(args.baselines, "rt", encoding="utf8") as infp:
+                baselines = json.load(infp)
+        for size, steps in results.items():
+            baselines[size] = {step: {"seconds": res["seconds"], "peak_rss": res["peak_rss"]}
+                               for step, res in steps.items()}
+        if os.path.dirname(args.baselines):
+            os.makedirs(os.path.dirname(args.baselines), exist_ok=True)
+        with open(args.baselines, "wt", encoding="utf8") as outfp:
+            json.dump(baselines, outfp, indent=2)
+        logger.info(f"Baselines saved to {args.baselines}")
+        runutils.run_stop()
+        sys.exit(0)
+    if not os.path.exists(args.baselines):
+        logger.warning(f"No baselines file {args.baselines}, nothing to compare to (use --update-baselines)")
+        runutils.run_stop()
+        sys.exit(0)
+    with open(args.baselines, "rt", encoding="utf8") as infp:
+        baselines = json.load(infp)
+    regressions = compare(results, baselines, args.tolerance, args.memtolerance, args.minseconds)
+    for msg in regressions:
+        logger.error(f"Regression: {msg}")
+    if not regressions:
+        logger.info("No regressions")
+    runutils.run_stop()
+    sys.exit(1 if regressions else 0)
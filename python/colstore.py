@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+"""
+Compact columnar on-disk format for items and their annotations, as an alternative to the JSON files.
+A store is a directory with the extension .cols which contains:
+* meta.json: number of items, names of the columns, the label and confidence codecs
+* payload.jsonl: one line per item with all fields which are not stored in a column
+* payload.idx.npy: the byte offsets of the lines in payload.jsonl (number of items + 1)
+* assigned.npy, assigned.idx.npy: the values of all the "assigned" lists and the offsets for each item
+* annNN_label.npy, annNN_conf.npy: one small integer code per item for each annotator, -1 if missing or empty,
+  -2 if the value is null
+All npy files get memory-mapped when reading, so a program only pays for the columns it actually uses.
+The labels and confidences are encoded using the Choice values/aliases from the label-studio config, labels not
+in the config are added to the codec stored with the data.
+In the payload, the fields stored in columns are kept with a null value so that the original order of the
+fields can be restored.
+A store is written to a temporary directory next to it which replaces the store only once it is complete, so a crash
+never leaves a half-written store.
+When run as a program, this checks that the items of a JSON/JSONL file come back exactly as they were after being
+saved as a store, e.g. `./python/colstore.py annotations/round1_ann01.json`.
+"""
+import os
+import json
+import mmap
+import shutil
+import threading
+import xml.etree.ElementTree as ET
+import numpy as np
+import regex
+
+STORE_EXT = ".cols"
+DEFAULT_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "label-studio", "tmpl_config.xml")
+PAT_ANNFIELD = regex.compile(r"ann[0-9]+_(label|conf)")
+# the codes for a missing or empty value and for null
+EMPTY_CODE = -1
+NULL_CODE = -2
+
+
+class Codec:
+    """
+    Map the string values of a field to small integer codes and back. The empty string has code -1 (EMPTY_CODE),
+    None has code -2 (NULL_CODE), so both come back as they were.
+    """
+    def __init__(self, values=None):
+        self.values = list(values) if values else []
+        self.value2code = {v: i for i, v in enumerate(self.values)}
+
+    @classmethod
+    def from_config(cls, config=DEFAULT_CONFIG, name="label"):
+        """
+        Create the codec from the Choices element with the given name in a label-studio config file. For each
+        Choice, the alias is used if there is one, otherwise the value, since this is what label-studio stores.
+        :param config: label-studio config file
+        :param name: the name of the Choices element
+        :return: codec
+        """
+        if config is None or not os.path.exists(config):
+            return cls()
+        root = ET.parse(config).getroot()
+        for choices in root.iter("Choices"):
+            if choices.get("name") == name:
+                return cls([c.get("alias") or c.get("value") for c in choices.iter("Choice")])
+        return cls()
+
+    def __len__(self):
+        return len(self.values)
+
+    def encode(self, value, extend=True):
+        """
+        Get the code for a value.
+        :param value: value, empty string or None for missing
+        :param extend: if True, add unknown values to the codec, otherwise raise an exception
+        :return: the code, -1 for the empty string, -2 for None
+        """
+        if value is None:
+            return NULL_CODE
+        if value == "":
+            return EMPTY_CODE
+        code = self.value2code.get(value)
+        if code is None:
+            if not extend:
+                raise Exception(f"Value not known to the codec: {value}")
+            code = self.value2code[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def decode(self, code):
+        if code == NULL_CODE:
+            return None
+        return "" if code < 0 else self.values[code]
+
+
+def is_store(path):
+    """
+    Check if the path is (the name of) a columnar store.
+    """
+    return path.endswith(STORE_EXT)
+
+
+def write_store(path, items, config=DEFAULT_CONFIG):
+    """
+    Save the items as a columnar store, replacing whatever may already be there once the new store is complete.
+    If there is an exception, the store is not changed.
+    :param path: store directory, should have extension .cols
+    :param items: iterable of items
+    :param config: label-studio config file to get the codecs from
+    :return: number of items written
+    """
+    path = path.rstrip(os.sep)
+    tmppath = f"{path}.tmp{os.getpid()}-{threading.get_ident()}"
+    if os.path.exists(tmppath):
+        shutil.rmtree(tmppath)
+    os.makedirs(tmppath)
+    try:
+        n = _write_store(tmppath, items, config)
+    except BaseException:
+        shutil.rmtree(tmppath, ignore_errors=True)
+        raise
+    # a directory cannot replace another one which is not empty, so the old store is moved away first and only
+    # removed once the new one is in place
+    oldpath = None
+    if os.path.exists(path):
+        oldpath = f"{path}.old{os.getpid()}-{threading.get_ident()}"
+        os.rename(path, oldpath)
+    os.rename(tmppath, path)
+    if oldpath is not None:
+        shutil.rmtree(oldpath)
+    return n
+
+
+def _write_store(path, items, config):
+    """
+    Write the files of a store to an empty directory, see write_store.
+    """
+    labels = Codec.from_config(config, "label")
+    confs = Codec.from_config(config, "rating")
+    offsets = [0]
+    assigned = []
+    assigned_offsets = [0]
+    # annotation columns: name -> list of codes, filled up with -1 for items before the first with that column
+    columns = {}
+    n = 0
+    with open(os.path.join(path, "payload.jsonl"), "wb") as outfp:
+        for item in items:
+            payload = {}
+            for k, v in item.items():
+                if k == "assigned":
+                    assigned.extend(v)
+                    payload[k] = None
+                elif PAT_ANNFIELD.fullmatch(k):
+                    col = columns.get(k)
+                    if col is None:
+                        col = columns[k] = [-1] * n
+                    col.append((labels if k.endswith("_label") else confs).encode(v))
+                    payload[k] = None
+                else:
+                    payload[k] = v
+            for col in columns.values():
+                if len(col) == n:
+                    col.append(-1)
+            assigned_offsets.append(len(assigned))
+            line = json.dumps(payload).encode("utf8") + b"\n"
+            outfp.write(line)
+            offsets.append(offsets[-1] + len(line))
+            n += 1
+    np.save(os.path.join(path, "payload.idx.npy"), np.asarray(offsets, dtype=np.int64))
+    np.save(os.path.join(path, "assigned.npy"), np.asarray(assigned, dtype=np.int16))
+    np.save(os.path.join(path, "assigned.idx.npy"), np.asarray(assigned_offsets, dtype=np.int64))
+    for name, col in columns.items():
+        np.save(os.path.join(path, name + ".npy"), np.asarray(col, dtype=np.int16))
+    meta = {"version": 1, "n": n, "columns": sorted(columns), "labels": labels.values, "confs": confs.values}
+    with open(os.path.join(path, "meta.json"), "wt", encoding="utf8") as outfp:
+        json.dump(meta, outfp)
+    return n
+
+
+class Store:
+    """
+    Read access to a columnar store. Columns are memory-mapped when first used, the payload is only
+    parsed for the items which get materialized.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json"), "rt", encoding="utf8") as infp:
+            self.meta = json.load(infp)
+        self.labels = Codec(self.meta["labels"])
+        self.confs = Codec(self.meta["confs"])
+        self.columns = self.meta["columns"]
+        self._arrays = {}
+        self._payload = None
+
+    def __len__(self):
+        return self.meta["n"]
+
+    def array(self, name):
+        """
+        Get a memory-mapped column, e.g. "ann02_label", "assigned", "assigned.idx" or "payload.idx".
+        """
+        arr = self._arrays.get(name)
+        if arr is None:
+            arr = self._arrays[name] = np.load(os.path.join(self.path, name + ".npy"), mmap_mode="r")
+        return arr
+
+    def assigned(self, i):
+        """
+        The assigned list of item i.
+        """
+        offsets = self.array("assigned.idx")
+        return self.array("assigned")[offsets[i]:offsets[i+1]].tolist()
+
+    def annotators(self):
+        """
+        The names (annNN) of the annotators which have a label column.
+        """
+        return [c[:-6] for c in self.columns if c.endswith("_label")]
+
+    def payload(self, i):
+        """
+        Get the payload of item i: the fields not stored in columns, those which are have the value None.
+        """
+        if self._payload is None:
+            with open(os.path.join(self.path, "payload.jsonl"), "rb") as infp:
+                if os.fstat(infp.fileno()).st_size == 0:
+                    self._payload = b""
+                else:
+                    self._payload = mmap.mmap(infp.fileno(), 0, access=mmap.ACCESS_READ)
+        offsets = self.array("payload.idx")
+        return json.loads(self._payload[offsets[i]:offsets[i+1]])
+
+    def item(self, i):
+        """
+        Materialize item i as a dict, exactly as it was written.
+        """
+        item = self.payload(i)
+        for k in item:
+            if item[k] is not None:
+                continue
+            if k == "assigned":
+                item[k] = self.assigned(i)
+            elif k in self.columns:
+                codec = self.labels if k.endswith("_label") else self.confs
+                item[k] = codec.decode(int(self.array(k)[i]))
+        return item
+
+    def items(self, rows=None):
+        """
+        Materialize all items or the items with the given indices.
+        :param rows: iterable of item indices or None for all
+        :return: list of dicts
+        """
+        if rows is None:
+            rows = range(len(self))
+        return [self.item(i) for i in rows]
+
+
+def read_store(path):
+    """
+    Read all items from a columnar store.
+    :param path: store directory
+    :return: list of items
+    """
+    return Store(path).items()
+
+
+def check_roundtrip(items, path, config=DEFAULT_CONFIG):
+    """
+    Save the items as a store and read them back.
+    :param items: list of items
+    :param path: store directory to use
+    :return: list of the indices of the items which did not come back exactly as they were
+    """
+    write_store(path, items, config)
+    back = read_store(path)
+    if len(back) != len(items):
+        raise Exception(f"Wrote {len(items)} items but read back {len(back)}")
+    # compare the serialized items, so the order of the fields and the types of the values count too
+    return [i for i, (a, b) in enumerate(zip(items, back)) if json.dumps(a) != json.dumps(b)]
+
+
+if __name__ == "__main__":
+    import argparse
+    import tempfile
+    import runutils
+    import dataio
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("infile", help="Input JSON/JSONL file")
+    parser.add_argument("--fmt", type=str, default="json", help="Input format (json, jsonl), default is json")
+    parser.add_argument("--config", type=str, default=DEFAULT_CONFIG, help="Label-studio config file for the codecs")
+    parser.add_argument("-d", action="store_true", help="Debug")
+    args = parser.parse_args()
+
+    logger = runutils.set_logger(args)
+    items = list(dataio.iter_items(args.infile, args.fmt))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        bad = check_roundtrip(items, os.path.join(tmpdir, "check" + STORE_EXT), args.config)
+    for i in bad[:10]:
+        logger.error(f"Item {i} did not come back as it was")
+    if bad:
+        raise Exception(f"{len(bad)} of {len(items)} items did not come back as they were")
+    logger.info(f"All {len(items)} items came back as they were")
@@ -0,0 +1,853 @@
+#!/usr/bin/env python
+"""
+Utilities for reading and writing the data files: opening (compressed) files, reading items incrementally
+from JSON and JSONL files, writing JSON arrays incrementally, writing files in the background and shuffling
+more items than fit into memory. All output files are written to a temporary file first and renamed once complete
+(see atomic_open), so a crash never leaves a half-written file, and are compressed if the name has the extension
+of a compressor. Lists of items can be saved as several shards, which get read back as one list.
+"""
+import io
+import json
+import contextlib
+import gzip
+import bz2
+import lzma
+import heapq
+import os
+import itertools
+import threading
+import concurrent.futures
+import random
+import tempfile
+import regex
+import colstore
+
+# files written by prepare-split-data.py and prepare-assign-data.py next to the sets / assigned sets
+SETS_MANIFEST = "_manifest.json"
+ASSIGNMENTS = "_assignments.json"
+PAT_ASSIGNED = regex.compile(rb'"assigned": \[([-0-9, ]*)\]\}')
+PAT_NONWS = regex.compile(r"\S")
+PAT_DELIM = regex.compile(r"[,\]]")
+# for reading only some fields of the items, see iter_fields: the start of a string or a bracket, a number or literal,
+# JSON whitespace
+PAT_BSPECIAL = regex.compile(rb'["\[\]{}]')
+PAT_BSCALAR = regex.compile(rb'[^,:\[\]{}" \t\r\n]+')
+PAT_BWS = regex.compile(rb'[ \t\r\n]*')
+DEFAULT_CHUNKSIZE = 1024*1024
+# file extensions for compressed files and the function to open them
+COMPRESSORS = {".gz": gzip.open, ".bz2": bz2.open, ".xz": lzma.open, ".lzma": lzma.open}
+# for writing, the functions to create the compressing file object over a binary file; gzip uses the compression level
+# of the gzip command and no time stamp, so the same data always gives the same file
+COMPRESS_WRITERS = {
+    ".gz": lambda fp, path: gzip.GzipFile(filename=os.path.basename(path), fileobj=fp, mode="wb", compresslevel=6,
+                                          mtime=0),
+    ".bz2": lambda fp, path: bz2.BZ2File(fp, "wb"),
+    ".xz": lambda fp, path: lzma.LZMAFile(fp, "wb"),
+    ".lzma": lambda fp, path: lzma.LZMAFile(fp, "wb", format=lzma.FORMAT_ALONE),
+}
+# the choices for the --compress option of programs which create the output file names themselves
+COMPRESS_CHOICES = ["gz", "bz2", "xz"]
+# buffer size for writing, so large files get written with few system calls
+WRITE_BUFFER = 4*1024*1024
+
+
+def open_file(path, mode="rt"):
+    """
+    Open a file for reading or writing, if the file name ends with .gz, .bz2, .xz or .lzma, use that compression.
+    :param path: file path
+    :param mode: the mode to use, e.g. "rt" or "wt"
+    :return: file object
+    """
+    encoding = None if "b" in mode else "utf8"
+    for ext, opener in COMPRESSORS.items():
+        if path.endswith(ext):
+            return opener(path, mode, encoding=encoding)
+    return open(path, mode, encoding=encoding)
+
+
+@contextlib.contextmanager
+def atomic_open(path, mode="wt"):
+    """
+    Open a file for writing, compressed if the file name ends with .gz, .bz2, .xz or .lzma. The data gets written
+    to a temporary file in the same directory, with a large buffer, which replaces the file only once everything
+    has been written. If there is an exception, the temporary file is removed and the file is not changed.
+    :param path: file path
+    :param mode: "wt" or "wb"
+    :return: context manager for the file object
+    """
+    if mode not in ["wt", "wb"]:
+        raise Exception(f"Not a valid mode for writing: {mode}")
+    tmppath = f"{path}.tmp{os.getpid()}-{threading.get_ident()}"
+    raw = open(tmppath, "wb", buffering=WRITE_BUFFER)
+    fp = raw
+    try:
+        for ext, writer in COMPRESS_WRITERS.items():
+            if path.endswith(ext):
+                fp = writer(raw, path)
+        if mode == "wt":
+            fp = io.TextIOWrapper(fp, encoding="utf8")
+        yield fp
+        fp.close()
+        raw.close()
+    except BaseException:
+        try:
+            fp.close()
+        except Exception:
+            pass
+        raw.close()
+        os.remove(tmppath)
+        raise
+    os.replace(tmppath, path)
+
+
+def add_compression(path, compress):
+    """
+    Add the extension for the compression chosen with a --compress option (one of COMPRESS_CHOICES) to the path.
+    :param compress: the compression or None
+    """
+    return path if compress is None else path + "." + compress
+
+
+def shard_path(path, i):
+    """
+    The path of shard i of a list of items saved to path with save_items, e.g. data.shard002.json.gz for data.json.gz.
+    """
+    base = strip_compression(path)
+    stem, ext = os.path.splitext(base)
+    return f"{stem}.shard{i:03d}{ext}{path[len(base):]}"
+
+
+def item_paths(path):
+    """
+    Get the files which contain the items saved to path with save_items: the file itself or its shards.
+    :param path: file path
+    :return: list of existing files, empty if there are none
+    """
+    if os.path.exists(path):
+        return [path]
+    paths = []
+    while os.path.exists(shard_path(path, len(paths))):
+        paths.append(shard_path(path, len(paths)))
+    return paths
+
+
+def strip_compression(path):
+    """
+    Return the path without the compression extension, if there is one.
+    """
+    for ext in COMPRESSORS:
+        if path.endswith(ext):
+            return path[:-len(ext)]
+    return path
+
+
+def load_items(path):
+    """
+    Load a list of items from a JSON file (which may be compressed) or a columnar store (see colstore.py).
+    :param path: file or store path
+    :return: list of items
+    """
+    if colstore.is_store(path):
+        return colstore.read_store(path)
+    items = []
+    for p in item_paths(path) or [path]:
+        with open_file(p, "rt") as reader:
+            items.extend(json.load(reader))
+    return items
+
+
+def save_items(path, items, shard=None):
+    """
+    Save a list of items to a JSON file (compressed if the name ends with e.g. .gz) or, if the path has
+    the extension .cols, as a columnar store. The file is only replaced once it has been written completely.
+    :param path: file or store path
+    :param items: list of items
+    :param shard: if not None and there are more items, save them in files of this many items (see shard_path),
+        load_items reads them back as one list. Shards or a file left from saving to the same path before are removed.
+    """
+    if colstore.is_store(path):
+        colstore.write_store(path, items)
+        return
+    if shard is None or len(items) <= shard:
+        parts = [(path, items)]
+    else:
+        parts = [(shard_path(path, i), items[start:start+shard]) for i, start in enumerate(range(0, len(items), shard))]
+    for p, part in parts:
+        with atomic_open(p, "wt") as writer:
+            write_json_array(writer, part)
+    if len(parts) > 1 and os.path.exists(path):
+        os.remove(path)
+    i = 0 if len(parts) == 1 else len(parts)
+    while os.path.exists(shard_path(path, i)):
+        os.remove(shard_path(path, i))
+        i += 1
+
+
+def load_sets_manifest(pref):
+    """
+    Load the manifest of the sets created by prepare-split-data.py for the given prefix, if there is one.
+    The file names in the manifest are made relative to the current directory.
+    :param pref: the output prefix used with prepare-split-data.py
+    :return: the manifest or None
+    """
+    mfile = pref + SETS_MANIFEST
+    if not os.path.exists(mfile):
+        return None
+    with open(mfile, "rt", encoding="utf8") as infp:
+        manifest = json.load(infp)
+    for entry in manifest["sets"].values():
+        entry["file"] = os.path.join(os.path.dirname(mfile), entry["file"])
+    return manifest
+
+
+def add_assigned(raw, annnr):
+    """
+    Append an annotator to the "assigned" list of a serialized item, without parsing it.
+    :param raw: the bytes of the item as written by json.dumps
+    :param annnr: the annotator number
+    :return: the changed bytes, the same as json.dumps would produce for the changed item
+    """
+    m = PAT_ASSIGNED.search(raw, max(0, len(raw) - 1000)) if raw.endswith(b"]}") else None
+    if m is None or m.end() != len(raw):
+        # "assigned" is not the last field, do it the slow way
+        item = json.loads(raw)
+        item["assigned"].append(annnr)
+        return json.dumps(item).encode("utf8")
+    sep = b", " if m.group(1) else b""
+    return raw[:-2] + sep + str(annnr).encode("utf8") + b"]}"
+
+
+def copy_set_assigned(setfile, offsets, annnr, outfile):
+    """
+    Copy a set file written by prepare-split-data.py to the outfile, appending the annotator number to the
+    assigned list of each item. If the offsets are known, this only works on the bytes of the items as found
+    via the offsets from the set manifest, the result is the same as loading the items, appending and saving.
+    :param setfile: the set file
+    :param offsets: list of [start, end] byte offsets, one for each item in the file, or None
+    :param annnr: annotator number
+    :param outfile: output file
+    """
+    if offsets is None:
+        data = load_items(setfile)
+        for item in data:
+            item["assigned"].append(annnr)
+        save_items(outfile, data)
+        return
+    with open_file(setfile, "rb") as infp:
+        data = infp.read()
+    raws = [add_assigned(data[start:end], annnr) for start, end in offsets]
+    with atomic_open(outfile, "wb") as outfp:
+        outfp.write(b"[" + b", ".join(raws) + b"]")
+
+
+def iter_jsonl(reader):
+    """
+    Yield the objects from a JSONL file, one per line, empty lines are ignored.
+    :param reader: file object opened for reading text
+    :return: generator of objects
+    """
+    for line in reader:
+        if line.strip():
+            yield json.loads(line)
+
+
+def iter_json_array(reader, chunksize=DEFAULT_CHUNKSIZE):
+    """
+    Yield the elements of a JSON array one by one without reading the whole array into memory.
+    Only the element currently parsed and one chunk of the input are kept in memory.
+    :param reader: file object opened for reading text
+    :param chunksize: number of characters to read at a time
+    :return: generator of the array elements
+    """
+    decoder = json.JSONDecoder()
+    buf = ""
+    pos = 0
+    eof = False
+
+    def nextchar():
+        # skip whitespace, read more data as needed, return the next non-ws character or "" at EOF
+        nonlocal buf, pos, eof
+        while True:
+            m = PAT_NONWS.search(buf, pos)
+            if m:
+                pos = m.start()
+                return buf[pos]
+            if eof:
+                return ""
+            buf = reader.read(chunksize)
+            pos = 0
+            eof = buf == ""
+
+    if nextchar() != "[":
+        raise Exception("Not a JSON array")
+    pos += 1
+    if nextchar() == "]":
+        return
+    while True:
+        if nextchar() == "":
+            raise Exception("Unexpected end of JSON array")
+        while True:
+            # a number or literal is only complete if we have the delimiter following it
+            if buf[pos] in "{[\"" or PAT_DELIM.search(buf, pos) or eof:
+                try:
+                    obj, end = decoder.raw_decode(buf, pos)
+                    break
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+            more = reader.read(chunksize)
+            eof = more == ""
+            buf = buf[pos:] + more
+            pos = 0
+        pos = end
+        yield obj
+        c = nextchar()
+        if c == "]":
+            return
+        if c != ",":
+            raise Exception(f"Expected ',' or ']' in JSON array but got {c!r}")
+        pos += 1
+
+
+def iter_items(path, fmt="json"):
+    """
+    Yield the items from a JSON (array) or JSONL file, which may be compressed.
+    :param path: file path
+    :param fmt: either "json" or "jsonl"
+    :return: generator of items
+    """
+    if fmt not in ["json", "jsonl"]:
+        raise Exception(f"Not a valid format: {fmt}")
+    for p in item_paths(path) or [path]:
+        with open_file(p, "rt") as reader:
+            if fmt == "jsonl":
+                yield from iter_jsonl(reader)
+            else:
+                yield from iter_json_array(reader)
+
+
+class _Incomplete(Exception):
+    """
+    Raised when the buffer ends before the JSON value being parsed.
+    """
+    pass
+
+
+def _skip_ws(buf, pos):
+    return PAT_BWS.match(buf, pos).end()
+
+
+def _string_end(buf, pos):
+    """
+    Find the end of the JSON string starting at pos in buf (bytes). This only looks for the quotes, which is much
+    faster than matching all the characters of long strings.
+    :return: the index after the closing quote
+    """
+    end = pos + 1
+    while True:
+        end = buf.find(b'"', end)
+        if end < 0:
+            raise _Incomplete()
+        # the quote is escaped if there is an odd number of backslashes before it
+        k = end
+        while buf[k - 1] == 0x5c:
+            k -= 1
+        if (end - k) % 2 == 0:
+            return end + 1
+        end += 1
+
+
+def _value_end(buf, pos, eof):
+    """
+    Find the end of the JSON value starting at pos in buf (bytes), without decoding it.
+    :return: the index after the value
+    """
+    c = buf[pos:pos+1]
+    if c == b'"':
+        return _string_end(buf, pos)
+    if c in (b"{", b"["):
+        depth = 0
+        while True:
+            m = PAT_BSPECIAL.search(buf, pos)
+            if m is None:
+                raise _Incomplete()
+            t = buf[m.start()]
+            if t == 0x22:
+                pos = _string_end(buf, m.start())
+                continue
+            pos = m.end()
+            if t in (0x7b, 0x5b):
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    return pos
+    m = PAT_BSCALAR.match(buf, pos)
+    if m is None or (m.end() == len(buf) and not eof):
+        raise _Incomplete()
+    return m.end()
+
+
+def _project(buf, pos, eof, want):
+    """
+    Decode the JSON object starting at pos in buf (bytes), but only the values of the keys wanted. The other
+    values are only scanned to find their end. Values which are not objects get decoded completely.
+    :return: a tuple (object, index after the object)
+    """
+    if buf[pos:pos+1] != b"{":
+        end = _value_end(buf, pos, eof)
+        return json.loads(buf[pos:end]), end
+    obj = {}
+    pos = _skip_ws(buf, pos + 1)
+    if buf[pos:pos+1] == b"}":
+        return obj, pos + 1
+    while True:
+        if buf[pos:pos+1] != b'"':
+            if pos == len(buf):
+                raise _Incomplete()
+            raise Exception(f"Expected a key in JSON object but got {buf[pos:pos+1]!r}")
+        end = _string_end(buf, pos)
+        key = buf[pos+1:end-1]
+        key = json.loads(buf[pos:end]) if b"\\" in key else key.decode("utf8")
+        pos = _skip_ws(buf, end)
+        if buf[pos:pos+1] != b":":
+            if pos == len(buf):
+                raise _Incomplete()
+            raise Exception(f"Expected ':' in JSON object but got {buf[pos:pos+1]!r}")
+        pos = _skip_ws(buf, pos + 1)
+        end = _value_end(buf, pos, eof)
+        if want(key):
+            obj[key] = json.loads(buf[pos:end])
+        pos = _skip_ws(buf, end)
+        c = buf[pos:pos+1]
+        if c == b"}":
+            return obj, pos + 1
+        if c != b",":
+            if c == b"":
+                raise _Incomplete()
+            raise Exception(f"Expected ',' or '}}' in JSON object but got {c!r}")
+        pos = _skip_ws(buf, pos + 1)
+
+
+def iter_fields(path, fields, fmt="json", offsets=False, chunksize=DEFAULT_CHUNKSIZE):
+    """
+    Yield the items from a JSON (array) or JSONL file, which may be compressed or saved as shards, but with only
+    some of the fields. The other fields are skipped without decoding them, so large strings (e.g. the html of
+    retrieved items) do not get allocated and only one chunk of the input (or the current item, if larger) is kept
+    in memory.
+    :param path: file path
+    :param fields: collection of the field names to keep, or a function which returns True for the names to keep
+    :param fmt: either "json" or "jsonl"
+    :param offsets: if True, yield tuples (item, (start, end)) with the byte offsets of each item in the
+        (uncompressed) file, this cannot be used for shards
+    :param chunksize: number of bytes to read at a time
+    :return: generator of items
+    """
+    if fmt not in ["json", "jsonl"]:
+        raise Exception(f"Not a valid format: {fmt}")
+    want = fields if callable(fields) else set(fields).__contains__
+    paths = item_paths(path) or [path]
+    if offsets and paths != [path]:
+        raise Exception(f"Cannot get the offsets of the items in the shards of {path}")
+    for p in paths:
+        with open_file(p, "rb") as reader:
+            yield from _iter_fields(reader, p, want, fmt, offsets, chunksize)
+
+
+def _iter_fields(reader, path, want, fmt, offsets, chunksize):
+    """
+    Yield the items with the fields wanted from a binary file object, see iter_fields.
+    """
+    buf = b""
+    # the offset of buf in the file
+    base = 0
+    pos = 0
+    eof = False
+
+    def more():
+        # read more data, keeping everything from pos, at least doubling what is kept for large items
+        nonlocal buf, base, pos, eof
+        data = reader.read(max(chunksize, len(buf) - pos))
+        eof = data == b""
+        buf = buf[pos:] + data
+        base += pos
+        pos = 0
+
+    def nextbyte():
+        # skip whitespace (and in JSONL, empty lines), return the next byte or b"" at EOF
+        nonlocal pos
+        while True:
+            pos = _skip_ws(buf, pos)
+            if pos < len(buf):
+                return buf[pos:pos+1]
+            if eof:
+                return b""
+            more()
+
+    def nextitem():
+        while True:
+            try:
+                return _project(buf, pos, eof, want)
+            except _Incomplete:
+                if eof:
+                    raise Exception(f"Unexpected end of JSON in {path}")
+                more()
+
+    if fmt == "json":
+        if nextbyte() != b"[":
+            raise Exception("Not a JSON array")
+        pos += 1
+        if nextbyte() == b"]":
+            return
+    while True:
+        if nextbyte() == b"":
+            if fmt == "jsonl":
+                return
+            raise Exception("Unexpected end of JSON array")
+        obj, end = nextitem()
+        if offsets:
+            yield obj, (base + pos, base + end)
+        else:
+            yield obj
+        pos = end
+        if fmt == "jsonl":
+            continue
+        c = nextbyte()
+        if c == b"]":
+            return
+        if c != b",":
+            raise Exception(f"Expected ',' or ']' in JSON array but got {c!r}")
+        pos += 1
+
+
+def load_fields(path, fields):
+    """
+    Load a list of items from a JSON file (which may be compressed) or a columnar store (see colstore.py), but
+    only with the given fields, see iter_fields.
+    :param path: file or store path
+    :param fields: collection of field names or a function which returns True for the names to keep
+    :return: list of items
+    """
+    if colstore.is_store(path):
+        want = fields if callable(fields) else set(fields).__contains__
+        return [{k: v for k, v in item.items() if want(k)} for item in colstore.read_store(path)]
+    return list(iter_fields(path, fields))
+
+
+class LazyItems:
+    """
+    The items of an uncompressed JSON file, of which only some fields are kept in memory. Complete items get
+    read from the file when needed, using the byte offsets of the items. This has the same methods as
+    colstore.Store for the fields kept.
+    """
+    def __init__(self, path, fields=("assigned",)):
+        """
+        :param path: file path
+        :param fields: the fields to keep in memory, see iter_fields
+        """
+        self.path = path
+        self.fields = []
+        self.offsets = []
+        for obj, span in iter_fields(path, fields, offsets=True):
+            self.fields.append(obj)
+            self.offsets.append(span)
+        self.fp = None
+
+    def __len__(self):
+        return len(self.fields)
+
+    def assigned(self, i):
+        """
+        Get the list of annotators item i has been assigned to.
+        """
+        return self.fields[i].get("assigned", [])
+
+    def kept(self, i):
+        """
+        Get the fields of item i which are kept in memory.
+        """
+        return self.fields[i]
+
+    def item(self, i):
+        """
+        Read the complete item i from the file.
+        """
+        if self.fp is None:
+            self.fp = open(self.path, "rb")
+        start, end = self.offsets[i]
+        self.fp.seek(start)
+        return json.loads(self.fp.read(end - start))
+
+    def close(self):
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
+
+
+def write_json_array(writer, objs):
+    """
+    Write the objects as a JSON array, one at a time. This writes exactly the same as json.dump(list(objs), writer).
+    :param writer: file object opened for writing text
+    :param objs: iterable of objects
+    :return: number of objects written
+    """
+    return write_raw_array(writer, (json.dumps(obj) for obj in objs))
+
+
+def write_raw_array(writer, raws):
+    """
+    Write a JSON array from the already serialized elements, one at a time. For the JSON strings of a list
+    of objects, this writes exactly the same as json.dump of the list.
+    :param writer: file object opened for writing text
+    :param raws: iterable of JSON strings
+    :return: number of elements written
+    """
+    n = 0
+    writer.write("[")
+    for raw in raws:
+        if n > 0:
+            writer.write(", ")
+        writer.write(raw)
+        n += 1
+    writer.write("]")
+    return n
+
+
+def iter_chunks(iterable, size):
+    """
+    Yield lists of up to size elements from the iterable.
+    :param iterable: any iterable
+    :param size: maximum number of elements per chunk
+    :return: generator of lists
+    """
+    it = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(it, size))
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+
+class WriterPool:
+    """
+    Run file writing functions in background threads, so that writing can overlap with whatever else
+    the program is doing. At most maxpending writes can be queued, submitting another one blocks until
+    one of them has finished, so the memory needed for the data waiting to get written is bounded.
+    If nthreads is 0, the functions are run immediately when submitted.
+    """
+    def __init__(self, nthreads=2, maxpending=4):
+        self.executor = None
+        if nthreads > 0:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=nthreads)
+        self.slots = threading.BoundedSemaphore(max(maxpending, nthreads, 1))
+        self.futures = []
+
+    def submit(self, func, *args):
+        if self.executor is None:
+            func(*args)
+            return
+        self.slots.acquire()
+        future = self.executor.submit(func, *args)
+        future.add_done_callback(lambda f: self.slots.release())
+        self.futures.append(future)
+        # check finished writes early so errors are not only noticed at the very end
+        while self.futures and self.futures[0].done():
+            self.futures.pop(0).result()
+
+    def close(self):
+        """
+        Wait for all writes to finish, raise the exception of the first write that failed, if any.
+        """
+        if self.executor is None:
+            return
+        self.executor.shutdown(wait=True)
+        for future in self.futures:
+            future.result()
+        self.futures = []
+
+
+class ExternalShuffle:
+    """
+    Randomly shuffle an arbitrary number of JSON strings while only keeping a fixed number of them in memory.
+    Each string gets a random key, whenever maxitems strings have been added, they get sorted by key and
+    written to a temporary file. Iterating merges all those files, which gives a random permutation which
+    only depends on the seed and the order in which the strings were added.
+    If the keys are given when adding, this sorts the strings by those keys instead.
+    """
+    def __init__(self, seed, maxitems=100000, tmpdir=None):
+        """
+        :param seed: random seed
+        :param maxitems: maximum number of strings to keep in memory
+        :param tmpdir: directory for the temporary files, if None, the system default
+        """
+        self.rand = random.Random(seed)
+        self.maxitems = maxitems
+        self.tmpdir = tmpdir
+        self.buffer = []
+        self.files = []
+        self.n = 0
+
+    def __len__(self):
+        return self.n
+
+    def add(self, raw, key=None):
+        """
+        Add a JSON string, which must not contain a new line (which is the case for anything created by json.dumps).
+        :param raw: JSON string
+        :param key: the key to sort by, a string without tabs and new lines, if None, a random key is used
+        """
+        if key is None:
+            key = f"{self.rand.getrandbits(64):016x}"
+        self.buffer.append(f"{key}\t{raw}\n")
+        self.n += 1
+        if len(self.buffer) >= self.maxitems:
+            self._spill()
+
+    def _spill(self):
+        self.buffer.sort()
+        fp = tempfile.TemporaryFile("w+t", encoding="utf8", dir=self.tmpdir)
+        fp.writelines(self.buffer)
+        self.files.append(fp)
+        self.buffer = []
+
+    def __iter__(self):
+        for _, raw in self.items():
+            yield raw
+
+    def items(self):
+        """
+        Iterate over the tuples (key, JSON string) in the order of the keys.
+        """
+        self.buffer.sort()
+        for fp in self.files:
+            fp.seek(0)
+        for line in heapq.merge(self.buffer, *self.files):
+            key, raw = line[:-1].split("\t", 1)
+            yield key, raw
+
+    def close(self):
+        for fp in self.files:
+            fp.close()
+        self.files = []
+        self.buffer = []
+
+
+class PartitionedShuffle:
+    """
+    Shuffle the JSON strings of several partitions with a single ExternalShuffle, so at most maxitems strings of all
+    partitions together are kept in memory. Each partition (see partition) gets its own random keys from the seed,
+    so its strings come out in the same order as with an ExternalShuffle of its own. The keys are prefixed with the
+    partition value, so iterating the shuffle gives the partitions one after the other in the sorted order of their
+    values, and the partitions must be iterated in that order.
+    """
+    def __init__(self, seed, maxitems=100000, tmpdir=None):
+        """
+        :param seed: random seed, used for the keys of each partition
+        :param maxitems: maximum number of strings of all partitions to keep in memory
+        :param tmpdir: directory for the temporary files, if None, the system default
+        """
+        self.seed = seed
+        self.shuffle = ExternalShuffle(seed, maxitems=maxitems, tmpdir=tmpdir)
+        self.merged = None
+        self.pending = None
+
+    def partition(self, value):
+        """
+        Get the container for the strings of one partition, which has the same methods as ExternalShuffle.
+        :param value: the partition value, a string
+        """
+        return _ShufflePartition(self, value)
+
+    def _items(self, prefix):
+        # the partitions come one after the other, skip what is left of the ones before
+        if self.merged is None:
+            self.merged = self.shuffle.items()
+        while True:
+            if self.pending is None:
+                self.pending = next(self.merged, None)
+                if self.pending is None:
+                    return
+            key, raw = self.pending
+            if key > prefix and not key.startswith(prefix):
+                return
+            self.pending = None
+            if key.startswith(prefix):
+                yield key[len(prefix):], raw
+
+    def close(self):
+        self.shuffle.close()
+        self.merged = None
+        self.pending = None
+
+
+class _ShufflePartition:
+    """
+    The strings of one partition of a PartitionedShuffle.
+    """
+    def __init__(self, parent, value):
+        self.parent = parent
+        self.rand = random.Random(parent.seed)
+        # the bytes of the value in hex sort like the values, the dot sorts before all hex digits, so a value
+        # comes before all values it is the beginning of
+        self.prefix = value.encode("utf8").hex() + "."
+        self.n = 0
+
+    def __len__(self):
+        return self.n
+
+    def add(self, raw, key=None):
+        if key is None:
+            key = f"{self.rand.getrandbits(64):016x}"
+        self.parent.shuffle.add(raw, self.prefix + key)
+        self.n += 1
+
+    def __iter__(self):
+        for _, raw in self.items():
+            yield raw
+
+    def items(self):
+        return self.parent._items(self.prefix)
+
+    def close(self):
+        pass
+
+
+class SmallestKeys:
+    """
+    Keep only the JSON strings with the limit smallest keys of all strings added, in memory. The number of
+    strings kept never gets larger than twice the limit, so the time needed for n strings is O(n log(limit)).
+    This has the same methods as ExternalShuffle with given keys.
+    """
+    def __init__(self, limit):
+        """
+        :param limit: number of strings to keep
+        """
+        self.limit = limit
+        self.buffer = []
+        self.n = 0
+
+    def __len__(self):
+        return self.n
+
+    def add(self, raw, key):
+        """
+        Add a JSON string with the key to sort by.
+        """
+        self.buffer.append((key, raw))
+        self.n += 1
+        if len(self.buffer) >= 2 * self.limit:
+            self.buffer = heapq.nsmallest(self.limit, self.buffer)
+
+    def __iter__(self):
+        for _, raw in self.items():
+            yield raw
+
+    def items(self):
+        """
+        Iterate over the tuples (key, JSON string) kept, in the order of the keys.
+        """
+        self.buffer = heapq.nsmallest(self.limit, self.buffer)
+        yield from self.buffer
+
+    def close(self):
+        self.buffer = []
@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+"""
+Detection of near-duplicate claims with MinHash and locality sensitive hashing (LSH).
+The Claim text is normalized (PAT_WS, lower case) and represented by the set of its character shingles. The MinHash
+signature of that set is a small array of minimum hash values, for two claims the proportion of equal values
+estimates the Jaccard similarity of their shingle sets. The signature is cut into bands, and claims which agree
+on all values of at least one band land in the same bucket, so only claims which share a bucket are compared:
+the time needed grows linearly with the number of claims instead of quadratically.
+Each cluster is represented by the first claim seen for it. A new claim is added to the cluster of the most similar
+representative in its buckets if the estimated similarity is at least the threshold, otherwise it becomes the
+representative of a new cluster. The index can be saved and loaded again, so later batches get deduplicated against
+the clusters of all earlier ones and cluster ids stay the same. A cluster can be added without claiming it (e.g.
+because its representative was not used in the end): the next claim which falls into such a cluster after the index
+has been loaded again is not counted as a near-duplicate but takes over the cluster.
+When run as a program, this reports the clusters for a JSON/JSONL file of items.
+"""
+import os
+import json
+import argparse
+import numpy as np
+import runutils
+import dataio
+import pipeline
+
+DEFAULT_PERMS = 128
+DEFAULT_BANDS = 32
+DEFAULT_SHINGLE = 5
+DEFAULT_THRESHOLD = 0.5
+# the serialized item ends with this when the field "assigned" was just added by pipeline.prepare_item
+RAW_END = '"assigned": []}'
+
+
+def normalize(text):
+    """
+    Normalize a claim for comparing: runs of whitespace replaced like for the html, stripped and in lower case.
+    """
+    return pipeline.PAT_WS.sub(" ", text).strip().lower()
+
+
+class MinHasher:
+    """
+    Calculates MinHash signatures. Each of the nperms hash functions is a multiply-shift hash of the 64 bit shingle
+    hash with its own random odd multiplier and offset, all functions are applied at once with numpy.
+    This only holds the parameters, so it is cheap to send to worker processes.
+    """
+    def __init__(self, nperms=DEFAULT_PERMS, shingle=DEFAULT_SHINGLE, seed=42):
+        """
+        :param nperms: number of hash functions, the length of the signatures
+        :param shingle: number of characters per shingle
+        :param seed: random seed for the hash functions, must be the same for signatures which get compared
+        """
+        self.nperms = nperms
+        self.shingle = shingle
+        self.seed = seed
+        rng = np.random.default_rng(seed)
+        self.mults = rng.integers(0, 2**64, size=(nperms, 1), dtype=np.uint64) | np.uint64(1)
+        self.offsets = rng.integers(0, 2**64, size=(nperms, 1), dtype=np.uint64)
+        # polynomial rolling hash of the shingle bytes
+        self.powers = np.uint64(1099511628211) ** np.arange(shingle, dtype=np.uint64)
+
+    def shingles(self, text):
+        """
+        Hash the distinct character shingles of the normalized text.
+        :return: uint64 array of shingle hashes
+        """
+        data = np.frombuffer(normalize(text).encode("utf8"), dtype=np.uint8)
+        if len(data) < self.shingle:
+            data = np.concatenate([data, np.zeros(self.shingle - len(data), dtype=np.uint8)])
+        windows = np.lib.stride_tricks.sliding_window_view(data, self.shingle).astype(np.uint64)
+        return np.unique(windows @ self.powers)
+
+    def signature(self, text):
+        """
+        Calculate the MinHash signature of a text.
+        :return: uint32 array of length nperms
+        """
+        hashes = self.shingles(text)
+        return ((self.mults * hashes + self.offsets) >> np.uint64(32)).min(axis=1).astype(np.uint32)
+
+
+class Index:
+    """
+    LSH index of the MinHash signatures of the cluster representatives.
+    """
+    def __init__(self, nperms=DEFAULT_PERMS, bands=DEFAULT_BANDS, shingle=DEFAULT_SHINGLE,
+                 threshold=DEFAULT_THRESHOLD, seed=42):
+        """
+        :param nperms: length of the signatures, must be a multiple of bands
+        :param bands: number of bands, with more (and shorter) bands, less similar claims become candidates
+        :param shingle: number of characters per shingle
+        :param threshold: minimum estimated Jaccard similarity to a representative for being in its cluster
+        :param seed: random seed for the hash functions
+        """
+        if nperms % bands != 0:
+            raise Exception(f"Number of permutations {nperms} is not a multiple of the number of bands {bands}")
+        self.hasher = MinHasher(nperms, shingle, seed)
+        self.bands = bands
+        self.rows = nperms // bands
+        self.threshold = threshold
+        # signatures of the representatives, the cluster id is the index
+        self.sigs = []
+        # for each cluster if it has been claimed, and the ids of the loaded clusters which are not claimed and have
+        # not been taken over yet
+        self.claimed = []
+        self.open = set()
+        self.buckets = [{} for _ in range(bands)]
+
+    def __len__(self):
+        return len(self.sigs)
+
+    def _keys(self, sig):
+        return [sig[b * self.rows:(b + 1) * self.rows].tobytes() for b in range(self.bands)]
+
+    def _insert(self, sig, claimed=True):
+        cid = len(self.sigs)
+        self.sigs.append(sig)
+        self.claimed.append(claimed)
+        for bucket, key in zip(self.buckets, self._keys(sig)):
+            bucket.setdefault(key, cid)
+        return cid
+
+    def query(self, sig):
+        """
+        Find the cluster of a signature without changing the index.
+        :return: a tuple (cluster id, estimated similarity) or (None, best similarity) if it is not in any cluster
+        """
+        cands = {bucket[key] for bucket, key in zip(self.buckets, self._keys(sig)) if key in bucket}
+        best, bestsim = None, 0.0
+        for cid in sorted(cands):
+            sim = float(np.count_nonzero(self.sigs[cid] == sig)) / len(sig)
+            if sim > bestsim:
+                best, bestsim = cid, sim
+        if bestsim < self.threshold:
+            return None, bestsim
+        return best, bestsim
+
+    def add(self, sig, claim=True):
+        """
+        Add a signature: find its cluster or make it the representative of a new one. Falling into a loaded cluster
+        which is not claimed counts as a new cluster, once.
+        :param claim: if False, a new cluster is not claimed, see claim
+        :return: a tuple (cluster id, flag if it is a new cluster)
+        """
+        cid, _ = self.query(sig)
+        if cid is None:
+            return self._insert(sig, claim), True
+        if cid in self.open:
+            self.open.discard(cid)
+            self.claimed[cid] = claim
+            return cid, True
+        return cid, False
+
+    def claim(self, cid):
+        """
+        Claim a cluster added with claim=False, e.g. once its representative has been used.
+        """
+        self.claimed[cid] = True
+
+    def save(self, path):
+        """
+        Save the index to a numpy .npz file, replacing the file only once it has been written completely.
+        """
+        params = dict(nperms=self.hasher.nperms, bands=self.bands, shingle=self.hasher.shingle,
+                      threshold=self.threshold, seed=self.hasher.seed)
+        sigs = np.stack(self.sigs) if self.sigs else np.zeros((0, self.hasher.nperms), dtype=np.uint32)
+        with dataio.atomic_open(path, "wb") as outfp:
+            np.savez(outfp, sigs=sigs, claimed=np.array(self.claimed, dtype=bool), params=np.array(json.dumps(params)))
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load an index saved with save, the parameters are the ones it was created with.
+        """
+        with np.load(path) as data:
+            params = json.loads(str(data["params"]))
+            index = cls(**params)
+            # indices saved before clusters could be left unclaimed have all clusters claimed
+            claimed = data["claimed"] if "claimed" in data else np.ones(len(data["sigs"]), dtype=bool)
+            for cid, (sig, c) in enumerate(zip(data["sigs"], claimed)):
+                index._insert(sig, bool(c))
+                if not c:
+                    index.open.add(cid)
+        return index
+
+
+def add_cluster(raw, cid):
+    """
+    Add the field "cluster" to an item serialized by prepare-split-data.py, before the field "assigned", so
+    the result is the same as json.dumps of the item with the field added before "assigned".
+    :param raw: JSON string of the item
+    :param cid: cluster id
+    :return: the changed JSON string
+    """
+    if not raw.endswith(RAW_END):
+        item = json.loads(raw)
+        assigned = item.pop("assigned", [])
+        item["cluster"] = cid
+        item["assigned"] = assigned
+        return json.dumps(item)
+    return raw[:-len(RAW_END)] + f'"cluster": {cid}, ' + RAW_END
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("infile", help="Input JSON/JSONL file")
+    parser.add_argument("--fmt", type=str, default="json", help="Input format (json, jsonl), default is json")
+    parser.add_argument("--index", type=str, default=None,
+                        help="Index file (.npz) to load if it exists and to save the updated index to")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help=f"Minimum estimated similarity for near-duplicates, for a new index ({DEFAULT_THRESHOLD})")
+    parser.add_argument("--outfile", type=str, default=None,
+                        help="If specified, save the cluster id of each item, in input order, to this JSON file")
+    parser.add_argument("-d", action="store_true", help="Debug")
+    runutils.add_metrics_args(parser)
+    args = parser.parse_args()
+
+    logger = runutils.set_logger(args)
+    runutils.run_start()
+
+    if args.index and os.path.exists(args.index):
+        index = Index.load(args.index)
+        logger.info(f"Loaded index with {len(index)} clusters from {args.index}")
+    else:
+        index = Index(threshold=args.threshold)
+    cids = []
+    n_in = 0
+    n_new = 0
+    with runutils.stage("dedup"):
+        for obj in dataio.iter_items(args.infile, args.fmt):
+            n_in += 1
+            claim = obj.get("Claim")
+            if not claim:
+                cids.append(None)
+                continue
+            cid, new = index.add(index.hasher.signature(claim))
+            cids.append(cid)
+            # this is not the same as the growth of the index, a claim can take over a cluster which was not claimed
+            n_new += new
+            if not new:
+                logger.debug(f"Item {n_in - 1} is a near-duplicate of cluster {cid}: {claim}")
+    runutils.count("items_read", n_in)
+    n_dups = sum(1 for cid in cids if cid is not None) - n_new
+    runutils.count("items_duplicate", n_dups)
+    logger.info(f"Items read: {n_in}, near-duplicates: {n_dups}, new clusters: {n_new}")
+    if args.outfile:
+        with dataio.atomic_open(args.outfile, "wt") as outfp:
+            json.dump(cids, outfp)
+        logger.info(f"Cluster ids saved to {args.outfile}")
+    if args.index:
+        index.save(args.index)
+        logger.info(f"Index with {len(index)} clusters saved to {args.index}")
+    runutils.run_stop()
@@ -0,0 +1,620 @@
+#!/usr/bin/env python
+"""
+Inter-annotator agreement statistics, computed with numpy array operations over all items at once.
+The annotations are represented as three parallel integer arrays: the item index, the annotator index and
+the label code of each annotation. This is compact even for many annotators who each only labelled a
+small part of the items.
+"""
+import numpy as np
+import collections
+import warnings
+import runutils
+
+
+class Annotations:
+    """
+    The label codes of all annotations, together with the label and annotator names for the codes and
+    annotator indices.
+    """
+    def __init__(self, items, anns, codes, nitems, labels, annotators):
+        """
+        :param items: int array, the item index of each annotation
+        :param anns: int array, the annotator index of each annotation
+        :param codes: int array, the label code of each annotation
+        :param nitems: the number of items (including those without annotations)
+        :param labels: list of label names, the code of a label is its index
+        :param annotators: list of annotator names, the annotator index is the index in this list
+        """
+        self.items = items
+        self.anns = anns
+        self.codes = codes
+        self.nitems = nitems
+        self.labels = labels
+        self.annotators = annotators
+
+    @property
+    def nlabels(self):
+        return len(self.labels)
+
+
+def is_label_key(key):
+    """
+    Check if a field of a retrieved item is the label of an annotator (annNN_label).
+    """
+    return key.startswith("ann") and key.endswith("_label")
+
+
+def encode(objs, labels=None):
+    """
+    Create the annotation arrays from retrieved items which contain fields annNN_label for each annotator NN.
+    Empty labels are treated as missing.
+    :param objs: list of items
+    :param labels: list of known label names, labels not in this list get added in the order encountered
+    :return: Annotations instance
+    """
+    labels = list(labels) if labels else []
+    label2code = {l: i for i, l in enumerate(labels)}
+    ann2idx = {}
+    items = []
+    anns = []
+    codes = []
+    for i, obj in enumerate(objs):
+        for k, l in obj.items():
+            if not l or not is_label_key(k):
+                continue
+            code = label2code.get(l)
+            if code is None:
+                code = label2code[l] = len(labels)
+                labels.append(l)
+            a = ann2idx.get(k[:-6])
+            if a is None:
+                a = ann2idx[k[:-6]] = len(ann2idx)
+            items.append(i)
+            anns.append(a)
+            codes.append(code)
+    # number the annotators in the order of their names
+    annotators = sorted(ann2idx)
+    perm = np.zeros(len(annotators), dtype=np.int64)
+    for newidx, a in enumerate(annotators):
+        perm[ann2idx[a]] = newidx
+    return Annotations(np.asarray(items, dtype=np.int64), perm[np.asarray(anns, dtype=np.int64)],
+                       np.asarray(codes, dtype=np.int64), len(objs), labels, annotators)
+
+
+def from_columns(columns, labels, nitems):
+    """
+    Create the annotation arrays from label code columns, e.g. the memory-mapped columns of a columnar store.
+    :param columns: map from annotator name to an int array with one label code per item, -1 for missing
+    :param labels: list of label names for the codes
+    :param nitems: number of items
+    :return: Annotations instance
+    """
+    annotators = sorted(columns)
+    items = []
+    anns = []
+    codes = []
+    for a, name in enumerate(annotators):
+        col = np.asarray(columns[name])
+        rows = np.nonzero(col >= 0)[0]
+        items.append(rows)
+        anns.append(np.full(len(rows), a, dtype=np.int64))
+        codes.append(col[rows].astype(np.int64))
+    if not annotators:
+        return Annotations(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64),
+                           nitems, list(labels), [])
+    return Annotations(np.concatenate(items), np.concatenate(anns), np.concatenate(codes),
+                       nitems, list(labels), annotators)
+
+
+def concat(annslist):
+    """
+    Combine the annotations of several sets of items, the items of each set come after those of the previous.
+    Labels and annotators are matched by name.
+    :param annslist: list of Annotations instances
+    :return: Annotations instance
+    """
+    labels = []
+    label2code = {}
+    annotators = sorted(set(a for anns in annslist for a in anns.annotators))
+    ann2idx = {a: i for i, a in enumerate(annotators)}
+    items = []
+    anns = []
+    codes = []
+    offset = 0
+    for part in annslist:
+        for l in part.labels:
+            if l not in label2code:
+                label2code[l] = len(labels)
+                labels.append(l)
+        codemap = np.asarray([label2code[l] for l in part.labels] or [0], dtype=np.int64)
+        annmap = np.asarray([ann2idx[a] for a in part.annotators] or [0], dtype=np.int64)
+        items.append(part.items + offset)
+        anns.append(annmap[part.anns])
+        codes.append(codemap[part.codes])
+        offset += part.nitems
+    return Annotations(np.concatenate(items), np.concatenate(anns), np.concatenate(codes),
+                       offset, labels, annotators)
+
+
+def label_counts(anns):
+    """
+    For each item, count how many annotators assigned each label.
+    :param anns: Annotations instance
+    :return: int matrix items x labels
+    """
+    nlabels = anns.nlabels
+    flat = anns.items * nlabels + anns.codes
+    return np.bincount(flat, minlength=anns.nitems * nlabels).reshape(anns.nitems, nlabels)
+
+
+def item_slots(anns):
+    """
+    Arrange the annotations by item: for each item, the annotator indices and label codes of its annotations,
+    ordered by annotator, padded with -1.
+    :param anns: Annotations instance
+    :return: a tuple of two int matrices items x max number of annotations per item (annotators, codes)
+    """
+    order = np.lexsort((anns.anns, anns.items))
+    items = anns.items[order]
+    per_item = np.bincount(items, minlength=anns.nitems)
+    nslots = int(per_item.max()) if len(items) > 0 else 0
+    starts = np.cumsum(per_item) - per_item
+    slot = np.arange(len(items)) - starts[items]
+    slotanns = np.full((anns.nitems, nslots), -1, dtype=np.int64)
+    slotcodes = np.full((anns.nitems, nslots), -1, dtype=np.int64)
+    slotanns[items, slot] = anns.anns[order]
+    slotcodes[items, slot] = anns.codes[order]
+    return slotanns, slotcodes
+
+
+def confusion_matrices(anns):
+    """
+    Confusion matrices for all pairs of annotators which have labelled at least one item in common, computed
+    from all pairs of annotations within each item at once.
+    :param anns: Annotations instance
+    :return: map from (first annotator index, second annotator index) to int matrix labels x labels, with the
+        labels of the first annotator as rows, the first annotator index is always the smaller one
+    """
+    nlabels = anns.nlabels
+    nann = len(anns.annotators)
+    slotanns, slotcodes = item_slots(anns)
+    keys = []
+    for s in range(slotanns.shape[1]):
+        for t in range(s + 1, slotanns.shape[1]):
+            valid = slotanns[:, t] >= 0
+            pair = slotanns[valid, s] * nann + slotanns[valid, t]
+            keys.append((pair * nlabels + slotcodes[valid, s]) * nlabels + slotcodes[valid, t])
+    if not keys:
+        return {}
+    uniq, cnt = np.unique(np.concatenate(keys), return_counts=True)
+    pairs = uniq // (nlabels * nlabels)
+    cells = uniq % (nlabels * nlabels)
+    # the keys are sorted, so all cells for a pair of annotators are next to each other
+    upairs, starts = np.unique(pairs, return_index=True)
+    ends = np.append(starts[1:], len(pairs))
+    ret = {}
+    for pair, start, end in zip(upairs, starts, ends):
+        confusion = np.zeros(nlabels * nlabels, dtype=np.int64)
+        confusion[cells[start:end]] = cnt[start:end]
+        ret[(int(pair // nann), int(pair % nann))] = confusion.reshape(nlabels, nlabels)
+    return ret
+
+
+def _kappa(po, pe):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(pe < 1.0, (po - pe) / (1.0 - pe), np.nan)
+
+
+def cohen_kappa(confusion):
+    """
+    Cohen's kappa from a confusion matrix.
+    :param confusion: labels x labels matrix
+    :return: a tuple (kappa, observed agreement, number of items)
+    """
+    n = confusion.sum()
+    if n == 0:
+        return np.nan, np.nan, 0
+    po = np.trace(confusion) / n
+    pe = np.dot(confusion.sum(axis=1), confusion.sum(axis=0)) / (n * n)
+    return float(_kappa(po, pe)), float(po), int(n)
+
+
+def observed_agreement(counts):
+    """
+    Proportion of agreeing pairs of annotations among all pairs of annotations of the same item. For items with
+    exactly two annotations this is the proportion of items where the labels are equal.
+    :param counts: items x labels counts
+    :return: a tuple (observed agreement, number of pairs)
+    """
+    m = counts.sum(axis=1)
+    pairs = (m * (m - 1)).sum() / 2
+    agreeing = (counts * (counts - 1)).sum() / 2
+    if pairs == 0:
+        return np.nan, 0
+    return float(agreeing / pairs), int(pairs)
+
+
+def fleiss_kappa(counts):
+    """
+    Fleiss' kappa, generalized to a varying number of annotators per item. Items with fewer than two annotations
+    are ignored.
+    :param counts: items x labels counts
+    :return: kappa
+    """
+    m = counts.sum(axis=1)
+    keep = m >= 2
+    counts = counts[keep]
+    m = m[keep]
+    if len(m) == 0:
+        return np.nan
+    pi = ((counts * counts).sum(axis=1) - m) / (m * (m - 1))
+    pj = counts.sum(axis=0) / m.sum()
+    return float(_kappa(pi.mean(), (pj * pj).sum()))
+
+
+def coincidence_matrix(counts):
+    """
+    Coincidence matrix as used for Krippendorff's alpha: each item with m annotations contributes its
+    m(m-1) ordered pairs of annotations from different annotators, weighted by 1/(m-1).
+    :param counts: items x labels counts
+    :return: float matrix labels x labels
+    """
+    m = counts.sum(axis=1)
+    keep = m >= 2
+    counts = counts[keep].astype(np.float64)
+    w = 1.0 / (m[keep] - 1)
+    return (counts * w[:, None]).T @ counts - np.diag((counts * w[:, None]).sum(axis=0))
+
+
+def krippendorff_alpha(coincidence):
+    """
+    Krippendorff's alpha for nominal data from the coincidence matrix.
+    :param coincidence: labels x labels coincidence matrix
+    :return: alpha
+    """
+    n = coincidence.sum()
+    nc = coincidence.sum(axis=1)
+    disagree_o = n - np.trace(coincidence)
+    disagree_e = n * n - (nc * nc).sum()
+    if n <= 1 or disagree_e == 0:
+        return np.nan
+    return float(1.0 - (n - 1) * disagree_o / disagree_e)
+
+
+def per_label_agreement(coincidence):
+    """
+    Specific agreement for each label: the proportion of pairable annotations with that label which are
+    paired with an annotation of the same label.
+    :param coincidence: labels x labels coincidence matrix
+    :return: vector with one value per label, nan for labels never used
+    """
+    nc = coincidence.sum(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(nc > 0, np.diag(coincidence) / nc, np.nan)
+
+
+def agreement(anns):
+    """
+    Calculate all agreement statistics.
+    :param anns: Annotations instance
+    :return: map with the statistics, the confusion matrices are numpy arrays, everything else plain Python values
+    """
+    counts = label_counts(anns)
+    m = counts.sum(axis=1)
+    coincidence = coincidence_matrix(counts)
+    po, npairs = observed_agreement(counts)
+    stats = {
+        "items": int(anns.nitems),
+        "items_multi": int((m >= 2).sum()),
+        "annotations": int(m.sum()),
+        "pairs": npairs,
+        "observed_agreement": po,
+        "fleiss_kappa": fleiss_kappa(counts),
+        "krippendorff_alpha": krippendorff_alpha(coincidence),
+        "per_label": dict(zip(anns.labels, per_label_agreement(coincidence).tolist())),
+        "pairwise": [],
+    }
+    for (a, b), confusion in sorted(confusion_matrices(anns).items()):
+        kappa, po, n = cohen_kappa(confusion)
+        stats["pairwise"].append({
+            "annotators": [anns.annotators[a], anns.annotators[b]],
+            "items": n, "observed_agreement": po, "cohen_kappa": kappa, "confusion": confusion,
+        })
+    return stats
+
+
+class IncrementalAgreement:
+    """
+    The agreement statistics of a changing collection of items, updated whenever an item is added or removed at
+    a cost which only depends on the number of annotations of that item, not on the number of items. Only the
+    sums the statistics are calculated from are kept: the confusion counts for each pair of annotators, the
+    coincidence matrix and the sums for observed agreement and Fleiss' kappa.
+    """
+    def __init__(self, labels=None):
+        """
+        :param labels: list of known label names, labels not in this list get added in the order encountered
+        """
+        self.labels = list(labels) if labels else []
+        self.label2code = {l: i for i, l in enumerate(self.labels)}
+        self.nitems = 0
+        self.nmulti = 0
+        self.nannotations = 0
+        self.pairs = 0
+        self.agreeing = 0
+        # for Fleiss' kappa: the sum of the per item agreement and the label totals of the items with 2+ annotations
+        self.sum_pi = 0.0
+        self.multi_annotations = 0
+        self.totals = collections.Counter()
+        # (code, code) -> weight and (annotator, annotator) -> Counter of (code, code)
+        self.coincidence = collections.Counter()
+        self.confusion = collections.defaultdict(collections.Counter)
+
+    def _code(self, label):
+        code = self.label2code.get(label)
+        if code is None:
+            code = self.label2code[label] = len(self.labels)
+            self.labels.append(label)
+        return code
+
+    def update(self, annlabels, sign=1):
+        """
+        Add (sign=1) or remove (sign=-1) the annotations of one item.
+        :param annlabels: map from annotator name to label, empty labels are treated as missing
+        :param sign: 1 or -1
+        """
+        codes = {a: self._code(l) for a, l in annlabels.items() if l}
+        m = len(codes)
+        self.nitems += sign
+        self.nannotations += sign * m
+        if m < 2:
+            return
+        counts = collections.Counter(codes.values())
+        self.nmulti += sign
+        self.pairs += sign * m * (m - 1) // 2
+        self.agreeing += sign * sum(c * (c - 1) // 2 for c in counts.values())
+        self.sum_pi += sign * (sum(c * c for c in counts.values()) - m) / (m * (m - 1))
+        self.multi_annotations += sign * m
+        for c1, n1 in counts.items():
+            self.totals[c1] += sign * n1
+            for c2, n2 in counts.items():
+                pairs = n1 * n2 - (n1 if c1 == c2 else 0)
+                if pairs:
+                    self.coincidence[(c1, c2)] += sign * pairs / (m - 1)
+        anns = sorted(codes)
+        for i, a in enumerate(anns):
+            for b in anns[i + 1:]:
+                self.confusion[(a, b)][(codes[a], codes[b])] += sign
+
+    def add(self, annlabels):
+        self.update(annlabels, 1)
+
+    def remove(self, annlabels):
+        self.update(annlabels, -1)
+
+    def agreement(self):
+        """
+        Calculate all agreement statistics from the current sums.
+        :return: map with the same statistics as the function agreement
+        """
+        nlabels = len(self.labels)
+        coincidence = np.zeros((nlabels, nlabels), dtype=np.float64)
+        for (c1, c2), w in self.coincidence.items():
+            coincidence[c1, c2] = w
+        if self.nmulti > 0:
+            pj = np.asarray([self.totals[c] for c in range(nlabels)], dtype=np.float64) / self.multi_annotations
+            fleiss = float(_kappa(self.sum_pi / self.nmulti, (pj * pj).sum()))
+        else:
+            fleiss = np.nan
+        stats = {
+            "items": self.nitems,
+            "items_multi": self.nmulti,
+            "annotations": self.nannotations,
+            "pairs": self.pairs,
+            "observed_agreement": float(self.agreeing / self.pairs) if self.pairs > 0 else np.nan,
+            "fleiss_kappa": fleiss,
+            "krippendorff_alpha": krippendorff_alpha(coincidence),
+            "per_label": dict(zip(self.labels, per_label_agreement(coincidence).tolist())),
+            "pairwise": [],
+        }
+        for (a, b), cells in sorted(self.confusion.items()):
+            confusion = np.zeros((nlabels, nlabels), dtype=np.int64)
+            for (c1, c2), n in cells.items():
+                confusion[c1, c2] = n
+            kappa, po, n = cohen_kappa(confusion)
+            if n == 0:
+                continue
+            stats["pairwise"].append({
+                "annotators": [a, b], "items": n, "observed_agreement": po, "cohen_kappa": kappa,
+                "confusion": confusion,
+            })
+        return stats
+
+
+def item_patterns(anns):
+    """
+    Group the items by identical annotations (same annotators with the same labels). All statistics only depend
+    on how often each such pattern occurs, which makes resampling much cheaper than working with the items.
+    :param anns: Annotations instance
+    :return: a tuple (Annotations instance with one item per pattern, int array with the frequency of each pattern)
+    """
+    slotanns, slotcodes = item_slots(anns)
+    nslots = slotanns.shape[1]
+    uniq, freq = np.unique(np.concatenate([slotanns, slotcodes], axis=1), axis=0, return_counts=True)
+    pattanns = uniq[:, :nslots]
+    pattcodes = uniq[:, nslots:]
+    items, slots = np.nonzero(pattanns >= 0)
+    patterns = Annotations(items, pattanns[items, slots], pattcodes[items, slots], len(uniq),
+                           anns.labels, anns.annotators)
+    return patterns, freq
+
+
+def _group_sums(mat, keys, nkeys):
+    """
+    Sum the columns of the matrix which have the same key.
+    :param mat: matrix B x n
+    :param keys: sorted int array with n keys
+    :param nkeys: number of possible keys
+    :return: matrix B x nkeys
+    """
+    ret = np.zeros((mat.shape[0], nkeys))
+    if len(keys) > 0:
+        ukeys, starts = np.unique(keys, return_index=True)
+        ret[:, ukeys] = np.add.reduceat(mat, starts, axis=1)
+    return ret
+
+
+def weighted_agreement(anns, weights):
+    """
+    Calculate the agreement statistics for many weightings of the items at once, e.g. for bootstrap resamples,
+    where the weight of an item is how often it occurs in the resample. With all weights 1, this gives the same
+    as agreement(anns).
+    :param anns: Annotations instance
+    :param weights: matrix B x items
+    :return: map with vectors of length B for "observed_agreement", "fleiss_kappa" and "krippendorff_alpha",
+        matrices B x labels for "per_label" and B x pairs for "cohen_kappa" and "pair_observed_agreement",
+        and the list of annotator index pairs for the columns of the latter as "pairs"
+    """
+    nlabels = anns.nlabels
+    nann = len(anns.annotators)
+    counts = label_counts(anns).astype(np.float64)
+    m = counts.sum(axis=1)
+    keep = m >= 2
+    kept = counts * keep[:, None]
+    sumsq = (counts * counts).sum(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        v = np.where(keep, 1.0 / (m - 1), 0.0)
+        pi = np.where(keep, (sumsq - m) / (m * (m - 1)), 0.0)
+        # observed agreement: agreeing pairs / all pairs
+        po = (weights @ ((counts * (counts - 1)).sum(axis=1) / 2)) / (weights @ (m * (m - 1) / 2))
+        # Fleiss' kappa
+        pbar = (weights @ pi) / (weights @ keep.astype(np.float64))
+        # the label totals of the kept items are also the row sums of the coincidence matrix
+        nc = weights @ kept
+        n = nc.sum(axis=1)
+        pj = nc / n[:, None]
+        fleiss = _kappa(pbar, (pj * pj).sum(axis=1))
+        # Krippendorff's alpha and per-label agreement from the diagonal of the coincidence matrix
+        diag = weights @ (v[:, None] * (counts * counts - counts))
+        alpha = 1.0 - (n - 1) * (n - diag.sum(axis=1)) / (n * n - (nc * nc).sum(axis=1))
+        per_label = np.where(nc > 0, diag / nc, np.nan)
+
+    # pairwise: all pairs of annotations within an item, grouped by annotator pair and the two labels
+    slotanns, slotcodes = item_slots(anns)
+    occitems = []
+    occkeys = []
+    for s in range(slotanns.shape[1]):
+        for t in range(s + 1, slotanns.shape[1]):
+            valid = np.nonzero(slotanns[:, t] >= 0)[0]
+            pair = slotanns[valid, s] * nann + slotanns[valid, t]
+            occitems.append(valid)
+            occkeys.append((pair * nlabels + slotcodes[valid, s]) * nlabels + slotcodes[valid, t])
+    occitems = np.concatenate(occitems) if occitems else np.zeros(0, dtype=np.int64)
+    occkeys = np.concatenate(occkeys) if occkeys else np.zeros(0, dtype=np.int64)
+    pairs = np.unique(occkeys // (nlabels * nlabels))
+    # renumber the pairs which actually occur 0..npairs-1
+    pairidx = np.searchsorted(pairs, occkeys // (nlabels * nlabels))
+    row = occkeys // nlabels % nlabels
+    col = occkeys % nlabels
+    occw = weights[:, occitems]
+    npairs = len(pairs)
+    order = np.argsort(pairidx, kind="stable")
+    total = _group_sums(occw[:, order], pairidx[order], npairs)
+    agree = occw[:, row == col]
+    agreekeys = pairidx[row == col]
+    order = np.argsort(agreekeys, kind="stable")
+    agree = _group_sums(agree[:, order], agreekeys[order], npairs)
+    rowkeys = pairidx * nlabels + row
+    order = np.argsort(rowkeys, kind="stable")
+    rowmarg = _group_sums(occw[:, order], rowkeys[order], npairs * nlabels)
+    colkeys = pairidx * nlabels + col
+    order = np.argsort(colkeys, kind="stable")
+    colmarg = _group_sums(occw[:, order], colkeys[order], npairs * nlabels)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        pair_po = agree / total
+        pair_pe = (rowmarg * colmarg).reshape(weights.shape[0], npairs, nlabels).sum(axis=2) / (total * total)
+        cohen = _kappa(pair_po, pair_pe)
+    return {
+        "observed_agreement": po,
+        "fleiss_kappa": fleiss,
+        "krippendorff_alpha": alpha,
+        "per_label": per_label,
+        "cohen_kappa": cohen,
+        "pair_observed_agreement": pair_po,
+        "pairs": [(int(p // nann), int(p % nann)) for p in pairs],
+    }
+
+
+def _bootstrap_chunk(task):
+    """
+    Calculate the statistics for one chunk of bootstrap resamples, this may run in a worker process.
+    :param task: a tuple (pattern Annotations, pattern frequencies, SeedSequence, number of resamples)
+    :return: the map returned by weighted_agreement for the resamples
+    """
+    patterns, freq, seedseq, size = task
+    rng = np.random.default_rng(seedseq)
+    nitems = freq.sum()
+    # drawing nitems item indices with replacement and counting how often each pattern got drawn
+    # has exactly the distribution of this multinomial
+    weights = rng.multinomial(nitems, freq / nitems, size=size).astype(np.float64)
+    return weighted_agreement(patterns, weights)
+
+
+def bootstrap(anns, nboot, seed=42, level=0.95, workers=1, chunksize=100):
+    """
+    Bootstrap confidence intervals (percentile method) for all agreement statistics, by resampling the items
+    with replacement. The resamples are calculated in chunks, possibly in several worker processes; each
+    chunk has its own seed derived from the given seed, so the result does not depend on the number of workers.
+    :param anns: Annotations instance
+    :param nboot: number of resamples
+    :param seed: random seed
+    :param level: confidence level
+    :param workers: number of worker processes
+    :param chunksize: number of resamples per chunk
+    :return: map like the one returned by agreement, with a list [lower, upper] in place of each statistic
+    """
+    patterns, freq = item_patterns(anns)
+    nchunks = (nboot + chunksize - 1) // chunksize
+    seedseqs = np.random.SeedSequence(seed).spawn(nchunks)
+    tasks = [(patterns, freq, seedseqs[i], min(chunksize, nboot - i * chunksize)) for i in range(nchunks)]
+    results = list(runutils.imap_bounded(_bootstrap_chunk, tasks, workers))
+    alpha = (1.0 - level) / 2.0
+
+    def ci(name):
+        vals = np.concatenate([r[name] for r in results], axis=0)
+        # statistics which are undefined for all resamples (e.g. a label never used) give NaN
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            return np.nanquantile(vals, [alpha, 1.0 - alpha], axis=0)
+
+    per_label = ci("per_label")
+    cohen = ci("cohen_kappa")
+    pair_po = ci("pair_observed_agreement")
+    pairs = results[0]["pairs"] if results else []
+    return {
+        "observed_agreement": ci("observed_agreement").tolist(),
+        "fleiss_kappa": ci("fleiss_kappa").tolist(),
+        "krippendorff_alpha": ci("krippendorff_alpha").tolist(),
+        "per_label": {label: per_label[:, i].tolist() for i, label in enumerate(anns.labels)},
+        "pairwise": [{"annotators": [anns.annotators[a], anns.annotators[b]],
+                      "observed_agreement": pair_po[:, i].tolist(), "cohen_kappa": cohen[:, i].tolist()}
+                     for i, (a, b) in enumerate(pairs)],
+    }
+
+
+def stats2json(stats):
+    """
+    Convert the statistics returned by agreement so they can get saved as JSON.
+    :param stats: statistics map
+    :return: map where all numpy arrays are converted to lists and NaN to None
+    """
+    def conv(val):
+        if isinstance(val, dict):
+            return {k: conv(v) for k, v in val.items()}
+        if isinstance(val, list):
+            return [conv(v) for v in val]
+        if isinstance(val, np.ndarray):
+            return val.tolist()
+        if isinstance(val, float) and np.isnan(val):
+            return None
+        return val
+    return conv(stats)
@@ -1,28 +1,102 @@
 #!/usr/bin/env python
 """
-Script to convert a file from JSONL format (one map per line) to JSON format (an array of maps)
+Script to convert a file from JSONL format (one map per line) to JSON format (an array of maps), or,
+with --outfmt jsonl, the other way round.
+The formats are determined from the file extensions (.json or .jsonl), files ending in .gz, .bz2, .xz or .lzma
+are compressed/decompressed on the fly. Items are converted in chunks and written incrementally, so only one
+chunk of items is kept in memory, no matter how big the files are.
 """
 
 import json
 import argparse
+import runutils
+import dataio
 
+DEFAULT_CHUNKSIZE = 10000
 
-parser = argparse.ArgumentParser()
-parser.add_argument("infile", help="Input JOSNL file")
-parser.add_argument("outfile", help="Output JOSN file")
-args = parser.parse_args()
 
-objs = []
-n = 0
-with open(args.infile, "rt", encoding="utf8") as reader:
-    for line in reader:
-        n += 1
-        obj = json.loads(line)
-        objs.append(obj)
+def file_format(path, default):
+    """
+    Get the format of a file from its extension, ignoring the compression extension.
+    :param path: file path
+    :param default: format to use if the extension is neither .json nor .jsonl
+    :return: "json" or "jsonl"
+    """
+    path = dataio.strip_compression(path)
+    if path.endswith(".jsonl"):
+        return "jsonl"
+    if path.endswith(".json"):
+        return "json"
+    return default
 
-with open(args.outfile, "wt", encoding="utf8") as writer:
-    json.dump(objs, writer)
 
-print(f"Converted {n} lines")
+def jsonl2json(reader, writer, chunksize=DEFAULT_CHUNKSIZE):
+    """
+    Convert JSONL to a JSON array, one chunk of lines at a time. Empty lines are ignored.
+    This writes the same as json.dump of the list of all objects.
+    :return: number of items converted
+    """
+    n = 0
+    writer.write("[")
+    lines = (line for line in reader if line.strip())
+    for chunk in runutils.timed_iter("read", dataio.iter_chunks(lines, chunksize)):
+        with runutils.stage("convert"):
+            raws = ", ".join(json.dumps(json.loads(line)) for line in chunk)
+        with runutils.stage("write"):
+            writer.write((", " if n > 0 else "") + raws)
+        n += len(chunk)
+    writer.write("]")
+    return n
 
 
+def json2jsonl(reader, writer, chunksize=DEFAULT_CHUNKSIZE):
+    """
+    Convert a JSON array to JSONL, parsing the array incrementally, one chunk of items at a time.
+    :return: number of items converted
+    """
+    n = 0
+    objs = dataio.iter_json_array(reader)
+    for chunk in runutils.timed_iter("read", dataio.iter_chunks(objs, chunksize)):
+        with runutils.stage("convert"):
+            lines = "".join(json.dumps(obj) + "\n" for obj in chunk)
+        with runutils.stage("write"):
+            writer.write(lines)
+        n += len(chunk)
+    return n
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("infile", help="Input JOSNL file (or JSON file with --infmt json)")
+    parser.add_argument("outfile", help="Output JOSN file (or JSONL file with --outfmt jsonl)")
+    parser.add_argument("--infmt", type=str, default=None,
+                        help="Input format, json or jsonl (default: from the extension, otherwise the opposite of the output format)")
+    parser.add_argument("--outfmt", type=str, default=None,
+                        help="Output format, json or jsonl (default: from the extension, otherwise the opposite of the input format)")
+    parser.add_argument("--chunksize", type=int, default=DEFAULT_CHUNKSIZE,
+                        help=f"Number of items to convert at a time ({DEFAULT_CHUNKSIZE})")
+    runutils.add_metrics_args(parser)
+    args = parser.parse_args()
+
+    logger = runutils.set_logger(args)
+    runutils.run_start()
+
+    other = {"json": "jsonl", "jsonl": "json"}
+    infmt = args.infmt or file_format(args.infile, None)
+    outfmt = args.outfmt or file_format(args.outfile, None)
+    if infmt is None and outfmt is None:
+        infmt, outfmt = "jsonl", "json"
+    infmt = infmt or other[outfmt]
+    outfmt = outfmt or other[infmt]
+    if infmt not in other or outfmt != other[infmt]:
+        raise Exception(f"Cannot convert from {infmt} to {outfmt}")
+
+    with dataio.open_file(args.infile, "rt") as reader, dataio.atomic_open(args.outfile, "wt") as writer:
+        if infmt == "jsonl":
+            n = jsonl2json(reader, writer, args.chunksize)
+        else:
+            n = json2jsonl(reader, writer, args.chunksize)
+    runutils.count("items", n)
+    logger.info(f"Converted {n} items from {infmt} to {outfmt}")
+    runutils.run_stop()
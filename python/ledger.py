@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+"""
+An append-only ledger of all annotations over all rounds: one JSON record per line with the item id (see
+pipeline.item_id), annotator number, round, label, confidence and the list of annotators the item had been
+assigned to. retrieve-annotated.py --ledger appends the annotations it retrieves, reassign.py and agreement.py
+--ledger look them up by item id instead of re-reading the retrieved files of all earlier rounds.
+Next to the ledger file, an index with the byte offset of the latest record for each item, annotator and round
+is kept (file name with .idx.json added), so lookups do not need to read the ledger. When the ledger is
+opened, only the records appended since the index was saved get read. The index also keeps the offset and checksum of
+the last record it covers, if that record is not in the ledger any more (e.g. the file was replaced), the index is
+made again from the whole ledger. Appending a record which is the same as
+the latest one for the item, annotator and round does nothing, so retrieving the same annotations again does not
+make the ledger grow. A record which was not written completely (e.g. if the program was killed) is removed.
+When run as a program, this shows a summary of a ledger, e.g. `./python/ledger.py label-studio/ledger.jsonl`.
+"""
+
+import os
+import json
+import zlib
+import argparse
+from collections import defaultdict, Counter
+import runutils
+import dataio
+import pipeline
+
+# the index is saved to a file with this added to the ledger file name
+INDEX_EXT = ".idx.json"
+INDEX_VERSION = 2
+
+
+def records_from_items(items, annnr, round):
+    """
+    Make the ledger records for the items retrieved for an annotator.
+    :param items: retrieved items
+    :param annnr: annotator number
+    :param round: round number
+    :return: list of records
+    """
+    return [{"item": pipeline.get_id(item), "ann": annnr, "round": round,
+             "label": item.get(f"ann{annnr:02d}_label", ""), "conf": item.get(f"ann{annnr:02d}_conf", ""),
+             "assigned": item.get("assigned", [])} for item in items]
+
+
+class Ledger:
+    """
+    The ledger file with its index, see the module documentation.
+    """
+    def __init__(self, path):
+        """
+        Open the ledger, it is created if it does not exist yet.
+        :param path: ledger file path
+        """
+        self.path = path
+        # map from item id to map from (annotator, round) to (offset of the record, checksum of the record)
+        self.index = defaultdict(dict)
+        self.size = 0
+        # offset and checksum of the last record indexed
+        self.last = None
+        self.changed = False
+        self.fp = open(path, "a+b")
+        idxfile = path + INDEX_EXT
+        if os.path.exists(idxfile):
+            with open(idxfile, "rt", encoding="utf8") as infp:
+                saved = json.load(infp)
+            last = tuple(saved["last"]) if saved.get("last") is not None else None
+            if saved.get("version") == INDEX_VERSION and self._check(saved["size"], last):
+                for itemid, entries in saved["index"].items():
+                    self.index[itemid] = {tuple(map(int, k.split(":"))): tuple(v) for k, v in entries.items()}
+                self.size = saved["size"]
+                self.last = last
+            else:
+                runutils.ensurelogger().warning(f"Index {idxfile} does not match ledger {path}, indexing it again")
+                self.changed = True
+        self._catch_up()
+
+    def _check(self, size, last):
+        """
+        Check if the index saved for the first size bytes of the file still matches: the last record it covers
+        must still be in the file, ending at size.
+        """
+        if size == 0:
+            return last is None
+        if last is None or size > os.path.getsize(self.path):
+            return False
+        self.fp.seek(last[0])
+        line = self.fp.readline()
+        return last[0] + len(line) == size and zlib.crc32(line) == last[1]
+
+    def _catch_up(self):
+        """
+        Add the records after the part of the file already indexed to the index.
+        """
+        logger = runutils.ensurelogger()
+        self.fp.seek(self.size)
+        n = 0
+        for line in self.fp:
+            if not line.endswith(b"\n"):
+                logger.warning(f"Removing the incomplete last record of ledger {self.path}")
+                self.fp.truncate(self.size)
+                break
+            rec = json.loads(line)
+            self.last = (self.size, zlib.crc32(line))
+            self.index[rec["item"]][(rec["ann"], rec["round"])] = self.last
+            self.size += len(line)
+            n += 1
+        if n > 0:
+            self.changed = True
+            logger.debug(f"Indexed {n} records of ledger {self.path}")
+
+    def __len__(self):
+        """
+        Number of items in the ledger.
+        """
+        return len(self.index)
+
+    def __contains__(self, itemid):
+        return itemid in self.index
+
+    def items(self):
+        """
+        The ids of all items in the ledger.
+        """
+        return self.index.keys()
+
+    def append(self, records):
+        """
+        Append records, except those which are the same as the latest record for the item, annotator and round.
+        :param records: iterable of records, maps with at least "item", "ann" and "round"
+        :return: number of records appended
+        """
+        lines = []
+        for rec in records:
+            line = (json.dumps(rec) + "\n").encode("utf8")
+            crc = zlib.crc32(line)
+            key = (rec["ann"], rec["round"])
+            old = self.index[rec["item"]].get(key)
+            if old is not None and old[1] == crc:
+                continue
+            self.last = (self.size, crc)
+            self.index[rec["item"]][key] = self.last
+            self.size += len(line)
+            lines.append(line)
+        if lines:
+            self.fp.seek(0, os.SEEK_END)
+            self.fp.write(b"".join(lines))
+            self.fp.flush()
+            self.changed = True
+        return len(lines)
+
+    def _read(self, offset):
+        self.fp.seek(offset)
+        return json.loads(self.fp.readline())
+
+    def records(self, itemid, rounds=None):
+        """
+        Get the latest record for each annotator and round of an item.
+        :param itemid: item id
+        :param rounds: if not None, only the records for these rounds
+        :return: list of records, ordered by round and annotator
+        """
+        entries = self.index.get(itemid, {})
+        return [self._read(offset) for key, (offset, _) in sorted(entries.items(), key=lambda e: (e[0][1], e[0][0]))
+                if rounds is None or key[1] in rounds]
+
+    def assigned(self, itemid):
+        """
+        All annotators an item has been assigned to in any round: those with a record for the item and those
+        in the assigned lists of its records.
+        :return: sorted list of annotator numbers
+        """
+        seen = set()
+        for rec in self.records(itemid):
+            seen.add(rec["ann"])
+            seen.update(rec.get("assigned", []))
+        return sorted(seen)
+
+    def labels(self, rounds=None):
+        """
+        Get the labels of all items, as needed by iaa.encode. If an annotator labelled an item in more than one
+        round, the label from the latest of these rounds is used.
+        :param rounds: if not None, only the records for these rounds
+        :return: list of maps from annNN_label to the label, one for each item with at least one record
+        """
+        objs = []
+        for itemid in self.index:
+            obj = {}
+            for rec in self.records(itemid, rounds):
+                obj[f"ann{rec['ann']:02d}_label"] = rec["label"]
+            if obj:
+                objs.append(obj)
+        return objs
+
+    def close(self):
+        """
+        Close the ledger file and save the index if anything changed.
+        """
+        if self.fp is None:
+            return
+        self.fp.close()
+        self.fp = None
+        if self.changed:
+            with dataio.atomic_open(self.path + INDEX_EXT, "wt") as outfp:
+                json.dump({"version": INDEX_VERSION, "size": self.size, "last": self.last,
+                           "index": {itemid: {f"{a}:{r}": list(v) for (a, r), v in entries.items()}
+                                     for itemid, entries in self.index.items()}}, outfp)
+            self.changed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("ledger", help="Ledger file")
+    parser.add_argument("--item", type=str, default=None, help="Show the records of this item id")
+    parser.add_argument("-d", action="store_true", help="Debug")
+    args = parser.parse_args()
+
+    logger = runutils.set_logger(args)
+    with Ledger(args.ledger) as ledger:
+        if args.item is not None:
+            for rec in ledger.records(args.item):
+                print(json.dumps(rec))
+        else:
+            per_round = Counter()
+            for entries in ledger.index.values():
+                for ann, rnd in entries:
+                    per_round[(rnd, ann)] += 1
+            logger.info(f"Items in ledger {args.ledger}: {len(ledger)}")
+            for (rnd, ann), n in sorted(per_round.items()):
+                logger.info(f"Round {rnd}, annotator {ann:02d}: {n} items")
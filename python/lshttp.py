@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+"""
+Pull the tasks with their completions from running label-studio servers over HTTP, from all servers at the same
+time with asyncio. This only uses the python standard library: each server gets a small pool of keep-alive
+connections, every request has a timeout and failed requests (connection problems, timeouts, server errors) are
+retried with an increasing delay. The export is expected to be a JSON list of tasks, a map from task id to task
+(like the tasks.json file of a project) or a zip file containing one of these, each task like a completion file.
+Used by retrieve-annotated.py --http, which converts the tasks in the same way as the completion files.
+When run as a program, this serves the completion files of the project directories created by
+prepare-labelstudio.py for a prefix like running label-studio servers would, project N on port -p + N, e.g.
+`./python/lshttp.py label-studio/project_round1 -p 9000`, which is useful for trying out retrieval.
+"""
+
+import io
+import os
+import json
+import glob
+import time
+import asyncio
+import zipfile
+import argparse
+import threading
+import http.server
+import runutils
+import pipeline
+
+# the path of the export of a label-studio server
+DEFAULT_EXPORT = "/api/project/export?format=JSON"
+
+
+class HttpError(Exception):
+    """
+    The server answered with an error status.
+    """
+    def __init__(self, status, reason):
+        super().__init__(f"HTTP status {status} {reason}")
+        self.status = status
+
+
+class ServerPool:
+    """
+    Keep-alive connections to one server. Connections are created when needed and returned to the pool after
+    a complete response, unless the server wants to close them.
+    """
+    def __init__(self, host, port, size=2):
+        """
+        :param host: host name
+        :param port: port number
+        :param size: maximum number of idle connections kept
+        """
+        self.host = host
+        self.port = port
+        self.size = size
+        self.idle = []
+
+    def __str__(self):
+        return f"{self.host}:{self.port}"
+
+    async def request(self, path):
+        """
+        Send a GET request and read the response.
+        :param path: the path and query of the URL
+        :return: the body of the response as bytes
+        """
+        reused = bool(self.idle)
+        reader, writer = self.idle.pop() if reused else await asyncio.open_connection(self.host, self.port)
+        try:
+            writer.write(f"GET {path} HTTP/1.1\r\nHost: {self.host}:{self.port}\r\nConnection: keep-alive\r\n"
+                         f"Accept-Encoding: identity\r\n\r\n".encode("latin1"))
+            await writer.drain()
+            status, reason, headers, body, keep = await read_response(reader)
+        except (OSError, asyncio.IncompleteReadError):
+            writer.close()
+            if reused:
+                # the server may have closed the idle connection in the meantime, try once with a new one
+                return await self.request(path)
+            raise
+        except BaseException:
+            writer.close()
+            raise
+        if keep and len(self.idle) < self.size:
+            self.idle.append((reader, writer))
+        else:
+            writer.close()
+        if status >= 300:
+            raise HttpError(status, reason)
+        return body
+
+    def close(self):
+        for _, writer in self.idle:
+            writer.close()
+        self.idle = []
+
+
+async def read_response(reader):
+    """
+    Read an HTTP/1.1 response.
+    :param reader: asyncio.StreamReader
+    :return: a tuple (status, reason, map from lower case header name to value, body, flag if the connection
+        can be used again)
+    """
+    line = await reader.readuntil(b"\r\n")
+    parts = line.decode("latin1").rstrip("\r\n").split(" ", 2)
+    if len(parts) < 2 or not parts[0].startswith("HTTP/"):
+        raise Exception(f"Not an HTTP response: {line[:100]!r}")
+    status = int(parts[1])
+    reason = parts[2] if len(parts) > 2 else ""
+    headers = {}
+    while True:
+        line = await reader.readuntil(b"\r\n")
+        if line == b"\r\n":
+            break
+        name, _, value = line.decode("latin1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    keep = parts[0] == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+    if headers.get("transfer-encoding", "").lower() == "chunked":
+        chunks = []
+        while True:
+            size = int((await reader.readuntil(b"\r\n")).split(b";")[0], 16)
+            if size == 0:
+                # skip the trailer
+                while await reader.readuntil(b"\r\n") != b"\r\n":
+                    pass
+                break
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+        body = b"".join(chunks)
+    elif "content-length" in headers:
+        body = await reader.readexactly(int(headers["content-length"]))
+    else:
+        body = await reader.read()
+        keep = False
+    return status, reason, headers, body, keep
+
+
+def parse_export(body):
+    """
+    Get the list of tasks from the body of an export response.
+    :param body: bytes, JSON or a zip file with a JSON file
+    :return: list of tasks, ordered by task id
+    """
+    if body.startswith(b"PK"):
+        with zipfile.ZipFile(io.BytesIO(body)) as zf:
+            names = [n for n in zf.namelist() if n.endswith(".json")]
+            if not names:
+                raise Exception("No JSON file in the exported zip file")
+            body = zf.read(names[0])
+    data = json.loads(body)
+    if isinstance(data, dict):
+        data = list(data.values())
+    if not isinstance(data, list):
+        raise Exception("The export is not a list of tasks")
+    return sorted(data, key=lambda task: task.get("id", 0) if isinstance(task, dict) else 0)
+
+
+async def fetch_export(pool, path, timeout, retries, backoff):
+    """
+    Get the tasks from one server, retrying failed requests.
+    :param pool: ServerPool for the server
+    :param path: the path of the export
+    :param timeout: seconds for each attempt
+    :param retries: number of retries after the first attempt
+    :param backoff: seconds to wait before the first retry, doubled for each further retry
+    :return: list of tasks
+    """
+    logger = runutils.ensurelogger()
+    for attempt in range(retries + 1):
+        try:
+            body = await asyncio.wait_for(pool.request(path), timeout)
+            return parse_export(body)
+        except HttpError as e:
+            # only retry if the server had a problem, not if the request was wrong
+            if e.status < 500 or attempt == retries:
+                raise
+            error = e
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+            if attempt == retries:
+                raise
+            error = e
+        logger.warning(f"Attempt {attempt + 1} for {pool} failed ({type(error).__name__} {error}), "
+                       f"retrying in {backoff * 2 ** attempt}s")
+        await asyncio.sleep(backoff * 2 ** attempt)
+
+
+async def fetch_servers(servers, path, timeout, retries, backoff, connections):
+    """
+    Get the tasks from all servers concurrently, see fetch_all.
+    """
+    pools = {}
+    for _, host, port in servers:
+        if (host, port) not in pools:
+            pools[(host, port)] = ServerPool(host, port, connections)
+
+    async def one(annnr, host, port):
+        start = time.perf_counter()
+        try:
+            tasks = await fetch_export(pools[(host, port)], path, timeout, retries, backoff)
+            return annnr, tasks, None, time.perf_counter() - start
+        except Exception as e:
+            return annnr, None, f"{type(e).__name__} {e}".strip(), time.perf_counter() - start
+
+    try:
+        return await asyncio.gather(*(one(*server) for server in servers))
+    finally:
+        for pool in pools.values():
+            pool.close()
+
+
+def fetch_all(servers, path=DEFAULT_EXPORT, timeout=60.0, retries=3, backoff=1.0, connections=2):
+    """
+    Get the tasks from all servers at the same time.
+    :param servers: list of tuples (annotator number, host, port)
+    :param path: the path of the export
+    :param timeout: seconds for each attempt for a server
+    :param retries: number of retries after the first attempt for a server
+    :param backoff: seconds to wait before the first retry, doubled for each further retry
+    :param connections: maximum number of idle connections kept for a server
+    :return: list of tuples (annotator number, list of tasks or None, None or the error, seconds needed), in the
+        order of the servers
+    """
+    return asyncio.run(fetch_servers(servers, path, timeout, retries, backoff, connections))
+
+
+def url(host, port, path=DEFAULT_EXPORT):
+    return f"http://{host}:{port}{path}"
+
+
+def parse_server(spec, port=None):
+    """
+    Parse a server given as HOST:PORT, or just HOST if the port is known.
+    :return: a tuple (host, port)
+    """
+    host, sep, p = spec.rpartition(":")
+    if not sep:
+        if port is None:
+            raise Exception(f"Not a valid server, expected HOST:PORT: {spec}")
+        return spec, port
+    return host, int(p)
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Answer every GET request with all completion files of the project directory of the server as a JSON list,
+    files which are not valid JSON are left out.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        tasks = []
+        for file in glob.glob(os.path.join(self.server.projdir, "completions", "*.json")):
+            try:
+                with open(file, "rt", encoding="utf8") as infp:
+                    tasks.append(json.load(infp))
+            except ValueError as e:
+                runutils.ensurelogger().warning(f"Not serving file {file} because of {e}")
+        body = json.dumps(tasks).encode("utf8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        runutils.ensurelogger().debug(f"{self.server.projdir}: {format % args}")
+
+
+def serve_stub(projpref, port, host="localhost"):
+    """
+    Serve the projects with the prefix, project N on port + N, until interrupted.
+    """
+    logger = runutils.ensurelogger()
+    servers = []
+    for annnr, d in pipeline.find_projects(projpref):
+        server = http.server.ThreadingHTTPServer((host, port + annnr), StubHandler)
+        server.projdir = d
+        servers.append(server)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        logger.info(f"Serving {d} on {url(host, port + annnr, '/')}")
+    if not servers:
+        raise Exception(f"No projects found for prefix {projpref}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+    for server in servers:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("projpref", help="Project directory prefix, e.g. label-studio/project_round1")
+    parser.add_argument("-p", type=int, default=9000, help="Port number for project 0, project N gets port + N (9000)")
+    parser.add_argument("--host", type=str, default="localhost", help="Host name or address to listen on (localhost)")
+    parser.add_argument("-d", action="store_true", help="Debug")
+    args = parser.parse_args()
+
+    logger = runutils.set_logger(args)
+    serve_stub(args.projpref, args.p, args.host)
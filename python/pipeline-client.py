@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+"""
+Program to send a command to pipeline-daemon.py and print the reply. This only uses the python standard library,
+so it starts quickly, the work is all done by the daemon.
+e.g. `./python/pipeline-client.py reassign --infiles retrieved_ann00.json retrieved_ann01.json --annotators 0 1 --outpref reassigned`
+The result of the command is printed as JSON, use `./python/pipeline-client.py COMMAND --help` for the options of
+a command and `./python/pipeline-client.py status` to see what the daemon keeps in memory.
+"""
+
+import os
+import sys
+import json
+import socket
+import argparse
+
+DEFAULT_SOCKET = "pipeline-daemon.sock"
+
+
+def request(argv, sockpath=DEFAULT_SOCKET):
+    """
+    Send a command to the daemon and wait for the reply.
+    :param argv: list with the command and its options
+    :param sockpath: the daemon's socket
+    :return: the reply map
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(sockpath)
+        sock.sendall(json.dumps({"argv": argv, "cwd": os.getcwd()}).encode("utf8") + b"\n")
+        with sock.makefile("rb") as infp:
+            return json.loads(infp.readline())
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--socket", type=str, default=DEFAULT_SOCKET,
+                        help=f"Unix socket the daemon listens on ({DEFAULT_SOCKET})")
+    parser.add_argument("command", help="Command: split, assign, retrieve, reassign, agree, status, clear or stop")
+    parser.add_argument("options", nargs=argparse.REMAINDER, help="Options for the command")
+    args = parser.parse_args()
+
+    reply = request([args.command] + args.options, args.socket)
+    if reply.get("output"):
+        print(reply["output"], end="", file=sys.stdout if reply["ok"] else sys.stderr)
+    if "error" in reply:
+        print(f"ERROR: {reply['error']}", file=sys.stderr)
+    if "result" in reply and reply["result"] is not None:
+        print(json.dumps(reply["result"], indent=2))
+    if "seconds" in reply:
+        print(f"Done in {reply['seconds']:.3f}s", file=sys.stderr)
+    sys.exit(0 if reply["ok"] else 1)
@@ -0,0 +1,402 @@
+#!/usr/bin/env python
+"""
+Program to keep the data of an annotation round in memory and run the steps of the pipeline on request, so that
+repeated operations do not have to start python, import everything and re-parse the same files every time.
+The daemon listens on a Unix socket, pipeline-client.py sends it a command with the options for it and prints the
+reply. Commands (use e.g. `pipeline-client.py split --help` for the options of a command):
+* split: split an input file into sets and give sets to annotators, like pipeline.py
+* assign: give sets created by prepare-split-data.py to annotators, like prepare-assign-data.py, from the set manifest
+* retrieve: get the annotated items from all label-studio projects with a prefix, like retrieve-annotated.py --batch
+* reassign: assign retrieved items to new annotators, like reassign.py
+* agree: calculate the agreement statistics, like agreement.py
+* status: show what is kept in memory
+* clear: forget everything kept in memory
+* stop: stop the daemon
+Input files are parsed once and kept until they change on disk (modification time or size), for the input of split
+the checked and converted items are kept, for assign the set manifest. For label-studio projects, only the completion files which changed since
+the last request are read again. Commands are run one at a time, relative paths are relative to the directory the
+client was run in.
+"""
+
+import os
+import io
+import json
+import time
+import socket
+import argparse
+import threading
+import contextlib
+import socketserver
+import runutils
+import dataio
+import colstore
+import pipeline
+import iaa
+
+DEFAULT_SOCKET = "pipeline-daemon.sock"
+
+
+def stamp(path):
+    """
+    What we compare to find out if a file has changed: modification time and size.
+    """
+    st = os.stat(path)
+    return st.st_mtime_ns, st.st_size
+
+
+class Cache:
+    """
+    Parsed files and retrieved projects, each kept until it changes on disk.
+    """
+    def __init__(self):
+        # (kind, absolute path) -> (stamp, value)
+        self.files = {}
+        # (absolute project directory, annotator number) -> map completion file -> (stamp, item or None)
+        self.projects = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path, kind, loader):
+        """
+        Get the value loaded from the file, load it if it is not known yet or the file has changed.
+        :param path: file path
+        :param kind: what the loader makes of the file, the same file can be kept for several kinds
+        :param loader: function to call with the absolute path to get the value
+        :return: the value
+        """
+        path = os.path.abspath(path)
+        current = stamp(path)
+        entry = self.files.get((kind, path))
+        if entry is not None and entry[0] == current:
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        with runutils.stage("load"):
+            value = loader(path)
+        self.files[(kind, path)] = (current, value)
+        return value
+
+    def items(self, path):
+        """
+        Get the list of items from a JSON file or columnar store.
+        """
+        return self.get(path, "items", dataio.load_items)
+
+    def labels(self, path):
+        """
+        Get the list of items from a JSON file or columnar store, with only the annNN_label fields.
+        """
+        return self.get(path, "labels", lambda p: dataio.load_fields(p, iaa.is_label_key))
+
+    def manifest(self, pref):
+        """
+        Get the set manifest written by prepare-split-data.py for the prefix, see dataio.load_sets_manifest.
+        """
+        mfile = pref + dataio.SETS_MANIFEST
+        if not os.path.exists(mfile):
+            raise Exception(f"No set manifest {mfile}")
+        return self.get(mfile, "manifest", lambda p: dataio.load_sets_manifest(p[:-len(dataio.SETS_MANIFEST)]))
+
+    def prepared(self, path, fmt="json"):
+        """
+        Get the checked and converted items from an input file, see pipeline.prepare_items.
+        """
+        return self.get(path, "prepared-" + fmt, lambda p: pipeline.prepare_items(dataio.iter_items(p, fmt)))
+
+    def retrieve(self, projdir, annnr):
+        """
+        Get the annotated items of a label-studio project like pipeline.retrieve, but only read the completion
+        files which are new or have changed.
+        :return: a tuple (list of items, number of files read)
+        """
+        key = (os.path.abspath(projdir), annnr)
+        old = self.projects.get(key, {})
+        new = {}
+        n_read = 0
+        compldir = os.path.join(key[0], "completions")
+        for entry in sorted(os.scandir(compldir), key=lambda e: e.name):
+            if not entry.name.endswith(".json"):
+                continue
+            st = entry.stat()
+            current = (st.st_mtime_ns, st.st_size)
+            cached = old.get(entry.path)
+            if cached is None or cached[0] != current:
+                cached = (current, pipeline.retrieve_file(entry.path, annnr))
+                n_read += 1
+            new[entry.path] = cached
+        self.projects[key] = new
+        return [item for _, item in new.values() if item is not None], n_read
+
+    def clear(self):
+        self.files = {}
+        self.projects = {}
+
+    def status(self):
+        return {
+            "files": [{"kind": kind, "path": path, "items": len(value["sets"] if kind == "manifest" else value)}
+                      for (kind, path), (_, value) in self.files.items()],
+            "projects": [{"dir": d, "annnr": annnr, "files": len(files)}
+                         for (d, annnr), files in self.projects.items()],
+            "hits": self.hits, "misses": self.misses}
+
+
+def parser_split():
+    parser = argparse.ArgumentParser(prog="pipeline-client.py split")
+    parser.add_argument("infile", help="Input JSON/JSONL file")
+    parser.add_argument("outpref", help="Output file prefix for the annotator files, e.g. label-studio/data")
+    parser.add_argument("-k", type=int, required=True, help="Number of annotators, each gets one set")
+    parser.add_argument("--fmt", type=str, default="json", help="Input format (json, jsonl), default is json")
+    parser.add_argument("-s", type=int, default=25, help="Size (number of items) of each set (25)")
+    parser.add_argument("--skip", type=int, default=0, help="Number of items to skip after shuffling")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed (default: 42)")
+    parser.add_argument("--fromannnr", type=int, default=0, help="Number of first annotator to assign to (0)")
+    parser.add_argument("--setspref", type=str, default=None,
+                        help="If specified, also save all sets and the remaining items with this prefix")
+    return parser
+
+
+def cmd_split(cache, args):
+    items = cache.prepared(args.infile, args.fmt)
+    sets, remaining = pipeline.split_prepared(items, size=args.s, skip=args.skip, seed=args.seed)
+    if len(sets) < args.k:
+        raise Exception(f"Only got {len(sets)} sets for {args.k} annotators")
+    annotators = list(range(args.fromannnr, args.fromannnr + args.k))
+    perann = pipeline.assign(sets[:args.k], annotators)
+    files = pipeline.save_assigned(perann, args.outpref, sets, remaining, args.setspref)
+    return {"sets": len(sets), "remaining": len(remaining), "files": files}
+
+
+def parser_assign():
+    parser = argparse.ArgumentParser(prog="pipeline-client.py assign")
+    parser.add_argument("inpref", help="Input file name prefix, same as output prefix of prepare-split-data")
+    parser.add_argument("outpref", help="Output file prefix")
+    parser.add_argument("fromsetnr", type=int, help="Number of first set to take")
+    parser.add_argument("n", type=int, help="Number of sets to take")
+    parser.add_argument("--fromannnr", type=int, default=0, help="Number of first annotator to assign to (0)")
+    parser.add_argument("--lazy", action="store_true",
+                        help="Only record the assignments, the files are created by prepare-labelstudio.py")
+    return parser
+
+
+def cmd_assign(cache, args):
+    manifest = cache.manifest(args.inpref)
+    recordfile = args.outpref + dataio.ASSIGNMENTS
+    if os.path.exists(recordfile):
+        with open(recordfile, "rt", encoding="utf8") as infp:
+            record = json.load(infp)
+    else:
+        record = {}
+    tasks = []
+    for i, setnr in enumerate(range(args.fromsetnr, args.fromsetnr + args.n)):
+        annnr = i + args.fromannnr
+        entry = manifest["sets"].get(f"{setnr:03d}")
+        if entry is None:
+            raise Exception(f"Set {setnr} is not in the set manifest")
+        # the manifest is cached with absolute paths, the record gets them relative to the client's directory
+        setfile = os.path.relpath(entry["file"])
+        ext = colstore.STORE_EXT if colstore.is_store(setfile) else ".json"
+        outfile = args.outpref + f"_set{setnr:03d}_ann{annnr:02d}" + ext
+        record[f"{annnr:02d}"] = {"set": setnr, "setfile": setfile, "file": outfile,
+                                  "ids": entry["ids"], "offsets": entry["offsets"]}
+        tasks.append((setfile, entry["offsets"], annnr, outfile))
+    with dataio.atomic_open(recordfile, "wt") as outfp:
+        json.dump(record, outfp)
+    if not args.lazy:
+        with runutils.stage("write"):
+            for task in tasks:
+                dataio.copy_set_assigned(*task)
+    return {"record": recordfile, "files": {} if args.lazy else {outfile: annnr for _, _, annnr, outfile in tasks}}
+
+
+def parser_retrieve():
+    parser = argparse.ArgumentParser(prog="pipeline-client.py retrieve")
+    parser.add_argument("indir", help="Project directory prefix, all projects indir_N are retrieved")
+    parser.add_argument("outfile", help="Output file prefix, annotator N is saved to outfile_annNN.json")
+    parser.add_argument("--combined", type=str, default=None,
+                        help="Also save all retrieved items from all projects to this file")
+    return parser
+
+
+def cmd_retrieve(cache, args):
+    projects = pipeline.find_projects(args.indir)
+    if len(projects) == 0:
+        raise Exception(f"No projects found for prefix {args.indir}")
+    combined = []
+    result = {"projects": {}}
+    for annnr, d in projects:
+        data, n_read = cache.retrieve(d, annnr)
+        outfile = args.outfile + f"_ann{annnr:02d}.json"
+        dataio.save_items(outfile, data)
+        combined.extend(data)
+        result["projects"][d] = {"annnr": annnr, "items": len(data), "files_read": n_read, "file": outfile}
+    if args.combined is not None:
+        dataio.save_items(args.combined, combined)
+    result["items"] = len(combined)
+    return result
+
+
+def parser_reassign():
+    parser = argparse.ArgumentParser(prog="pipeline-client.py reassign")
+    parser.add_argument("--infiles", nargs="+", required=True, help="One or more files retrieved from their projects")
+    parser.add_argument("--outpref", required=True, help="Output file prefix")
+    parser.add_argument("--annotators", nargs="+", type=int, required=True, help="List of annotator ids to assign to")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed (default: 42)")
+    parser.add_argument("--redundancy", type=int, default=None,
+                        help="Give each item to exactly this many annotators, with balanced numbers of items per annotator")
+    parser.add_argument("--capacity", type=int, default=None,
+                        help="With --redundancy, maximum number of items per annotator")
+    return parser
+
+
+def cmd_reassign(cache, args):
+    items = [item for infile in args.infiles for item in cache.items(infile)]
+    perann = pipeline.reassign(items, args.annotators, seed=args.seed,
+                               redundancy=args.redundancy, capacity=args.capacity)
+    result = {}
+    for annid, annitems in perann.items():
+        filename = args.outpref + f"_ann{annid:02d}.json"
+        dataio.save_items(filename, annitems)
+        result[filename] = len(annitems)
+    return result
+
+
+def parser_agree():
+    parser = argparse.ArgumentParser(prog="pipeline-client.py agree")
+    parser.add_argument("--infiles", nargs="+", required=True, help="One or more files retrieved from their projects")
+    parser.add_argument("--outstats", type=str, default=None,
+                        help="If specified, also save all agreement statistics to this JSON file")
+    parser.add_argument("--bootstrap", type=int, default=0,
+                        help="Number of bootstrap resamples for confidence intervals, 0 for none (0)")
+    parser.add_argument("--level", type=float, default=0.95, help="Confidence level for the intervals (0.95)")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed for bootstrapping (default: 42)")
+    return parser
+
+
+def cmd_agree(cache, args):
+    items = [item for infile in args.infiles for item in cache.labels(infile)]
+    stats = iaa.stats2json(pipeline.agree(items, nboot=args.bootstrap, seed=args.seed, level=args.level))
+    if args.outstats:
+        with dataio.atomic_open(args.outstats, "wt") as outfp:
+            json.dump(stats, outfp)
+    return stats
+
+
+def parser_noopts(name):
+    return lambda: argparse.ArgumentParser(prog=f"pipeline-client.py {name}")
+
+
+COMMANDS = {
+    "split": (parser_split, cmd_split),
+    "assign": (parser_assign, cmd_assign),
+    "retrieve": (parser_retrieve, cmd_retrieve),
+    "reassign": (parser_reassign, cmd_reassign),
+    "agree": (parser_agree, cmd_agree),
+    "status": (parser_noopts("status"), None),
+    "clear": (parser_noopts("clear"), None),
+    "stop": (parser_noopts("stop"), None),
+}
+
+
+class Daemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Server which answers one request per connection: a JSON line {"argv": [command, options...], "cwd": dir}, the
+    reply is a JSON line {"ok": true/false, "result": ..., "output": text from parsing the options, "error": ...,
+    "seconds": time needed}.
+    """
+    daemon_threads = True
+
+    def __init__(self, sockpath):
+        super().__init__(sockpath, Handler)
+        self.cache = Cache()
+        self.lock = threading.Lock()
+        self.started = time.time()
+
+    def run(self, argv, cwd):
+        logger = runutils.ensurelogger()
+        if len(argv) == 0 or argv[0] not in COMMANDS:
+            return {"ok": False, "error": f"Unknown command, use one of {', '.join(COMMANDS)}"}
+        name = argv[0]
+        makeparser, func = COMMANDS[name]
+        out = io.StringIO()
+        with self.lock:
+            try:
+                with contextlib.redirect_stdout(out), contextlib.redirect_stderr(out):
+                    args = makeparser().parse_args(argv[1:])
+            except SystemExit as e:
+                # --help or invalid options
+                return {"ok": e.code == 0, "output": out.getvalue()}
+            os.chdir(cwd)
+            start = time.time()
+            try:
+                with runutils.stage(name):
+                    if name == "status":
+                        result = dict(self.cache.status(), pid=os.getpid(), uptime=time.time() - self.started,
+                                      peak_rss=runutils.peak_rss())
+                    elif name == "clear":
+                        self.cache.clear()
+                        result = None
+                    elif name == "stop":
+                        # shutdown waits for serve_forever to return, so it cannot be called in this thread
+                        threading.Thread(target=self.shutdown).start()
+                        result = None
+                    else:
+                        result = func(self.cache, args)
+            except Exception as e:
+                logger.exception(f"Command {argv} failed")
+                return {"ok": False, "error": f"{type(e).__name__}: {e}"}
+            seconds = time.time() - start
+        runutils.count("requests", 1)
+        logger.info(f"Command {argv} done in {seconds:.3f}s")
+        return {"ok": True, "result": result, "seconds": seconds}
+
+
+class Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        req = json.loads(line)
+        reply = self.server.run(req.get("argv", []), req.get("cwd", os.getcwd()))
+        self.wfile.write(json.dumps(reply).encode("utf8") + b"\n")
+
+
+def remove_stale(sockpath):
+    """
+    Remove the socket file left behind by a daemon which is not running any more, fail if one is still running.
+    """
+    if not os.path.exists(sockpath):
+        return
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(sockpath)
+        except (ConnectionRefusedError, FileNotFoundError):
+            os.unlink(sockpath)
+            return
+    raise Exception(f"A daemon is already listening on {sockpath}")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--socket", type=str, default=DEFAULT_SOCKET,
+                        help=f"Unix socket to listen on ({DEFAULT_SOCKET})")
+    parser.add_argument("-d", action="store_true", help="Debug")
+    runutils.add_metrics_args(parser)
+    args = parser.parse_args()
+
+    logger = runutils.set_logger(args)
+    runutils.run_start()
+
+    sockpath = os.path.abspath(args.socket)
+    remove_stale(sockpath)
+    server = Daemon(sockpath)
+    logger.info(f"Listening on {sockpath}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(sockpath)
+    logger.info("Stopped")
+    runutils.run_stop()
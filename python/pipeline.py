@@ -0,0 +1,820 @@
+#!/usr/bin/env python
+"""
+The steps of preparing and evaluating an annotation round as functions which work on lists of items in memory,
+so they can be imported and chained without writing and re-reading JSON files between the steps:
+* split: check, convert and shuffle the input items and split them into sets (see prepare-split-data.py)
+* assign: give sets to annotators (see prepare-assign-data.py)
+* render: convert items to the tasks label-studio stores for a project (see prepare-labelstudio.py)
+* retrieve: get the annotated items from a label-studio project directory (see retrieve-annotated.py)
+* reassign: assign annotated items to new annotators (see reassign.py)
+* agree: calculate the agreement statistics (see agreement.py)
+The programs use these functions, so the results are the same as when running the programs one after the other.
+When run as a program, this chains split and assign in memory and only writes the files for the annotators
+(and optionally the sets, for assigning them in later rounds).
+"""
+import os
+import json
+import glob
+import random
+import hashlib
+import argparse
+import collections
+import datetime
+import regex
+import numpy as np
+import runutils
+import dataio
+import colstore
+import iaa
+
+REQ_FIELDS = ["Claim", "Explaination", "Link", "Source", "Source_Lang", "Date", "Country", "Factcheck_Org", "Label"]
+TEMPLATE = """
+  <div><font size="+2"><b>Claim:</b>{0}</font></div>
+  <p>
+  <b>Explanation:</b>{1}
+  <p>
+  <a href="{2}" target="_blank">{2}</a> 
+"""
+
+PAT_WS = regex.compile(r"\s\s+")
+# the file in a label-studio project directory which contains all the tasks
+TASKS_FILE = "tasks.json"
+# the fields which identify an item, see item_id
+ID_FIELDS = ["Claim", "Link", "Date", "Factcheck_Org", "Country"]
+
+
+def check(indata, n):
+    """
+    Check if the item is useful/valid.
+    :param indata: the item object
+    :return: the item or None if not valid
+    """
+    logger = runutils.ensurelogger()
+    have_error = False
+    if 'Source_Lang_New' in indata:
+        indata['Source_Lang'] = indata['Source_Lang_New']
+    for k in REQ_FIELDS:
+        val = indata.get(k)
+        if not val:
+            logger.warning(f"Input object {n}: field {k} is missing or empty, item skipped")
+            have_error = True
+    if have_error:
+        return None
+    else:
+        return indata
+
+
+def input2obj(indata, n):
+    """
+    Convert a single object from the input to what we need.
+    NOTE: at this point we already expect the item to be valid!
+    NOTE: if this encounters an error it should return None to indicate that the item should get skipped
+    :param indata: a single item as read from the input
+    :return: converted item
+    """
+    # for now we keep all the original data and just add an additional field "html" with the data we need to present
+    claim = PAT_WS.sub(" ", indata["Claim"])
+    expl = PAT_WS.sub(" ", indata["Explaination"])
+    src = indata["Source"]
+    html = TEMPLATE.format(claim, expl, src)
+    indata["html"] = html
+    return indata
+
+
+def prepare_item(obj, idx, lang="en"):
+    """
+    Check and convert an input item and add the field "item_id" (see item_id) and the (empty) field "assigned".
+    :param obj: input item, this gets changed
+    :param idx: index of the item in the input, for log messages
+    :param lang: the language to keep, None to keep all languages
+    :return: a tuple (the item or None if it has to be skipped, flag if it was skipped because of the language)
+    """
+    obj = check(obj, idx)
+    if not obj:
+        return None, False
+    # check if we got the correct language
+    if lang is not None and obj["Source_Lang"] != lang:
+        return None, True
+    obj = input2obj(obj, idx)
+    if not obj:
+        return None, False
+    # the stable id of the item, then the assignment index as the last field
+    obj["item_id"] = item_id(obj)
+    obj["assigned"] = []
+    return obj, False
+
+
+def item_id(obj):
+    """
+    Get a stable id for an item from the content of the fields which identify it (ID_FIELDS), so the same item
+    gets the same id in every run and in every version of the input.
+    :return: hex string
+    """
+    h = hashlib.blake2b(digest_size=12)
+    for field in ID_FIELDS:
+        h.update(str(obj.get(field, "")).encode("utf8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def get_id(item):
+    """
+    Get the id of an item: the field "item_id" added when the item was prepared or, for items prepared before
+    there were ids, the same id computed from the content.
+    """
+    return item.get("item_id") or item_id(item)
+
+
+def rank_key(itemid, seed=42):
+    """
+    The position of an item in the keyed hash order: sorting items by this key gives a random order which only
+    depends on the seed and the item ids, not on the order or number of the items.
+    :param itemid: the item id, see item_id
+    :param seed: the random seed, used as the key of the hash
+    :return: 16 character hex string
+    """
+    return hashlib.blake2b(itemid.encode("utf8"), digest_size=8, key=str(seed).encode("utf8")).hexdigest()
+
+
+def shuffled(items, seed=42):
+    """
+    Shuffle the items in place like prepare-split-data.py does.
+    :return: the items
+    """
+    random.seed(seed)
+    random.shuffle(items)
+    return items
+
+
+def prepare_items(objs):
+    """
+    Check and convert the input items, like prepare-split-data.py.
+    :param objs: iterable of input items, these get changed
+    :return: list of the items which are kept, in input order
+    """
+    items = []
+    for idx, obj in enumerate(objs):
+        obj, _ = prepare_item(obj, idx)
+        if obj:
+            items.append(obj)
+    return items
+
+
+def split(objs, size=25, n=None, skip=0, seed=42):
+    """
+    Check, convert and shuffle the input items and split them into sets, like prepare-split-data.py.
+    :param objs: iterable of input items, these get changed
+    :param size: number of items per set
+    :param n: number of sets or None for as many as possible
+    :param skip: number of items to skip after shuffling
+    :param seed: random seed
+    :return: a tuple (list of sets, each a list of items, list of remaining items)
+    """
+    return split_prepared(prepare_items(objs), size=size, n=n, skip=skip, seed=seed)
+
+
+def split_prepared(items, size=25, n=None, skip=0, seed=42):
+    """
+    Shuffle items which have already been checked and converted (see prepare_items) and split them into sets.
+    The list of items itself is not changed, so it can be split again, e.g. with a different seed.
+    :return: a tuple (list of sets, each a list of items, list of remaining items)
+    """
+    items = shuffled(list(items), seed)
+    n_considered = len(items) - skip
+    if n_considered < size:
+        raise Exception(f"Got only {n_considered} items, cannot make at least one set of size {size}")
+    if n is None:
+        n = n_considered // size
+    elif n * size > n_considered:
+        raise Exception(f"Requested {n} sets, but only got {n_considered} items")
+    sets = [items[skip + i * size:skip + (i + 1) * size] for i in range(n)]
+    return sets, items[skip + n * size:]
+
+
+def assign(sets, annotators):
+    """
+    Give each set to an annotator, like prepare-assign-data.py: the annotator is added to the "assigned" list
+    of copies of the items.
+    :param sets: list of sets of items
+    :param annotators: list of annotator numbers, one for each set
+    :return: map from annotator number to the list of items for that annotator
+    """
+    if len(sets) != len(annotators):
+        raise Exception(f"Got {len(sets)} sets but {len(annotators)} annotators")
+    return {annnr: [dict(item, assigned=item["assigned"] + [annnr]) for item in items]
+            for items, annnr in zip(sets, annotators)}
+
+
+def save_assigned(perann, outpref, sets=None, remaining=None, setspref=None):
+    """
+    Save the items assigned to each annotator to the files prepare-assign-data.py would create and the record
+    of which set went to which annotator. If setspref is given, also save the sets and remaining items.
+    :param perann: map from annotator number to the list of items, in the order of the sets (see assign)
+    :param outpref: output file prefix for the annotator files
+    :param sets: list of all sets, only needed with setspref
+    :param remaining: list of the remaining items, only needed with setspref
+    :param setspref: if not None, prefix for saving the sets and remaining items as prepare-split-data.py would
+    :return: list of the annotator files
+    """
+    logger = runutils.ensurelogger()
+    record = {}
+    for setnr, (annnr, items) in enumerate(perann.items()):
+        outfile = outpref + f"_set{setnr:03d}_ann{annnr:02d}.json"
+        dataio.save_items(outfile, items)
+        record[f"{annnr:02d}"] = {"set": setnr, "setfile": None, "file": outfile, "ids": None, "offsets": None}
+        logger.info(f"Set {setnr} assigned to annotator {annnr} and saved to {outfile}")
+    with dataio.atomic_open(outpref + dataio.ASSIGNMENTS, "wt") as outfp:
+        json.dump(record, outfp)
+    if setspref:
+        for setnr, items in enumerate(sets):
+            dataio.save_items(setspref + f"_set{setnr:03d}.json", items)
+        dataio.save_items(setspref + "_remaining.json", remaining)
+        logger.info(f"Saved {len(sets)} sets and the remaining items with prefix {setspref}")
+    return [entry["file"] for entry in record.values()]
+
+
+def render(items):
+    """
+    Convert a list of items to the tasks as stored by label-studio in the tasks.json file of a project.
+    """
+    return {str(i): {"id": i, "data": item} for i, item in enumerate(items)}
+
+
+def get_result_value(result):
+    """
+    Retrieve the result value from a result object, but make sure we either return the only value set
+    or an empty string if the object is not what we expect.
+    :param result:
+    :return:
+    """
+    value = result.get("value")
+    if value is None:
+        return ""
+    choices = value.get("choices")
+    if choices is None:
+        return ""
+    if len(choices) == 0:
+        return ""
+    return choices[0]
+
+
+def timestamp(value):
+    """
+    Convert the created_at value of a label-studio completion, seconds since the epoch or an ISO 8601 string,
+    to seconds since the epoch.
+    :return: the seconds as a float or "" if the value is missing or not understood
+    """
+    if isinstance(value, bool):
+        return ""
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str) and value:
+        try:
+            dt = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+        except ValueError:
+            return ""
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=datetime.timezone.utc)
+        return dt.timestamp()
+    return ""
+
+
+def convert(item, annnr, file):
+    """
+    Convert a label-studio completion to the item with the fields annNN_label, annNN_conf and annNN_remarks added,
+    and the fields annNN_created (time the completion was created, in seconds since the epoch) and annNN_leadtime
+    (seconds spent on the item), empty if the completion does not have them.
+    """
+    logger = runutils.ensurelogger()
+    newitem = {}
+    newitem.update(item["data"])
+    # make sure the fields for the annotator are not already there
+    if newitem.get(f"ann{annnr:02d}_label") is not None:
+        logger.error("Annotation from annotator {annnr} for label already present!")
+        raise Exception("ERROR")
+    if newitem.get(f"ann{annnr:02d}_conf") is not None:
+        logger.error("Annotation from annotator {annnr} for conf already present!")
+        raise Exception("ERROR")
+    if newitem.get(f"ann{annnr:02d}_remarks") is not None:
+        logger.error("Annotation from annotator {annnr} for remarks already present!")
+        raise Exception("ERROR")
+    newitem[f"ann{annnr:02d}_label"] = ""
+    newitem[f"ann{annnr:02d}_conf"] = ""
+    newitem[f"ann{annnr:02d}_remarks"] = ""
+    newitem[f"ann{annnr:02d}_created"] = ""
+    newitem[f"ann{annnr:02d}_leadtime"] = ""
+    compls = item.get("completions")
+    if compls is None or len(compls) == 0:
+        logger.info(f"No completions in file {file}, setting everything to missing")
+        return newitem
+    elif len(compls) > 1:
+        logger.info(f"More than one completion in file {file} ({len(compls)}), using first")
+    compl = compls[0]
+    newitem[f"ann{annnr:02d}_created"] = timestamp(compl.get("created_at"))
+    leadtime = compl.get("lead_time")
+    if isinstance(leadtime, (int, float)) and not isinstance(leadtime, bool):
+        newitem[f"ann{annnr:02d}_leadtime"] = float(leadtime)
+    # now get the actual annotation data:
+    results = compl.get("result")
+    if results is None or len(results) == 0:
+        logger.info(f"No result in file {file}, setting everything to missing")
+        return newitem
+    # process the results
+    for result in results:
+        name = result.get("from_name")
+        if name == "label":
+            newitem[f"ann{annnr:02d}_label"] = get_result_value(result)
+        if name == "rating":
+            newitem[f"ann{annnr:02d}_conf"] = get_result_value(result)
+        if name == "remark":
+            newitem[f"ann{annnr:02d}_remarks"] = "|".join(result["value"]["text"])
+    return newitem
+
+
+def retrieve(projdir, annnr):
+    """
+    Get the annotated items from the completion files of a label-studio project, like retrieve-annotated.py
+    (but without re-using anything from earlier runs). Completion files which cannot be converted are ignored.
+    :param projdir: project directory
+    :param annnr: annotator number
+    :return: list of items
+    """
+    data = []
+    for file in sorted(glob.glob(os.path.join(projdir, "completions", "*.json"))):
+        item = retrieve_file(file, annnr)
+        if item is not None:
+            data.append(item)
+    return data
+
+
+def retrieve_file(file, annnr):
+    """
+    Read and convert a single completion file, see convert.
+    :return: the item or None if the file cannot be converted
+    """
+    logger = runutils.ensurelogger()
+    try:
+        with open(file, "rt", encoding="utf8") as infp:
+            return convert(json.load(infp), annnr, file)
+    except Exception as e:
+        logger.warning(f"Ignoring file {file} because of {e}")
+        return None
+
+
+def find_projects(pref):
+    """
+    Find all project directories created by prepare-labelstudio.py with the given prefix and get the
+    annotator number from the directory name.
+    :param pref: the project directory prefix
+    :return: sorted list of tuples (annotator number, directory)
+    """
+    pat = regex.compile(regex.escape(pref) + r"_([0-9]+)")
+    projects = []
+    for d in glob.glob(pref + "_*"):
+        m = pat.fullmatch(d)
+        if m and os.path.isdir(d):
+            projects.append((int(m.group(1)), d))
+    return sorted(projects)
+
+
+def count_tasks(projdir):
+    """
+    Get the number of tasks in a label-studio project.
+    :return: the number of tasks or None if the project has no tasks file
+    """
+    tfile = os.path.join(projdir, TASKS_FILE)
+    if not os.path.exists(tfile):
+        return None
+    with open(tfile, "rt", encoding="utf8") as infp:
+        return len(json.load(infp))
+
+
+def throughput(items, annnr, ntasks=None, idle=1800.0, now=None):
+    """
+    Throughput and latency of an annotator from the fields annNN_created and annNN_leadtime of the retrieved items.
+    Gaps of more than idle seconds between two completions count as idle time, the time before the first
+    completion after such a gap is taken to be the lead time of that completion. The rate (items per hour) is
+    the number of completions per hour of active (not idle) time.
+    :param items: retrieved items
+    :param annnr: annotator number
+    :param ntasks: number of tasks in the project, for the projected time needed for the rest, or None
+    :param idle: minimum gap in seconds that counts as idle time
+    :param now: time in seconds since the epoch from which to project the completion, default: the last completion
+    :return: map with the statistics, times as seconds since the epoch, durations in hours
+    """
+    fcreated, fleadtime = f"ann{annnr:02d}_created", f"ann{annnr:02d}_leadtime"
+    # (created, lead time or 0) of all completions with a time, in the order they were created
+    timed = sorted((item[fcreated], item.get(fleadtime) or 0.0) for item in items if item.get(fcreated, "") != "")
+    created = np.asarray([c for c, _ in timed], dtype=np.float64)
+    leads = np.asarray([item[fleadtime] for item in items if item.get(fleadtime, "") != ""], dtype=np.float64)
+    ret = {"annnr": annnr, "items": len(items), "completed": len(created), "tasks": ntasks,
+           "first": None, "last": None, "active_hours": 0.0, "items_per_hour": None,
+           "leadtime": None, "idle_gaps": 0, "idle_hours": 0.0, "longest_gap_hours": 0.0,
+           "remaining": None, "projected_hours": None, "projected_finish": None}
+    if ntasks is not None:
+        ret["remaining"] = max(ntasks - len(created), 0)
+    if len(leads) > 0:
+        p50, p90, p99 = np.percentile(leads, [50, 90, 99]).tolist()
+        ret["leadtime"] = {"mean": float(leads.mean()), "p50": p50, "p90": p90, "p99": p99, "max": float(leads.max())}
+    if len(created) == 0:
+        return ret
+    gaps = np.diff(created)
+    isidle = gaps > idle
+    # each session starts with the first completion or a completion after an idle gap
+    isstart = np.concatenate([[True], isidle])
+    active = float(gaps[~isidle].sum()) + float(np.asarray([lt for _, lt in timed])[isstart].sum())
+    ret["first"] = float(created[0])
+    ret["last"] = float(created[-1])
+    ret["active_hours"] = active / 3600
+    ret["idle_gaps"] = int(isidle.sum())
+    ret["idle_hours"] = float(gaps[isidle].sum()) / 3600
+    ret["longest_gap_hours"] = float(gaps.max()) / 3600 if len(gaps) > 0 else 0.0
+    if active > 0:
+        ret["items_per_hour"] = len(created) / ret["active_hours"]
+        if ret["remaining"] is not None:
+            ret["projected_hours"] = ret["remaining"] / ret["items_per_hour"]
+            ret["projected_finish"] = (now if now is not None else ret["last"]) + ret["projected_hours"] * 3600
+    return ret
+
+
+class ItemPool:
+    """
+    Pool of the indices of all items which have not been assigned to anyone yet, from which a random
+    item can be drawn for an annotator, excluding the items already seen by that annotator.
+    Drawing and removing an item is O(1) (expected): removal swaps the item with the last one, drawing
+    picks random items from the shared pool until one has not been seen by the annotator. If this fails
+    too often, the annotator gets its own list of candidates which is cleaned up lazily whenever
+    a candidate turns out to have been taken by someone else.
+    """
+    def __init__(self, n, seen, maxtries=32):
+        """
+        Create the pool.
+        :param n: number of items, the items are identified by the indices 0..n-1
+        :param seen: a map from annotator id to the set of item indices already seen by that annotator
+        :param maxtries: how many draws from the shared pool to try before using a candidate list
+        """
+        self.items = list(range(n))
+        # position of each item in self.items or -1 if the item has been removed
+        self.pos = list(range(n))
+        self.seen = seen
+        self.maxtries = maxtries
+        self.own = {}
+
+    def __len__(self):
+        return len(self.items)
+
+    def remove(self, idx):
+        """
+        Remove the item from the pool so it cannot be drawn for any annotator any more.
+        :param idx: item index
+        :return:
+        """
+        p = self.pos[idx]
+        last = self.items.pop()
+        if last != idx:
+            self.items[p] = last
+            self.pos[last] = p
+        self.pos[idx] = -1
+
+    def draw(self, annid):
+        """
+        Randomly choose one of the items not yet seen by the annotator, all such items are equally likely.
+        The item is NOT removed from the pool.
+        :param annid: annotator id
+        :return: item index or None if there is no item available for the annotator
+        """
+        own = self.own.get(annid)
+        if own is None:
+            seen = self.seen[annid]
+            for _ in range(self.maxtries):
+                if len(self.items) == 0:
+                    return None
+                idx = self.items[random.randrange(len(self.items))]
+                if idx not in seen:
+                    return idx
+            # the annotator has seen most of what is left, from now on use a list of just the candidates
+            own = [idx for idx in self.items if idx not in seen]
+            self.own[annid] = own
+        while len(own) > 0:
+            i = random.randrange(len(own))
+            idx = own[i]
+            if self.pos[idx] >= 0:
+                return idx
+            own[i] = own[-1]
+            own.pop()
+        return None
+
+
+def seen_by(assigned_all, annotators):
+    """
+    For each annotator, the set of indices of the items already assigned to it.
+    :param assigned_all: list with the "assigned" list of each item
+    :param annotators: list of annotator ids
+    :return: map from annotator id to set of item indices
+    """
+    seen = {annid: set() for annid in annotators}
+    for idx, assigned in enumerate(assigned_all):
+        for a in assigned:
+            if a in seen:
+                seen[a].add(idx)
+    return seen
+
+
+def assign_round_robin(assigned_all, annotators):
+    """
+    Assign items to the annotators in a round robin fashion: in each round, each annotator gets one random item
+    from those not assigned to anyone yet and not already seen by that annotator, until no annotator gets anything.
+    Uses the global random generator.
+    :param assigned_all: list with the "assigned" list of each item
+    :param annotators: list of annotator ids
+    :return: map from annotator id to the list of indices of the items assigned, in the order of assignment
+    """
+    logger = runutils.ensurelogger()
+    pool = ItemPool(len(assigned_all), seen_by(assigned_all, annotators))
+    new_forann = {annid: [] for annid in annotators}
+    iterations = 0
+    while(True):
+        iterations += 1
+        added = 0
+        for annid in annotators:
+            idx = pool.draw(annid)
+            if idx is None:
+                continue
+            pool.remove(idx)
+            new_forann[annid].append(idx)
+            added += 1
+        logger.debug(f"End of round {iterations}: added={added}")
+        if added == 0:
+            break
+    return new_forann
+
+
+class BalancedAssignment:
+    """
+    Assignment of items to annotators as a flow problem: each item has to go to exactly r different annotators,
+    never to one who has already seen it, and every annotator gets the same number of items (or one more).
+    The items are added one at a time: an item is given to the next annotators in turn which have not seen it
+    and are not full yet. If there are not enough of those, an augmenting path is searched, which makes room by
+    moving items from one annotator to another, until an annotator which is not full yet is reached. Since nearly
+    all annotators can take nearly all items, such paths are short and found quickly, so the time needed is
+    close to linear in the number of items times r. As with any augmenting path algorithm, if no path is found,
+    the items added so far cannot be assigned within the current limits: then the maximum number of items per
+    annotator is raised by one, as long as this stays within the capacity.
+    """
+    def __init__(self, seen, nannotators, nitems, redundancy=1, capacity=None):
+        """
+        :param seen: list with the set of annotator positions (0..nannotators-1) which saw each item, or None
+        :param nannotators: number of annotators
+        :param nitems: number of items which will be added
+        :param redundancy: number of annotators for each item
+        :param capacity: maximum number of items per annotator or None
+        """
+        self.seen = seen
+        self.k = nannotators
+        self.r = redundancy
+        self.capacity = capacity
+        total = nitems * redundancy
+        # every annotator gets base items, nextra of them get one more
+        self.base = total // nannotators
+        self.nextra = total - self.base * nannotators
+        self.nextra_used = 0
+        self.members = [set() for _ in range(nannotators)]
+        self.chosen = {}
+        self.open = list(range(nannotators))
+        random.shuffle(self.open)
+        self.ptr = 0
+
+    def relax(self):
+        """
+        Allow every annotator one item more than the current maximum, if the capacity permits.
+        :return: False if the capacity does not permit this
+        """
+        if self.capacity is not None and self.base + 1 > self.capacity:
+            return False
+        self.base += 1
+        self.nextra = 0
+        self.nextra_used = 0
+        self.open = [a for a in range(self.k) if self.has_room(a)]
+        return True
+
+    def remove(self, i):
+        """
+        Take item i away from all annotators it has been given to.
+        """
+        for a in self.chosen.pop(i):
+            if len(self.members[a]) == self.base + 1:
+                self.nextra_used -= 1
+            self.members[a].remove(i)
+        self.open = [a for a in range(self.k) if self.has_room(a)]
+
+    def has_room(self, a):
+        load = len(self.members[a])
+        return load < self.base or (load == self.base and self.nextra_used < self.nextra)
+
+    def allowed(self, i, a):
+        seen = self.seen[i]
+        return (seen is None or a not in seen) and a not in self.chosen[i]
+
+    def _added(self, a):
+        # bookkeeping after annotator a got one more item
+        if len(self.members[a]) == self.base + 1:
+            self.nextra_used += 1
+            if self.nextra_used == self.nextra:
+                self.open = [b for b in self.open if len(self.members[b]) < self.base]
+                return
+        if not self.has_room(a) and a in self.open:
+            self.open.remove(a)
+
+    def _give(self, i, a):
+        self.members[a].add(i)
+        self.chosen[i].append(a)
+        self._added(a)
+
+    def add(self, i):
+        """
+        Give item i to r annotators.
+        :return: True if this was possible, otherwise False (then the item is not given to anyone)
+        """
+        self.chosen[i] = []
+        # first, try the next annotators in turn which have room
+        candidates = []
+        n = len(self.open)
+        for t in range(n):
+            a = self.open[(self.ptr + t) % n]
+            if self.allowed(i, a):
+                candidates.append(a)
+                if len(candidates) == self.r:
+                    break
+        self.ptr += len(candidates)
+        for a in candidates:
+            if self.has_room(a):
+                self._give(i, a)
+        while len(self.chosen[i]) < self.r:
+            if not self._augment(i) and not self.relax():
+                self.remove(i)
+                return False
+        return True
+
+    def _augment(self, i):
+        # breadth first search from the annotators which could take item i over the annotators: a -> b if
+        # some item of a could be moved to b, until we reach an annotator b with room
+        parent = {}
+        queue = collections.deque()
+        for a in range(self.k):
+            if self.allowed(i, a):
+                if self.has_room(a):
+                    self._give(i, a)
+                    return True
+                parent[a] = None
+                queue.append(a)
+        unvisited = [b for b in range(self.k) if b not in parent]
+        while queue and unvisited:
+            a = queue.popleft()
+            for j in self.members[a]:
+                rest = []
+                for b in unvisited:
+                    if not self.allowed(j, b):
+                        rest.append(b)
+                        continue
+                    parent[b] = (a, j)
+                    if self.has_room(b):
+                        self._move_path(i, b, parent)
+                        return True
+                    queue.append(b)
+                unvisited = rest
+                if not unvisited:
+                    break
+        return False
+
+    def _move_path(self, i, b, parent):
+        # move the items along the path which ends in b: b gets one more item, the annotator where the path
+        # starts one less, which makes room for item i there
+        last = b
+        while parent[b] is not None:
+            a, j = parent[b]
+            self.members[a].remove(j)
+            self.members[b].add(j)
+            chosen = self.chosen[j]
+            chosen[chosen.index(a)] = b
+            b = a
+        self.members[b].add(i)
+        self.chosen[i].append(b)
+        self._added(last)
+
+
+def assign_balanced(assigned_all, annotators, redundancy=1, capacity=None):
+    """
+    Assign items so that each item goes to exactly redundancy annotators who have not seen it before and all
+    annotators get the same number of items, or one more (see BalancedAssignment). If that is not possible because
+    some annotators have already seen too many of the items, the maximum number of items per annotator is
+    raised as little as needed. Items are considered in order, items which have been seen by too many of the
+    annotators or do not fit within the capacity are skipped.
+    Uses the global random generator.
+    :param assigned_all: list with the "assigned" list of each item
+    :param annotators: list of annotator ids
+    :param redundancy: number of annotators for each item
+    :param capacity: maximum number of items per annotator, if this is less than needed for all items,
+        only as many items as fit are assigned
+    :return: map from annotator id to the list of indices of the items assigned, in the order of the items
+    """
+    logger = runutils.ensurelogger()
+    k = len(annotators)
+    if redundancy > k:
+        raise Exception(f"Cannot give each item to {redundancy} of only {k} annotators")
+    pos = {annid: p for p, annid in enumerate(annotators)}
+    seen = []
+    eligible = []
+    for idx, assigned in enumerate(assigned_all):
+        s = {pos[a] for a in assigned if a in pos}
+        seen.append(s or None)
+        if k - len(s) >= redundancy:
+            eligible.append(idx)
+    if len(eligible) < len(assigned_all):
+        logger.warning(f"Items seen by too many of the annotators, not assigned: {len(assigned_all)-len(eligible)}")
+    if capacity is not None and capacity * k < len(eligible) * redundancy:
+        eligible = eligible[:capacity * k // redundancy]
+        logger.info(f"Capacity {capacity} per annotator, only assigning {len(eligible)} items")
+    flow = BalancedAssignment(seen, k, len(eligible), redundancy, capacity)
+    n_failed = 0
+    for idx in eligible:
+        if not flow.add(idx):
+            n_failed += 1
+    if n_failed > 0:
+        logger.warning(f"Items which could not be assigned within the capacity: {n_failed}")
+    logger.info(f"Items per annotator: {min(len(m) for m in flow.members)} to {max(len(m) for m in flow.members)}")
+    return {annid: sorted(flow.members[p]) for annid, p in pos.items()}
+
+
+def reassign(items, annotators, seed=42, redundancy=None, capacity=None):
+    """
+    Randomly assign annotated items to new annotators, like reassign.py, never to an annotator who already saw
+    the item.
+    :param items: list of items
+    :param annotators: list of annotator ids
+    :param seed: random seed
+    :param redundancy: if not None, give each item to exactly that many annotators with balanced loads
+        (see assign_balanced), otherwise assign round robin
+    :param capacity: with redundancy, maximum number of items per annotator
+    :return: map from annotator id to the list of items for that annotator, with the annotator added to "assigned"
+    """
+    random.seed(seed)
+    order = list(range(len(items)))
+    random.shuffle(order)
+    assigned_all = [items[i].get("assigned", []) for i in order]
+    if redundancy is None:
+        new_forann = assign_round_robin(assigned_all, annotators)
+    else:
+        new_forann = assign_balanced(assigned_all, annotators, redundancy, capacity)
+    return {annid: [dict(items[order[idx]], assigned=assigned_all[idx] + [annid]) for idx in idxs]
+            for annid, idxs in new_forann.items()}
+
+
+def agree(items, labels=None, nboot=0, seed=42, level=0.95, workers=1):
+    """
+    Calculate the agreement statistics for the annotated items, like agreement.py.
+    :param items: list of items with fields annNN_label
+    :param labels: list of labels, by default the labels from the label-studio config
+    :param nboot: number of bootstrap resamples for confidence intervals, 0 for none
+    :return: the statistics map from iaa.agreement, with the confidence intervals under "ci" if nboot > 0
+    """
+    if labels is None:
+        labels = colstore.Codec.from_config().values
+    anns = iaa.encode(items, labels)
+    stats = iaa.agreement(anns)
+    if nboot > 0:
+        stats["ci"] = iaa.bootstrap(anns, nboot, seed=seed, level=level, workers=workers)
+    return stats
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("infile", help="Input JSON/JSONL file")
+    parser.add_argument("outpref", help="Output file prefix for the annotator files, e.g. label-studio/data")
+    parser.add_argument("-k", type=int, required=True, help="Number of annotators, each gets one set")
+    parser.add_argument("--fmt", type=str, default="json", help="Input format (json, jsonl), default is json")
+    parser.add_argument("-s", type=int, default=25, help="Size (number of items) of each set (25)")
+    parser.add_argument("--skip", type=int, default=0, help="Number of items to skip after shuffling")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed (default: 42)")
+    parser.add_argument("--fromannnr", type=int, default=0, help="Number of first annotator to assign to (0)")
+    parser.add_argument("--setspref", type=str, default=None,
+                        help="If specified, also save all sets and the remaining items with this prefix, as "
+                             "prepare-split-data.py would")
+    runutils.add_metrics_args(parser)
+    args = parser.parse_args()
+
+    logger = runutils.set_logger(args)
+    runutils.run_start()
+
+    with runutils.stage("split"):
+        sets, remaining = split(dataio.iter_items(args.infile, args.fmt), size=args.s, skip=args.skip, seed=args.seed)
+    logger.info(f"Created {len(sets)} sets of size {args.s}, {len(remaining)} items remaining")
+    if len(sets) < args.k:
+        raise Exception(f"Only got {len(sets)} sets for {args.k} annotators")
+    annotators = list(range(args.fromannnr, args.fromannnr + args.k))
+    with runutils.stage("assign"):
+        perann = assign(sets[:args.k], annotators)
+    with runutils.stage("write"):
+        save_assigned(perann, args.outpref, sets, remaining, args.setspref)
+    runutils.count("items_written", sum(len(items) for items in perann.values()))
+    runutils.run_stop()
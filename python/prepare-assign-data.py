@@ -2,15 +2,71 @@
 """
 Program to assign k sets/files to k annotators in sequence.
 Annotators are assigned from 0 to k-1
-Input files need to all have names someprefix_setNNN*.json.
-Output files will have names outprefix_setNNN_annMM.json
+Input files need to all have names someprefix_setNNN*.json (or someprefix_setNNN*.cols for columnar stores).
+Output files will have names outprefix_setNNN_annMM.json (or .cols if the input is a columnar store)
 Each set is assigned to a different annotator
+If prepare-split-data.py created a set manifest (someprefix_manifest.json), the set files are looked up there
+and the output files are created from the bytes of the items in the set files, in parallel, without parsing
+and re-serializing the sets.
+In any case, the assignments are recorded in outprefix_assignments.json (annotator -> set number, set file and
+item ids). With --lazy, only this record is written and prepare-labelstudio.py creates the files
+when it needs them.
 """
 
+import os
 import json
 import argparse
 import runutils
 import glob
+import dataio
+import colstore
+import concurrent.futures
+
+
+def find_setfile(inpref, setnr, manifest):
+    """
+    Find the file for a set, either from the manifest or by looking for a matching file name.
+    :param inpref: input prefix
+    :param setnr: set number
+    :param manifest: the set manifest or None
+    :return: a tuple (file name, manifest entry for the set or None)
+    """
+    logger = runutils.ensurelogger()
+    if manifest is not None:
+        entry = manifest["sets"].get(f"{setnr:03d}")
+        if entry is None:
+            logger.error(f"Set {setnr} is not in the set manifest")
+            raise Exception("No proper intput")
+        return entry["file"], entry
+    files = glob.glob(inpref+f"_set{setnr:03d}*.json") + glob.glob(inpref+f"_set{setnr:03d}*.cols")
+    for ext in dataio.COMPRESSORS:
+        files += glob.glob(inpref+f"_set{setnr:03d}*.json{ext}")
+    if len(files) != 1:
+        logger.error(f"Could not find exactly one match for set {setnr} but {len(files)}")
+        raise Exception("No proper intput")
+    return files[0], None
+
+
+def materialize(file, offsets, annnr, outfile):
+    """
+    Create the file of items for an annotator from the set file.
+    :param file: set file
+    :param offsets: byte offsets of the items from the set manifest or None
+    :param annnr: annotator number
+    :param outfile: output file
+    """
+    logger = runutils.ensurelogger()
+    dataio.copy_set_assigned(file, offsets, annnr, outfile)
+    logger.info(f"File {file} assigned to annotator {annnr} and saved to {outfile}")
+
+
+def outfilename(outpref, setnr, annnr, file):
+    """
+    Name of the output file, in the same format as the set file.
+    """
+    ext = colstore.STORE_EXT if colstore.is_store(file) else ".json"
+    return outpref + f"_set{setnr:03d}_ann{annnr:02d}" + ext
+
 
 if __name__ == "__main__":
 
@@ -20,26 +76,39 @@ if __name__ == "__main__":
     parser.add_argument("fromsetnr", type=int, help="Number of first set to take")
     parser.add_argument("--fromannnr", type=int, default=0, help="Number of first annotator to assign to (0)")
     parser.add_argument("n", type=int, help="Number of sets to take")
+    parser.add_argument("--lazy", action="store_true",
+                        help="Only record the assignments, the files are created by prepare-labelstudio.py")
+    parser.add_argument("--threads", type=int, default=8, help="Number of threads for writing files (8)")
+    runutils.add_metrics_args(parser)
     args = parser.parse_args()
 
     logger = runutils.set_logger(args)
     runutils.run_start()
 
+    manifest = dataio.load_sets_manifest(args.inpref)
+    if manifest is None:
+        logger.info(f"No set manifest found for {args.inpref}, looking for the set files")
+    recordfile = args.outpref + dataio.ASSIGNMENTS
+    if os.path.exists(recordfile):
+        with open(recordfile, "rt", encoding="utf8") as infp:
+            record = json.load(infp)
+    else:
+        record = {}
+    tasks = []
     for i, setnr in enumerate(range(args.fromsetnr, args.fromsetnr+args.n)):
         annnr = i + args.fromannnr
-        files = glob.glob(args.inpref+f"_set{setnr:03d}*.json")
-        if len(files) != 1:
-            logger.error(f"Could not find exactly one match for set {setnr} but {len(files)}")
-            raise Exception("No proper intput")
-        file = files[0]
-        with open(file, "rt", encoding="utf8") as infp:
-            data = json.load(infp)
-        # add the annotator id to the field assigned
-        for item in data:
-            item["assigned"].append(annnr)
-        # save to the output file
-        outfile = args.outpref + f"_set{setnr:03d}_ann{annnr:02d}.json"
-        with open(outfile, "wt", encoding="utf8") as outfp:
-            json.dump(data, outfp)
-        logger.info(f"File {file} assigned to annotator {annnr} and saved to {outfile}")
-    runutils.run_stop()
\ No newline at end of file
+        file, entry = find_setfile(args.inpref, setnr, manifest)
+        outfile = outfilename(args.outpref, setnr, annnr, file)
+        offsets = entry["offsets"] if entry else None
+        record[f"{annnr:02d}"] = {"set": setnr, "setfile": file, "file": outfile,
+                                  "ids": entry["ids"] if entry else None, "offsets": offsets}
+        tasks.append((file, offsets, annnr, outfile))
+    with dataio.atomic_open(recordfile, "wt") as outfp:
+        json.dump(record, outfp)
+    logger.info(f"Assignments recorded in {recordfile}")
+    if not args.lazy:
+        with runutils.stage("write"), concurrent.futures.ThreadPoolExecutor(max_workers=args.threads) as executor:
+            for _ in executor.map(lambda task: materialize(*task), tasks):
+                pass
+        runutils.count("files_written", len(tasks))
+    runutils.run_stop()
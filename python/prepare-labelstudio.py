@@ -2,6 +2,10 @@
 """
 Program to prepare the labelstudio projects.
 The default parameters assume the program is run from the root directory of the repo.
+With --workers, several "label-studio init" commands are run at the same time.
+With --clone, "label-studio init" is only run for the first project, all other projects are created by copying
+that project directory, replacing the tasks and changing the paths in config.json. If the tasks file of the
+first project does not look as expected, this falls back to running init for each project.
 """
 
 import json
@@ -10,6 +14,12 @@ import runutils
 import os
 import regex
 import glob
+import dataio
+import colstore
+import pipeline
+import shutil
+import subprocess
+import concurrent.futures
 
 DEFAULT_ANNGUIDE_HTML = "annotation-guidelines.html"
 DEFAULT_CONFIG = "label-studio/tmpl_config.xml"
@@ -17,22 +27,114 @@ TITLE = "WeVerify Covid-19 Annotation Exercise"
 
 DEFAULT_GUIDE_URL = "https://gate.ac.uk/wiki/wv-covid19/annotation-guidelines.html"
 
-TMPL_INIT_CMD = "label-studio init -l {0} -i {1} --input-format json  {2}"
+TMPL_INIT_CMD = "{0} init -l {1} -i {2} --input-format json  {3}"
+# the files in a project directory which get changed when cloning a project
+TASKS_FILE = "tasks.json"
+CONFIG_FILE = "config.json"
 PAT_WS = regex.compile(r"\s\s+")
 
 def infilename(pref, i):
     infilepat = args.inpref + "*_" + f"ann{i:02d}" + ".json"
-    infiles = glob.glob(infilepat)
+    infiles = glob.glob(infilepat) + glob.glob(infilepat[:-5] + colstore.STORE_EXT)
+    if len(infiles) == 0:
+        # the assignment may have been recorded with prepare-assign-data.py --lazy, create the file now
+        entry = assignments.get(f"{i:02d}")
+        if entry is not None:
+            dataio.copy_set_assigned(entry["setfile"], entry["offsets"], i, entry["file"])
+            logger.info(f"Created file {entry['file']} from set file {entry['setfile']} for annotator {i}")
+            infiles = [entry["file"]]
     if len(infiles) != 1:
-        logger.error(f"Not exactly one file for {infilepat} but {len(infiles)}")
+        logger.error(f"Not exactly one file for {infilepat} (or .cols) but {len(infiles)}")
         raise Exception("ERROR")
     infile = infiles[0]
     return infile
 
+
+def jsonfilename(infile):
+    """
+    Return the name of the JSON file to import into label-studio: for a columnar store, this exports the
+    items to the file tasks.json in the store directory first.
+    """
+    if not colstore.is_store(infile):
+        return infile
+    jsonfile = os.path.join(infile, "tasks.json")
+    dataio.save_items(jsonfile, colstore.read_store(infile))
+    return jsonfile
+
 def projdirname(pref, i):
     return pref + f"_{i}"
 
 
+def init_project(lsexe, config, infile, outdir):
+    """
+    Create a project directory by running label-studio init.
+    :param lsexe: the label-studio command
+    :param config: label config file
+    :param infile: file with the tasks
+    :param outdir: project directory to create
+    """
+    logger = runutils.ensurelogger()
+    cmd = TMPL_INIT_CMD.format(lsexe, config, infile, outdir)
+    logger.info(f"Running command: {cmd}")
+    ret = subprocess.run(cmd, shell=True).returncode
+    if ret != 0:
+        raise Exception(f"Something went wrong, got exit code {ret} for {cmd}")
+    logger.info(f"Created label-studio project {outdir}")
+
+
+def relocate(obj, replacements):
+    """
+    Replace the paths in all strings of the (parsed JSON) object which start with one of the old paths.
+    :param obj: the object
+    :param replacements: list of tuples (old path, new path)
+    :return: the changed object
+    """
+    if isinstance(obj, dict):
+        return {k: relocate(v, replacements) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [relocate(v, replacements) for v in obj]
+    if isinstance(obj, str):
+        for old, new in replacements:
+            if obj.startswith(old):
+                return new + obj[len(old):]
+    return obj
+
+
+def can_clone(template, infile):
+    """
+    Check if the tasks file of the template project contains exactly the items from the input file, in the
+    format created by pipeline.render, so that other projects can be created by replacing it.
+    """
+    tfile = os.path.join(template, TASKS_FILE)
+    if not os.path.exists(tfile) or not os.path.exists(os.path.join(template, CONFIG_FILE)):
+        return False
+    with open(tfile, "rt", encoding="utf8") as infp:
+        tasks = json.load(infp)
+    return tasks == pipeline.render(dataio.load_items(infile))
+
+
+def clone_project(template, template_infile, infile, outdir):
+    """
+    Create a project directory by copying the template project and replacing the tasks.
+    :param template: template project directory, created with label-studio init from template_infile
+    :param template_infile: the file the template project was created from
+    :param infile: file with the tasks for the new project
+    :param outdir: project directory to create
+    """
+    logger = runutils.ensurelogger()
+    shutil.copytree(template, outdir, ignore=shutil.ignore_patterns(TASKS_FILE, CONFIG_FILE))
+    with dataio.atomic_open(os.path.join(outdir, TASKS_FILE), "wt") as outfp:
+        outfp.write(json.dumps(pipeline.render(dataio.load_items(infile))))
+    # the config may contain relative or absolute paths to the project directory and the input file
+    replacements = [(os.path.abspath(template_infile), os.path.abspath(infile)), (template_infile, infile),
+                    (os.path.abspath(template), os.path.abspath(outdir)), (template, outdir)]
+    with open(os.path.join(template, CONFIG_FILE), "rt", encoding="utf8") as infp:
+        jconf = relocate(json.load(infp), replacements)
+    with dataio.atomic_open(os.path.join(outdir, CONFIG_FILE), "wt") as outfp:
+        json.dump(jconf, outfp)
+    logger.info(f"Created label-studio project {outdir} from {template}")
+
+
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
@@ -41,11 +143,21 @@ if __name__ == "__main__":
     parser.add_argument("-k", type=int, required=True, help="Number of sets/annotators")
     parser.add_argument("-p", type=int, default=9000, help="Starting port number (9000)")
     parser.add_argument("-c", type=str, default=DEFAULT_CONFIG, help=f"Config file template ({DEFAULT_CONFIG})")
+    parser.add_argument("--workers", type=int, default=1, help="Number of projects to create at the same time (1)")
+    parser.add_argument("--clone", action="store_true",
+                        help="Only run label-studio init for the first project and copy it for all others")
+    parser.add_argument("--lsexe", type=str, default="label-studio", help="The label-studio command (label-studio)")
+    runutils.add_metrics_args(parser)
     args = parser.parse_args()
 
     logger = runutils.set_logger(args)
     runutils.run_start()
 
+    assignments = {}
+    if os.path.exists(args.inpref + dataio.ASSIGNMENTS):
+        with open(args.inpref + dataio.ASSIGNMENTS, "rt", encoding="utf8") as infp:
+            assignments = json.load(infp)
+
     # read in the annotation guidelines HTML
     # NOTE: NOT NECESSARY
     #with open(DEFAULT_ANNGUIDE_HTML, "rt", encoding="utf8") as infp:
@@ -54,36 +166,35 @@ if __name__ == "__main__":
 
     # check that all the input files are there and the project directories are not there
     infiles = []
-    for i in range(args.k):
-        infile = infilename(args.inpref, i)
-        outdir = projdirname(args.outpref, i)
-        if not os.path.exists(infile):
-            raise Exception(f"Input file {infile} does not exist")
-        if os.path.exists(outdir):
-            raise Exception(f"Output directory {outdir} must not exist")
-
-    for i in range(args.k):
-        outdir = projdirname(args.outpref, i)
-        infile = infilename(args.inpref, i)
-        cmd = TMPL_INIT_CMD.format(args.c, infile, outdir)
-        logger.info(f"Trying to create label-studio project {i}")
-        logger.info(f"Running command: {cmd}")
-        ret = os.system(cmd)
-        if ret != 0:
-            raise Exception(f"Something went wrong, got exit code {ret}")
-        # if success, update the config json file of the project
-        jfile = os.path.join(outdir, "config.json")
-        with open(jfile, "rt", encoding="utf8") as infp:
-            jconf = json.load(infp)
-        # update the info we need to update:
-        # NOTE: this does not work in label-studio anyways so we do not need to do that!
-        # jconf["port"] = args.p + i
-        # jconf["instruction"] = guide_html
-        # jconf["title"] = TITLE
-        with open(jfile, "wt", encoding="utf8") as outfp:
-            jconf = json.dump(jconf, outfp)
-        logger.info(f"Config file {jconf} updated")
-
-
+    with runutils.stage("check"):
+        for i in range(args.k):
+            infile = infilename(args.inpref, i)
+            outdir = projdirname(args.outpref, i)
+            if not os.path.exists(infile):
+                raise Exception(f"Input file {infile} does not exist")
+            if os.path.exists(outdir):
+                raise Exception(f"Output directory {outdir} must not exist")
+            infiles.append(infile)
+        infiles = [jsonfilename(infile) for infile in infiles]
+    outdirs = [projdirname(args.outpref, i) for i in range(args.k)]
+
+    # NOTE: we used to update the config.json file of each project here, but changing the port, instructions or
+    # title there does not work in label-studio anyways, so the file is left as created by label-studio.
+    tasks = [(init_project, args.lsexe, args.c, infile, outdir) for infile, outdir in zip(infiles, outdirs)]
+    if args.clone and args.k > 1:
+        template = outdirs[0]
+        with runutils.stage("init"):
+            init_project(args.lsexe, args.c, infiles[0], template)
+        if can_clone(template, infiles[0]):
+            tasks = [(clone_project, template, infiles[0], infile, outdir)
+                     for infile, outdir in zip(infiles[1:], outdirs[1:])]
+        else:
+            logger.warning(f"Tasks in {template} not as expected, running label-studio init for each project")
+            tasks = tasks[1:]
+    with runutils.stage("create"), concurrent.futures.ThreadPoolExecutor(max_workers=max(1, args.workers)) as executor:
+        for _ in executor.map(lambda task: task[0](*task[1:]), tasks):
+            pass
+    runutils.count("projects", args.k)
+    logger.info(f"Created {args.k} label-studio projects")
 
     runutils.run_stop()
@@ -2,7 +2,8 @@
 """
 Program to convert the original data to what we need and group items into sets of k in separate files.
 Each file with k items can then be subsequently get assigned to some annotator (see prepare-assign-data.py)
-We keep all input fields and add the field "html" (the text to present) and the field "assigned" (list of set numbers
+We keep all input fields and add the field "html" (the text to present), the field "item_id" (a stable id computed
+from the content, see pipeline.item_id) and the field "assigned" (list of set numbers
 0..(k-1) this item is/has been assigned to, this list is empty initially)
 Major steps:
 * read all data, but filter items with missing data fields, abort if major problem
@@ -11,63 +12,279 @@ Major steps:
 * split the rest into as many sets of -s as possible or take -n sets if specified
 * NOTE: ignore any items at the end which would not make up a complete set
 * store all the sets using the output file prefix, nubering the sets starting with 0
+With --stream, the input is parsed incrementally and the shuffling is done using temporary files so that
+only a bounded number of items (--maxitems) is kept in memory. This gives a different (but also
+reproducible) random order than the default.
+With --workers, checking, converting and serializing the items is done by several processes, and the set files
+are always written by a pool of background threads (--writers). The output is the same as with a single process.
+The file outpref_manifest.json records the file, item ids (the field item_id) and item byte offsets for each set,
+this is used by prepare-assign-data.py. Unless the items are ordered with --order hash, the positions of the items in
+the shuffled order are also recorded.
+With --dedup drop, near-duplicates of claims seen before (see dedup.py) are left out, with --dedup mark, all items
+get the field "cluster" with the id of their cluster of near-duplicates, so duplicates can share labels. With
+--dedup-index, the clusters are also loaded from and saved to that file, so later batches get deduplicated against
+the earlier ones. The file is only saved once all sets have been written, and only the clusters of items which went
+into a set are claimed: items which were left over (skipped, remaining or not kept) are not near-duplicates in a later
+run.
+With --partition FIELD (Source_Lang, Factcheck_Org or Country), the valid items are routed to one partition for each
+value of that field while reading the input, and the sets are created for each partition separately, as if the
+program had been run on just the items of that partition: each partition is shuffled with the same seed, has its
+own set numbering and manifest and its files get the prefix outpref_VALUE. The input is only read once, no matter
+how many partitions there are. Partitioning by Source_Lang keeps all languages (unless --lang is given), --values
+restricts the partitions to the values listed. The file outpref_partitions.json lists the partitions. With --stream,
+all partitions are shuffled together on disk, so --maxitems is the limit for all of them, not for each.
+With --order hash, the items are not shuffled but ordered by a keyed hash of their id (see pipeline.item_id and
+pipeline.rank_key), so the order of an item only depends on the seed and its content. With -n, only the items for
+the sets requested are kept (no file with the remaining items is written, one from an earlier run is removed),
+otherwise the items are sorted on disk like with --stream. The manifest then records the item ids of each set and with --extend, the sets in an
+existing manifest for the same prefix are kept: their items are left out and the new sets are numbered after them,
+so more sets can be added at any time, also from a newer version of the input, without changing the existing ones.
 """
 
 import json
 import argparse
+import functools
 import runutils
-import random
+import itertools
+import os
+import shutil
+import dataio
+import colstore
 import regex
-import gzip
-
-REQ_FIELDS = ["Claim", "Explaination", "Link", "Source", "Source_Lang", "Date", "Country", "Factcheck_Org", "Label"]
-TEMPLATE = """
-  <div><font size="+2"><b>Claim:</b>{0}</font></div>
-  <p>
-  <b>Explanation:</b>{1}
-  <p>
-  <a href="{2}" target="_blank">{2}</a> 
-"""
+import pipeline
+import dedup
+
+# the partitions are listed in a file with this added to the output prefix
+PARTITIONS = "_partitions.json"
+PAT_UNSAFE = regex.compile(r"[^\w.-]+")
+
+def prepare_chunk(chunk, hasher=None, lang="en", partition=None, withids=False):
+    """
+    Check and convert a chunk of input items and serialize the items we keep, with the field "assigned" added.
+    This runs in the worker processes if there are several. Since this does not depend on anything but the chunk,
+    the result is the same no matter how many workers are used.
+    :param chunk: a tuple (index of the first item, list of items, flag if the items are still JSON strings)
+    :param hasher: if not None, a dedup.MinHasher to calculate the signatures of the claims with
+    :param lang: the language of the items to keep, None for all
+    :param partition: if not None, the field to partition the items by
+    :param withids: if True, also return the item ids (the field item_id, see pipeline.item_id)
+    :return: a tuple (list of JSON strings, number of items in the chunk, number of items skipped, number skipped
+        because of the language, list of the signatures of the items kept or None, list of the values of the
+        partition field of the items kept or None, list of the ids of the items kept or None)
+    """
+    startidx, objs, isjson = chunk
+    raws = []
+    sigs = [] if hasher else None
+    keys = [] if partition else None
+    ids = [] if withids else None
+    n_skipped = 0
+    n_non_en = 0
+    for idx, obj in enumerate(objs, start=startidx):
+        if isjson:
+            obj = json.loads(obj)
+        obj, non_en = pipeline.prepare_item(obj, idx, lang=lang)
+        if not obj:
+            n_skipped += 1
+            n_non_en += non_en
+            continue
+        raws.append(json.dumps(obj))
+        if hasher:
+            sigs.append(hasher.signature(obj["Claim"]))
+        if partition:
+            keys.append(str(obj[partition]))
+        if withids:
+            ids.append(obj["item_id"])
+    return raws, len(objs), n_skipped, n_non_en, sigs, keys, ids
+
 
-PAT_WS = regex.compile(r"\s\s+")
+def partition_name(value):
+    """
+    Make the value of the partition field usable in a file name.
+    """
+    return PAT_UNSAFE.sub("_", value).strip("_") or "_"
 
 
-def check(indata, n):
+def write_set(fname, raws):
     """
-    Check if the item is useful/valid.
-    :param indata: the item object
-    :return: the item or None if not valid
+    Write a set file from the JSON strings of the items.
+    :param fname: file name, if it has the extension .cols, a columnar store is written instead
+    :param raws: list of JSON strings
     """
     logger = runutils.ensurelogger()
-    have_error = False
-    if 'Source_Lang_New' in indata:
-        indata['Source_Lang'] = indata['Source_Lang_New']
-    for k in REQ_FIELDS:
-        val = indata.get(k)
-        if not val:
-            logger.warning(f"Input object {n}: field {k} is missing or empty, item skipped")
-            have_error = True
-    if have_error:
-        return None
+    if colstore.is_store(fname):
+        colstore.write_store(fname, (json.loads(raw) for raw in raws))
     else:
-        return indata
+        with dataio.atomic_open(fname, "wt") as outfp:
+            dataio.write_raw_array(outfp, raws)
+    logger.info(f"Wrote file {fname} containing {len(raws)} items")
+
+
+def raw_offsets(raws):
+    """
+    Calculate the byte offsets of the items in a set file written with write_set.
+    NOTE: json.dumps only produces ASCII, so the number of characters is the number of bytes.
+    :param raws: list of JSON strings
+    :return: list of [start, end] offsets
+    """
+    offsets = []
+    pos = 1
+    for raw in raws:
+        offsets.append([pos, pos + len(raw)])
+        pos += len(raw) + 2
+    return offsets
+
+
+def load_used(outpref, args):
+    """
+    With --extend, load the manifest of the sets already created with the prefix.
+    :return: a tuple (manifest or None, set of the ids of the items in those sets)
+    """
+    mfile = outpref + dataio.SETS_MANIFEST
+    if not args.extend or not os.path.exists(mfile):
+        return None, set()
+    with open(mfile, "rt", encoding="utf8") as infp:
+        manifest = json.load(infp)
+    if manifest.get("order") != "hash" or manifest["seed"] != args.seed or manifest["size"] != args.s:
+        raise Exception(f"Cannot extend {mfile}: not created with --order hash, the same seed and the same set size")
+    return manifest, set(itemid for entry in manifest["sets"].values() for itemid in entry["ids"])
 
 
-def input2obj(indata, n):
+def raw_item_id(raw):
     """
-    Convert a single object from the input to what we need.
-    NOTE: at this point we already expect the item to be valid!
-    NOTE: if this encounters an error it should return None to indicate that the item should get skipped
-    :param indata: a single item as read from the input
-    :return: converted item
+    Get the item id from the JSON string of an item serialized by prepare_chunk.
+    NOTE: quotes inside string values are escaped, so the key can only be found where it is the key.
     """
-    # for now we keep all the original data and just add an additional field "html" with the data we need to present
-    claim = PAT_WS.sub(" ", indata["Claim"])
-    expl = PAT_WS.sub(" ", indata["Explaination"])
-    src = indata["Source"]
-    html = TEMPLATE.format(claim, expl, src)
-    indata["html"] = html
-    return indata
+    start = raw.rindex('"item_id": "') + 12
+    return raw[start:raw.index('"', start)]
+
+
+def write_sets(objs, outpref, args, writers, strict=True, old=None, onset=None):
+    """
+    Shuffle the converted items (unless they are already shuffled on disk with --stream or ordered by --order hash),
+    split them into sets and write the sets, the remaining items and the manifest.
+    :param objs: list of JSON strings, or dataio.ExternalShuffle or, with --order hash, dataio.SmallestKeys
+    :param outpref: output file prefix
+    :param args: the command line arguments
+    :param writers: dataio.WriterPool for writing the set files
+    :param strict: if True, raise an exception if there are not enough items for --skip, -n or a single set,
+        otherwise create as many sets as possible (maybe none) and log a warning
+    :param old: with --extend, the manifest of the existing sets, which are kept
+    :param onset: if not None, a function called with the list of JSON strings of each set written
+    :return: a tuple (number of sets, number of items in all sets, number of remaining items)
+    """
+    logger = runutils.ensurelogger()
+    n_ok = len(objs)
+    hashed = args.order == "hash"
+    if not args.stream and not hashed:
+        # now shuffle the objects
+        with runutils.stage("shuffle"):
+            pipeline.shuffled(objs, args.seed)
+
+    skip = args.skip
+    if skip:
+        if skip >= n_ok:
+            logger.error(f"Not enough input data to skip {skip}, only have {n_ok}")
+            if strict:
+                raise Exception("Not enough data")
+            skip = n_ok
+        else:
+            logger.info(f"Skipping {skip}, got {n_ok - skip} remaining")
+    n_considered = n_ok - skip
+    # args.n: number of sets requested
+    # n: number of sets we take
+    if n_considered < args.s:
+        logger.error(f"Got only {n_considered} items, cannot proceed to make at least one set of size {args.s}")
+        if strict:
+            raise Exception("Not enough data")
+        n = 0
+    elif args.n:
+        if (args.n * args.s) > n_considered:
+            logger.error(f"Requested {args.n} sets, but only got {n_considered} items")
+            if strict:
+                raise Exception("Not enough data")
+        n = min(args.n, n_considered // args.s)
+    else:
+        n = int(n_considered / args.s)
+    nitems = n * args.s
+    logger.info(f"Creating {n} sets of size {args.s}, total of {nitems} items")
+
+    # from here on we only go through the shuffled objects once, in order, with --order hash as tuples
+    # (rank key:item id, JSON string)
+    objsiter = iter(objs.items() if hashed else objs)
+    for _ in itertools.islice(objsiter, skip):
+        pass
+    ext = ".cols" if args.cols else dataio.add_compression(".json", args.compress)
+    n_total = 0
+    # the manifest records for each set the file, the item ids of the items, for JSON files the byte offsets of each
+    # item in the file and, unless with --order hash, the positions of the items in the shuffled order
+    manifest = {"size": args.s, "seed": args.seed, "skip": skip, "sets": {}}
+    firstset = 0
+    if hashed:
+        manifest["order"] = "hash"
+        if old is not None:
+            manifest["sets"] = old["sets"]
+            firstset = len(old["sets"])
+            logger.info(f"Keeping the {firstset} existing sets, numbering the new sets from {firstset}")
+    # with --stream, the shuffled items get merged from the temporary files while writing
+    for setnr in runutils.timed_iter("write", range(firstset, firstset + n)):
+        raws = list(itertools.islice(objsiter, args.s))
+        if hashed:
+            ids = [key[17:] for key, _ in raws]
+            raws = [raw for _, raw in raws]
+            positions = None
+        else:
+            ids = [raw_item_id(raw) for raw in raws]
+            first = skip + n_total
+            positions = list(range(first, first + len(raws)))
+        fname = outpref + "_" + f"set{setnr:03d}" + ext
+        n_total = n_total + len(raws)
+        writers.submit(write_set, fname, raws)
+        if onset is not None:
+            onset(raws)
+        manifest["sets"][f"{setnr:03d}"] = {
+            "file": os.path.basename(fname), "ids": ids,
+            "offsets": None if args.cols else raw_offsets(raws)}
+        if positions is not None:
+            manifest["sets"][f"{setnr:03d}"]["positions"] = positions
+    if hashed:
+        objsiter = (raw for _, raw in objsiter)
+    # OK on second thought, also output anything that may be left over
+    fname = outpref + "_" + f"remaining" + ext
+    if isinstance(objs, dataio.SmallestKeys):
+        # only the items for the sets were kept
+        logger.info(f"Not writing {fname}, with --order hash and -n the remaining items are not kept")
+        n_remaining = 0
+        # a remaining file from an earlier run lists items which may now be in sets
+        for e in [".cols", ".json"] + [".json." + c for c in dataio.COMPRESS_CHOICES]:
+            stale = outpref + "_remaining" + e
+            if os.path.isdir(stale):
+                shutil.rmtree(stale)
+            elif os.path.exists(stale):
+                os.remove(stale)
+            else:
+                continue
+            logger.info(f"Removed {stale} from an earlier run")
+    else:
+        n_remaining = write_remaining(fname, objsiter, args)
+    with dataio.atomic_open(outpref + dataio.SETS_MANIFEST, "wt") as outfp:
+        json.dump(manifest, outfp)
+    return n, n_total, n_remaining
+
+
+def write_remaining(fname, objsiter, args):
+    """
+    Write the items left over after the sets.
+    :return: number of items written
+    """
+    logger = runutils.ensurelogger()
+    with runutils.stage("write"):
+        if args.cols:
+            n_remaining = colstore.write_store(fname, (json.loads(raw) for raw in objsiter))
+        else:
+            with dataio.atomic_open(fname, "wt") as outfp:
+                n_remaining = dataio.write_raw_array(outfp, objsiter)
+        logger.info(f"Wrote file {fname} containing remaining {n_remaining} items")
+    return n_remaining
 
 
 if __name__ == "__main__":
@@ -80,112 +297,232 @@ if __name__ == "__main__":
     parser.add_argument("-n", type=int, default=None, help="Number of sets to take (after optional skip), default: as many as possible")
     parser.add_argument("--skip", type=int, default=0, help="Number of items to skip after shuffling before taking rest or n")
     parser.add_argument("--seed", type=int, default=42, help="Random seed (default: 42)")
+    parser.add_argument("--stream", action="store_true",
+                        help="Read the input incrementally and shuffle on disk, for inputs larger than memory")
+    parser.add_argument("--maxitems", type=int, default=100000,
+                        help="With --stream, maximum number of items to keep in memory when shuffling (100000)")
+    parser.add_argument("--tmpdir", type=str, default=None,
+                        help="With --stream, directory for temporary files (system default)")
+    parser.add_argument("--compress", type=str, default=None, choices=dataio.COMPRESS_CHOICES,
+                        help="Compress the set files and the remaining items with this compressor (no compression)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of processes to use for checking and converting items (1)")
+    parser.add_argument("--chunksize", type=int, default=1000,
+                        help="Number of items processed by a worker at a time (1000)")
+    parser.add_argument("--writers", type=int, default=2,
+                        help="Number of threads writing set files in the background, 0 to write in the main thread (2)")
+    parser.add_argument("--cols", action="store_true",
+                        help="Save the sets as columnar stores (setNNN.cols directories) instead of JSON files")
+    parser.add_argument("--dedup", type=str, default=None,
+                        help="Near-duplicate claims: drop (keep only the first) or mark (add the field cluster), default: neither")
+    parser.add_argument("--dedup-index", type=str, default=None,
+                        help="With --dedup, file (.npz) with the clusters of earlier batches, updated with the new ones")
+    parser.add_argument("--dedup-threshold", type=float, default=dedup.DEFAULT_THRESHOLD,
+                        help=f"With --dedup, minimum estimated similarity of near-duplicates, for a new index ({dedup.DEFAULT_THRESHOLD})")
+    parser.add_argument("--partition", type=str, default=None, choices=["Source_Lang", "Factcheck_Org", "Country"],
+                        help="Create separate sets for each value of this field, in one pass over the input")
+    parser.add_argument("--values", nargs="+", default=None,
+                        help="With --partition, only create partitions for these values, skip the other items")
+    parser.add_argument("--lang", type=str, default=None,
+                        help="Only keep items with this Source_Lang, all for all languages "
+                             "(default: en, or all with --partition Source_Lang)")
+    parser.add_argument("--order", type=str, default="shuffle", choices=["shuffle", "hash"],
+                        help="Shuffle the items or order them by a keyed hash of their id (shuffle)")
+    parser.add_argument("--extend", action="store_true",
+                        help="With --order hash, keep the sets already created with the output prefix and add new ones")
+    runutils.add_metrics_args(parser)
     args = parser.parse_args()
 
     logger = runutils.set_logger(args)
     runutils.run_start()
 
-    # this will contain the objects as we need them for the annotation (fields already selected/converted)
-    objs = []
     n_in = 0
     n_skipped = 0
-    if args.infile.endswith(".gz"):
-        myopen = gzip.open
-    else:
-        myopen = open
+    n_non_en = 0
+    n_dups = 0
+    n_other = 0
+    n_used = 0
+    index = None
+    # with --dedup-index, a map from the id of each item which is the representative of a new cluster to the cluster id
+    reps = {}
+    hashed = args.order == "hash"
+    if args.extend and not hashed:
+        parser.error("--extend can only be used with --order hash")
+    lang = args.lang
+    if lang is None:
+        lang = "all" if args.partition == "Source_Lang" else "en"
+    lang = None if lang == "all" else lang
+    values = set(args.values) if args.values else None
+    # the file name part for each partition value
+    partnames = {}
+    if args.dedup is not None:
+        if args.dedup not in ["drop", "mark"]:
+            raise Exception(f"Not a valid --dedup: {args.dedup}")
+        if args.dedup_index and os.path.exists(args.dedup_index):
+            index = dedup.Index.load(args.dedup_index)
+            logger.info(f"Loaded near-duplicate index with {len(index)} clusters from {args.dedup_index}")
+        else:
+            index = dedup.Index(threshold=args.dedup_threshold)
+    # with --extend, for each output prefix the manifest of the existing sets and the ids of their items
+    used = {}
+
+    # with --partition, the partitions shuffled on disk share one shuffle, so --maxitems bounds all of them together
+    shared = None
+    if args.partition is not None and (args.stream or hashed) and not (hashed and args.n):
+        shared = dataio.PartitionedShuffle(args.seed, maxitems=args.maxitems, tmpdir=args.tmpdir)
+
+    def new_container(value=None):
+        if hashed and args.n:
+            return dataio.SmallestKeys(args.skip + args.n * args.s)
+        if shared is not None:
+            return shared.partition(value)
+        if args.stream or hashed:
+            # read and convert one chunk at a time and shuffle on disk, so only a bounded number of items is in memory
+            return dataio.ExternalShuffle(args.seed, maxitems=args.maxitems, tmpdir=args.tmpdir)
+        # this will contain the objects as we need them for the annotation (fields already selected/converted),
+        # already serialized to JSON
+        return []
+    # with --partition, a map from the value of the partition field to the container for the partition
+    objs = new_container() if args.partition is None else {}
+    if args.partition is None:
+        used[args.outpref] = load_used(args.outpref, args)
     if args.fmt == "jsonl":
-        with myopen(args.infile, "rt", encoding="utf8") as reader:
-            for line in reader:
-                n_in += 1
-                obj = json.loads(line)
-                objs.append(obj)
+        # the lines get parsed by prepare_chunk, so this can happen in the worker processes
+        reader = dataio.open_file(args.infile, "rt")
+        chunks = ((i*args.chunksize, chunk, True)
+                  for i, chunk in enumerate(dataio.iter_chunks((l for l in reader if l.strip()), args.chunksize)))
     elif args.fmt == "json":
-        with myopen(args.infile, "rt", encoding="utf8") as reader:
-            objs = json.load(reader)
-            n_in = len(objs)
+        reader = dataio.open_file(args.infile, "rt")
+        if args.stream:
+            objsread = dataio.iter_json_array(reader)
+        else:
+            with runutils.stage("read"):
+                objsread = json.load(reader)
+        chunks = ((i*args.chunksize, chunk, False)
+                  for i, chunk in enumerate(dataio.iter_chunks(objsread, args.chunksize)))
     else:
         raise Exception(f"Not a valid format: {args.fmt}")
 
-    objsread = objs
-    objs = []
-    n_non_en = 0
-    for idx, obj in enumerate(objsread):
-        obj = check(obj, idx)
-        if not obj:
-            n_skipped += 1
-        else:
-            # check if we got the correct language
-            if obj["Source_Lang"] != "en":
-                n_non_en += 1
-                n_skipped += 1
-                continue
-            obj = input2obj(obj, idx)
-            if not obj:
-                n_skipped += 1
-            else:
-                objs.append(obj)
+    # stage "read" is reading and parsing the input, stage "convert" checking and converting the items (or with
+    # several workers, waiting for them), stage "collect" keeping the converted items, for --stream this includes
+    # writing the sorted temporary files
+    chunks = runutils.timed_iter("read", chunks)
+    func = functools.partial(prepare_chunk, hasher=index.hasher if index is not None else None,
+                             lang=lang, partition=args.partition, withids=hashed or bool(args.dedup_index))
+    for raws, n_chunk, n_chunk_skipped, n_chunk_non_en, sigs, keys, ids in runutils.timed_iter(
+            "convert", runutils.imap_bounded(func, chunks, args.workers)):
+        n_in += n_chunk
+        n_skipped += n_chunk_skipped
+        n_non_en += n_chunk_non_en
+        if index is not None:
+            # the clusters depend on the order in which claims are seen, so this is done in input order here
+            with runutils.stage("dedup"):
+                kept = []
+                for i, (raw, sig) in enumerate(zip(raws, sigs)):
+                    # the clusters only get claimed once their representative has been written to a set
+                    cid, new = index.add(sig, claim=not args.dedup_index)
+                    if new and args.dedup_index:
+                        reps[ids[i]] = cid
+                    if args.dedup == "mark":
+                        raws[i] = dedup.add_cluster(raw, cid)
+                    if not new:
+                        n_dups += 1
+                    if new or args.dedup == "mark":
+                        kept.append(i)
+                raws = [raws[i] for i in kept]
+                keys = [keys[i] for i in kept] if keys is not None else None
+                ids = [ids[i] for i in kept] if ids is not None else None
+        with runutils.stage("collect"):
+            for i, raw in enumerate(raws):
+                if args.partition is not None:
+                    key = keys[i]
+                    if values is not None and key not in values:
+                        n_other += 1
+                        continue
+                    part = objs.get(key)
+                    if part is None:
+                        name = partition_name(key)
+                        if name in partnames.values():
+                            raise Exception(f"Partition values {key} and "
+                                            f"{[v for v, n in partnames.items() if n == name]} give the same file name")
+                        partnames[key] = name
+                        part = objs[key] = new_container(key)
+                        used[key] = load_used(args.outpref + "_" + name, args)
+                    usedids = used[key][1]
+                else:
+                    part = objs
+                    usedids = used[args.outpref][1]
+                if hashed:
+                    if ids[i] in usedids:
+                        n_used += 1
+                        continue
+                    part.add(raw, pipeline.rank_key(ids[i], args.seed) + ":" + ids[i])
+                elif args.stream:
+                    part.add(raw)
+                else:
+                    part.append(raw)
+    reader.close()
+    runutils.count("items_read", n_in)
+    runutils.count("items_skipped", n_skipped)
+    objsread = None
+    if index is not None:
+        runutils.count("items_duplicate", n_dups)
 
-    n_ok = len(objs)
-    # now shuffle the objects
-    random.seed(args.seed)
-    random.shuffle(objs)
-
-    if args.skip:
-        if args.skip < n_ok:
-            objs = objs[args.skip:]
-            logger.info(f"Skipping {args.skip}, got {len(objs)} remaining")
-        else:
-            logger.error(f"Not enough input data to skip {args.skip}, only have {n_ok}")
-            raise Exception("Not enough data")
-    n_considered = len(objs)
-    if n_considered < args.s:
-        logger.error(f"Got only {n_considered} items, cannot proceed to make at least one set of size {args.s}")
-        raise Exception("Not enough data")
-    # args.n: number of sets requested
-    # n: number of sets we take
-    if args.n:
-        if (args.n * args.s) > n_considered:
-            logger.error(f"Requested {args.n} sets, but only got {n_considered} items")
-            raise Exception("Not enough data")
-        n = args.n
-        nitems = args.n * args.s
-        remainder = objs[nitems:]
-        objs = objs[:nitems+1]
-    else:
-        n = int(n_considered / args.s)
-        nitems = n * args.s
-        remainder = objs[nitems:]
-        objs = objs[:nitems+1]
-    logger.info(f"Creating {n} sets of size {args.s}, total of {nitems} items")
+    def claim(raws):
+        for raw in raws:
+            cid = reps.get(raw_item_id(raw))
+            if cid is not None:
+                index.claim(cid)
+    onset = claim if args.dedup_index else None
 
-    n_total = 0
-    for setnr in range(n):
-        fromidx = int(setnr*args.s)
-        toidx = int(fromidx + args.s )
-        # logger.info(f"DEBUG: trying to get indices {fromidx} to {toidx}")
-        items = objs[fromidx:toidx]
-        fname = args.outpref + "_" + f"set{setnr:03d}" + ".json"
-        n_total = n_total + len(items)
-        # add the assignment index as a field
-        for item in items:
-            item["assigned"] = []
-        with open(fname, "wt", encoding="utf8") as outfp:
-            json.dump(items, outfp)
-            logger.info(f"Wrote file {fname} containing {len(items)} items")
-    # OK on second thought, also output anything that may be left over
-    for item in remainder:
-        item["assigned"] = []
-    fname = args.outpref + "_" + f"remaining" + ".json"
-    with open(fname, "wt", encoding="utf8") as outfp:
-        json.dump(remainder, outfp)
-        logger.info(f"Wrote file {fname} containing remaining {len(remainder)} items")
+    writers = dataio.WriterPool(args.writers)
+    if args.partition is None:
+        n, n_total, n_remaining = write_sets(objs, args.outpref, args, writers, old=used[args.outpref][0],
+                                             onset=onset)
+        n_ok = len(objs)
+    else:
+        n, n_total, n_remaining = 0, 0, 0
+        n_ok = sum(len(o) for o in objs.values())
+        record = {"field": args.partition, "partitions": {}}
+        for value in sorted(objs):
+            outpref = args.outpref + "_" + partnames[value]
+            logger.info(f"Partition {args.partition}={value}: {len(objs[value])} items, prefix {outpref}")
+            n_part, n_part_total, n_part_remaining = write_sets(objs[value], outpref, args, writers, strict=False,
+                                                                old=used[value][0], onset=onset)
+            record["partitions"][value] = {"prefix": os.path.basename(outpref), "items": len(objs[value]),
+                                           "sets": n_part, "items_in_sets": n_part_total, "remaining": n_part_remaining}
+            n += n_part
+            n_total += n_part_total
+            n_remaining += n_part_remaining
+        with dataio.atomic_open(args.outpref + PARTITIONS, "wt") as outfp:
+            json.dump(record, outfp)
+        logger.info(f"Created {len(objs)} partitions by {args.partition}, see {args.outpref + PARTITIONS}")
+    with runutils.stage("write"):
+        writers.close()
+    if index is not None and args.dedup_index:
+        index.save(args.dedup_index)
+        logger.info(f"Near-duplicate index with {len(index)} clusters ({sum(index.claimed)} claimed) "
+                    f"saved to {args.dedup_index}")
+    runutils.count("items_written", n_total + n_remaining)
+    if args.stream or hashed:
+        for o in (objs.values() if args.partition is not None else [objs]):
+            o.close()
+        if shared is not None:
+            shared.close()
 
     logger.info(f"Total number of items read:    {n_in}")
     logger.info(f"Number of items skipped:       {n_skipped}")
-    logger.info(f"       of which non-en:        {n_non_en}")
+    logger.info(f"       of which non-{lang}:        {n_non_en}" if lang else f"       of which other language: {n_non_en}")
+    if args.partition is not None:
+        logger.info(f"Number of items not in --values: {n_other}")
+        logger.info(f"Number of partitions:          {len(objs)}")
+    if index is not None:
+        logger.info(f"Number of near-duplicates:     {n_dups}" + (", dropped" if args.dedup == "drop" else ""))
+    if args.extend:
+        logger.info(f"Number of items already in sets: {n_used}")
     logger.info(f"Number of items ok:            {n_ok}")
     logger.info(f"Number of sets created:        {n}")
     logger.info(f"Number of items in all sets:   {n_total}")
-    logger.info(f"Number of items in remaining:  {len(remainder)}")
-    logger.info(f"Number of items total:         {len(remainder)+n_total}")
+    logger.info(f"Number of items in remaining:  {n_remaining}")
+    logger.info(f"Number of items total:         {n_remaining+n_total}")
     runutils.run_stop()
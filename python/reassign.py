@@ -4,16 +4,67 @@ Program to re-assign already annotated items to a new set of annotators.
 This reads in the retrieved annotations from several annotators, combines them and assigns to
 a list of annotators, trying to allocate the same number of items to each randomly, without
 assigning an item to the same annotator twice.
+The input files can be JSON files or columnar stores (.cols), from both only the "assigned" field gets read
+(see dataio.LazyItems), except for the items which get written to the output. Compressed JSON files get read completely.
+With --redundancy r, each item is instead given to exactly r of the annotators which have not seen it, and all
+annotators get the same number of items (or one more) where the items already seen permit it, see
+pipeline.assign_balanced. With --capacity, annotators get at most that many items, then not all items may get assigned.
+With --ledger FILE, the annotators which have already seen an item are also looked up in the ledger written by
+retrieve-annotated.py --ledger (see ledger.py) by the id of the item, so annotators from all earlier rounds are
+known even if their files are not among the input files. The field "item_id" then also gets read, items without it
+are read completely to compute their id.
 """
 
-import json
+import os
 import argparse
 import runutils
+import dataio
+import colstore
+import pipeline
+import ledger
 import random
-import sys
+import itertools
 from collections import defaultdict, Counter
 
 
+def get_assigned(source, row):
+    """
+    Get the list of annotators an object has already been assigned to.
+    :param source: list of objects or columnar store
+    :param row: index of the object in the source
+    :return: list of annotator ids
+    """
+    if isinstance(source, (colstore.Store, dataio.LazyItems)):
+        return source.assigned(row)
+    return source[row].get("assigned", [])
+
+
+def get_item_id(source, row):
+    """
+    Get the id of an object (see pipeline.get_id). The complete object only gets read if it has no field item_id.
+    :param source: list of objects or columnar store
+    :param row: index of the object in the source
+    :return: the item id
+    """
+    if isinstance(source, dataio.LazyItems):
+        return source.kept(row).get("item_id") or pipeline.get_id(source.item(row))
+    if isinstance(source, colstore.Store):
+        return source.payload(row).get("item_id") or pipeline.get_id(source.item(row))
+    return pipeline.get_id(source[row])
+
+
+def get_item(source, row):
+    """
+    Get a copy of an object, that can be changed without changing the source.
+    :param source: list of objects or columnar store
+    :param row: index of the object in the source
+    :return: the object
+    """
+    if isinstance(source, (colstore.Store, dataio.LazyItems)):
+        return source.item(row)
+    return source[row].copy()
+
+
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
@@ -21,91 +72,85 @@ if __name__ == "__main__":
     parser.add_argument("--outpref", required=True, help="Output file prefix")
     parser.add_argument("--annotators", nargs="+", type=int, help="List of annotator ids to assign to")
     parser.add_argument("--seed", type=int, default=42, help="Random seed (default: 42)")
+    parser.add_argument("--cols", action="store_true", help="Save the sets as columnar stores (.cols) instead of JSON")
+    parser.add_argument("--redundancy", type=int, default=None,
+                        help="Give each item to exactly this many annotators, with balanced numbers of items per annotator")
+    parser.add_argument("--capacity", type=int, default=None,
+                        help="With --redundancy, maximum number of items per annotator")
     parser.add_argument("-d", action="store_true", help="Debug")
+    parser.add_argument("--ledger", type=str, default=None,
+                        help="Also take the annotators which have seen an item from this ledger (see ledger.py)")
+    runutils.add_metrics_args(parser)
     args = parser.parse_args()
+    if args.ledger is not None and not os.path.exists(args.ledger):
+        parser.error(f"ledger {args.ledger} does not exist")
 
     logger = runutils.set_logger(args)
     runutils.run_start()
     random.seed(args.seed)
 
-    # for each of the new annotator ids, store which object idxs have already been annotated by them
-    per_annid = {}
-    for annid in args.annotators:
-        per_annid[annid] = set()
     # also keep track of how items get assigned from annotator to annotator
     old2new = defaultdict(Counter)
     new4old = defaultdict(Counter)
 
-    # each object is added to this list and uniquely identified by the index in it
+    # each object is added to this list and uniquely identified by the index in it: the entries are tuples
+    # (index of the source, index of the object in the source), where a source is either the list of objects
+    # read from a JSON file or a columnar store, of which only the "assigned" field gets read
     all = []
+    sources = []
     n_total = 0
     # First of all, read all objects from all the input files
-    for infile in args.infiles:
-        with open(infile, "rt", encoding="utf8") as reader:
-            objs = json.load(reader)
-            n_in = len(objs)
+    with runutils.stage("read"):
+        for infile in args.infiles:
+            if colstore.is_store(infile):
+                source = colstore.Store(infile)
+            elif os.path.exists(infile) and dataio.strip_compression(infile) == infile:
+                source = dataio.LazyItems(infile, ["assigned", "item_id"] if args.ledger else ["assigned"])
+            else:
+                source = dataio.load_items(infile)
+            n_in = len(source)
             n_total += n_in
             logger.info(f"Loaded {n_in} items from {infile}")
-            for obj in objs:
-                all.append(obj)
+            runutils.count("items_read", n_in)
+            all.extend((len(sources), row) for row in range(n_in))
+            sources.append(source)
     # reshuffle the list of objects
-    random.shuffle(all)
+    with runutils.stage("shuffle"):
+        random.shuffle(all)
+        assigned_all = [get_assigned(sources[srcidx], row) for srcidx, row in all]
+    if args.ledger is not None:
+        with runutils.stage("ledger"), ledger.Ledger(args.ledger) as led:
+            n_more = 0
+            for i, (srcidx, row) in enumerate(all):
+                seen = led.assigned(get_item_id(sources[srcidx], row))
+                more = [a for a in seen if a not in assigned_all[i]]
+                if more:
+                    assigned_all[i] = assigned_all[i] + more
+                    n_more += 1
+        logger.info(f"Items with more annotators from ledger {args.ledger}: {n_more}")
 
     # store all the indices of objects already seen by each of the new annotators
-    for idx, obj in enumerate(all):
-        assigned = obj["assigned"]
-        for a in assigned:
-            if a in per_annid:
-                per_annid[a].add(idx)
+    per_annid = pipeline.seen_by(assigned_all, args.annotators)
     for annid,v in per_annid.items():
         logger.info(f"Items already seen by annotator {annid}: {len(v)}")
         logger.debug(f"Items ids seen by {annid}: {per_annid[annid]}")
     # Try to assign items in a round robin fashion randomly to each annotator
     # We want to choose for each annotator from all the items not already assigned to it and
-    # once we have assigned an item, remove it from all the lists available to each annotator
-    # Let's not be clever about this and brute force this: build the list available to an annotator each time we need it
-    new_forann = {}
-    for annid in args.annotators:
-        new_forann[annid] = []
-    iterations = 0
-    while(True):
-        iterations += 1
-        logger.debug(f"Doing a new round: {iterations}")
-        added = 0
-        for annid in args.annotators:
-            logger.debug(f"Assigning to annotator {annid}")
-            available = []
-            availableidxs = []
-            logger.debug(f"Already used for {annid}: {per_annid[annid]}")
-            for idx, obj in enumerate(all):
-                if idx not in per_annid[annid]:
-                    available.append(obj)
-                    availableidxs.append(idx)
-            logger.debug(f"Found available: {availableidxs}")
-            if len(available) == 0:
-                logger.debug("Nothing available not doing anything for this annotator")
+    # once we have assigned an item, remove it from what is available to every annotator: the pool
+    # takes care of this without re-building the list of available items for each draw
+    with runutils.stage("assign"):
+        if args.redundancy is None:
+            new_forann = pipeline.assign_round_robin(assigned_all, args.annotators)
+        else:
+            new_forann = pipeline.assign_balanced(assigned_all, args.annotators, args.redundancy, args.capacity)
+    # count in the order of the rounds of assignment
+    for idxs in itertools.zip_longest(*new_forann.values()):
+        for annid, idx in zip(new_forann, idxs):
+            if idx is None:
                 continue
-            i = random.randint(0, len(availableidxs)-1)
-            idx = availableidxs[i]
-            obj = available[i]
-            logger.debug(f"Randomly chosen {idx} out of {availableidxs}")
-            # we need a copy of the object so we do not mess up the assigned status for everyone else!
-            objcopy = obj.copy()
-            assigneds = ",".join([str(x) for x in objcopy.get("assigned", ["NA"])])
+            assigneds = ",".join([str(x) for x in assigned_all[idx]])
             old2new[assigneds][annid] += 1
             new4old[annid][assigneds] += 1
-            objcopy["assigned"].append(annid)
-            new_forann[annid].append(idx)
-            for a in args.annotators:
-                per_annid[a].add(idx)
-            added += 1
-        logger.debug(f"End of round {iterations}: added={added}")
-        for annid in args.annotators:
-            logger.debug(f"Assigned to {annid} now: {new_forann[annid]}")
-        if added == 0:
-            break
-        #if iterations == 2:
-        #    break
     for annid in args.annotators:
         logger.info(f"Nr items assigned to new {annid} from old: {dict(new4old[annid])}")
     for annid in old2new.keys():
@@ -113,12 +158,19 @@ if __name__ == "__main__":
     for annid in args.annotators:
         logger.info(f"Items assigned to annotator {annid}: {len(new_forann[annid])}")
         logger.debug(f"Item ids: {new_forann[annid]}")
-        filename = args.outpref + f"_ann{annid:02d}.json"
-        with open(filename, "wt", encoding="utf8") as outfp:
+        filename = args.outpref + f"_ann{annid:02d}" + (".cols" if args.cols else ".json")
+        with runutils.stage("write"):
             objs = []
             for idx in new_forann[annid]:
-                objs.append(all[idx])
-            json.dump(objs, outfp)
+                srcidx, row = all[idx]
+                obj = get_item(sources[srcidx], row)
+                obj["assigned"] = assigned_all[idx] + [annid]
+                objs.append(obj)
+            dataio.save_items(filename, objs)
+        runutils.count("items_written", len(objs))
         logger.info(f"Set for annotator {annid} saved to {filename}")
+    for source in sources:
+        if isinstance(source, dataio.LazyItems):
+            source.close()
 
     runutils.run_stop()
\ No newline at end of file
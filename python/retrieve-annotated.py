@@ -7,101 +7,466 @@ annN_label: label assigned
 annN_conf: confidence
 annN_remarks: list of remarks
 where the N in the field name is always two digits, e.g. ann02_label or ann13_conf
+Completion files are read by a pool of threads. Next to the output file, a manifest with the modification
+time and size of each completion file is stored: when retrieving again to the same output file, only
+completion files which are new or have changed since then are read, everything else is taken from the
+previous output file (use --nocache to re-read everything).
+With --batch, all project directories created by prepare-labelstudio.py for a directory prefix are retrieved
+at once, in parallel worker processes, and a single summary of missing annotations is shown. If any project fails,
+the others are still saved, but the program exits with status 1 and, unless --allow-partial is given, the combined
+file is not written and nothing is added to the ledger.
+If an output file name has the extension .cols, the items are saved as a columnar store (see colstore.py).
+The fields annN_created and annN_leadtime keep the time the completion was created and the seconds spent on it.
+With --report FILE, the throughput and latency of each annotator are calculated from these, in the same pass:
+items per hour of active time, lead time percentiles, idle gaps (longer than --idle seconds) and, from the number
+of tasks in the project, the projected time needed for the rest (see pipeline.throughput). This is logged and
+saved to the report file.
+With --http, the annotations are not read from the project directories but pulled from the running label-studio
+servers, all at the same time (see lshttp.py): the server of annotator N is expected on port -p + N of the host
+given instead of the project directory, --server N=HOST:PORT gives the server of an annotator explicitly. The
+exported tasks are converted in the same way as the completion files.
+With --ledger FILE --round R, the label, confidence and assigned annotators of each retrieved item are also appended
+to the ledger of all rounds (see ledger.py), annotations which are already there unchanged are not added again.
 """
 
 import json
+import time
+import datetime
 import argparse
 import runutils
 import glob
 import os
+import concurrent.futures
+import sys
+import dataio
+import pipeline
+import lshttp
+import ledger
 
-def get_result_value(result):
+# the manifest of which completion files have been converted is stored in a file with this added to the output file name
+MANIFEST_EXT = ".manifest.json"
+# items converted by an older version do not have all fields, so their manifest is not used
+MANIFEST_VERSION = 2
+
+def load_and_convert(file, annnr):
     """
-    Retrieve the result value from a result object, but make sure we either return the only value set
-    or an empty string if the object is not what we expect.
-    :param result:
-    :return:
+    Read and convert a single completion file. This is run in the threads of the thread pool.
+    :param file: completion file path
+    :param annnr: annotator number
+    :return: a tuple (converted item or None, None or the exception if the file could not be converted)
     """
-    value = result.get("value")
-    if value is None:
-        return ""
-    choices = value.get("choices")
-    if choices is None:
-        return ""
-    if len(choices) == 0:
-        return ""
-    return choices[0]
+    try:
+        with open(file, "rt", encoding="utf8") as infp:
+            item = json.load(infp)
+        return pipeline.convert(item, annnr, file), None
+    except Exception as e:
+        return None, e
 
 
-def convert(item, annnr, file):
+def load_manifest(outfile, annnr):
+    """
+    Load the manifest and the data from a previous run which wrote to the same output file, if there is one.
+    :param outfile: the output file
+    :param annnr: annotator number, the manifest is only used if it was created for the same annotator
+    :return: a tuple (map from file path to manifest entry, list of items), both empty if there is nothing to reuse
+    """
     logger = runutils.ensurelogger()
-    newitem = {}
-    newitem.update(item["data"])
-    # make sure the fields for the annotator are not already there
-    if newitem.get(f"ann{annnr:02d}_label") is not None:
-        logger.error("Annotation from annotator {annnr} for label already present!")
-        raise Exception("ERROR")
-    if newitem.get(f"ann{annnr:02d}_conf") is not None:
-        logger.error("Annotation from annotator {annnr} for conf already present!")
-        raise Exception("ERROR")
-    if newitem.get(f"ann{annnr:02d}_remarks") is not None:
-        logger.error("Annotation from annotator {annnr} for remarks already present!")
+    mfile = outfile + MANIFEST_EXT
+    if not os.path.exists(mfile) or not dataio.item_paths(outfile):
+        return {}, []
+    with open(mfile, "rt", encoding="utf8") as infp:
+        manifest = json.load(infp)
+    if manifest.get("annnr") != annnr:
+        logger.warning(f"Manifest {mfile} is for annotator {manifest.get('annnr')}, not using it")
+        return {}, []
+    if manifest.get("version", 1) != MANIFEST_VERSION:
+        logger.info(f"Manifest {mfile} was written by an older version, not using it")
+        return {}, []
+    data = dataio.load_items(outfile)
+    return manifest["files"], data
+
+
+def retrieve(indir, outfile, annnr, nocache=False, threads=8, idle=None, now=None, shard=None):
+    """
+    Retrieve all the annotations from one project directory and save them to the output file.
+    :param indir: project directory
+    :param outfile: output file
+    :param annnr: annotator number
+    :param nocache: if True, do not re-use anything from a previous run for the same output file
+    :param threads: number of threads for reading completion files
+    :param idle: if not None, add the throughput (see pipeline.throughput) with this idle gap to the summary
+    :param now: with idle, the time from which to project the completion
+    :param shard: if not None, save the items in shards of this many items (see dataio.save_items)
+    :return: a tuple (list of retrieved items, summary map)
+    """
+    logger = runutils.ensurelogger()
+    completions = os.path.join(indir, "completions")
+    completionspat = completions + "/*.json"
+    with runutils.stage("scan"):
+        files = sorted(glob.glob(completionspat))
+    logger.info(f"Found {len(files)} annotations in {indir}")
+    if len(files) == 0:
+        logger.error(f"No annotations found in {indir}!")
         raise Exception("ERROR")
-    newitem[f"ann{annnr:02d}_label"] = ""
-    newitem[f"ann{annnr:02d}_conf"] = ""
-    newitem[f"ann{annnr:02d}_remarks"] = ""
-    compls = item.get("completions")
-    if compls is None or len(compls) == 0:
-        logger.info(f"No completions in file {file}, setting everything to missing")
-        return newitem
-    elif len(compls) > 1:
-        logger.info(f"More than one completion in file {file} ({len(compls)}), using first")
-    compl = compls[0]
-    # now get the actual annotation data:
-    results = compl.get("result")
-    if results is None or len(results) == 0:
-        logger.info(f"No result in file {file}, setting everything to missing")
-        return newitem
-    # process the results
-    for result in results:
-        name = result.get("from_name")
-        if name == "label":
-            newitem[f"ann{annnr:02d}_label"] = get_result_value(result)
-        if name == "rating":
-            newitem[f"ann{annnr:02d}_conf"] = get_result_value(result)
-        if name == "remark":
-            newitem[f"ann{annnr:02d}_remarks"] = "|".join(result["value"]["text"])
-    return newitem
+    if nocache:
+        oldfiles, olddata = {}, []
+    else:
+        with runutils.stage("load_previous"):
+            oldfiles, olddata = load_manifest(outfile, annnr)
+    # find the files which are new or changed since the last run, for all others re-use the converted item
+    stats = {}
+    toread = []
+    with runutils.stage("scan"):
+        for file in files:
+            st = os.stat(file)
+            stats[file] = {"mtime": st.st_mtime_ns, "size": st.st_size}
+            old = oldfiles.get(file)
+            if old is None or old["pos"] is None or old["mtime"] != st.st_mtime_ns or old["size"] != st.st_size:
+                toread.append(file)
+    logger.info(f"Completion files unchanged: {len(files)-len(toread)}, new or changed: {len(toread)}")
+    with runutils.stage("read"):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+            converted = dict(zip(toread, executor.map(lambda f: load_and_convert(f, annnr), toread)))
+    runutils.count("files_read", len(toread))
+    runutils.count("files_reused", len(files) - len(toread))
+    data = []
+    newfiles = {}
+    n_ignored = 0
+    for file in files:
+        if file in converted:
+            item, e = converted[file]
+            if e is not None:
+                logger.warning(f"Ignoring file {file} because of {e}")
+                newfiles[file] = dict(stats[file], pos=None)
+                n_ignored += 1
+                continue
+        else:
+            item = olddata[oldfiles[file]["pos"]]
+        newfiles[file] = dict(stats[file], pos=len(data))
+        data.append(item)
+    with runutils.stage("write"):
+        dataio.save_items(outfile, data, shard=shard)
+        with dataio.atomic_open(outfile + MANIFEST_EXT, "wt") as outfp:
+            json.dump({"version": MANIFEST_VERSION, "annnr": annnr, "files": newfiles}, outfp)
+    runutils.count("files_ignored", n_ignored)
+    runutils.count("items_written", len(data))
+    logger.info(f"Saved to file {outfile}")
+    summary = {
+        "annnr": annnr, "indir": indir, "outfile": outfile, "files": len(files), "ignored": n_ignored,
+        "items": len(data),
+        "nolabel": sum(1 for item in data if not item[f"ann{annnr:02d}_label"]),
+        "noconf": sum(1 for item in data if not item[f"ann{annnr:02d}_conf"]),
+    }
+    if idle is not None:
+        with runutils.stage("throughput"):
+            summary["throughput"] = pipeline.throughput(data, annnr, pipeline.count_tasks(indir), idle, now)
+    return data, summary
+
+
+def convert_tasks(tasks, annnr, source):
+    """
+    Convert the tasks exported by a label-studio server, like the completion files in retrieve.
+    :param tasks: list of tasks
+    :param annnr: annotator number
+    :param source: the URL of the export, for the log messages
+    :return: a tuple (list of items, number of tasks ignored)
+    """
+    logger = runutils.ensurelogger()
+    data = []
+    n_ignored = 0
+    for task in tasks:
+        name = f"{source}#{task.get('id') if isinstance(task, dict) else None}"
+        try:
+            data.append(pipeline.convert(task, annnr, name))
+        except Exception as e:
+            logger.warning(f"Ignoring task {name} because of {e}")
+            n_ignored += 1
+    return data, n_ignored
+
+
+def retrieve_http(servers, outfiles, export=lshttp.DEFAULT_EXPORT, timeout=60.0, retries=3, idle=None, now=None,
+                  shard=None):
+    """
+    Pull the tasks from the label-studio servers of several annotators at the same time, convert them and save
+    the items of each annotator.
+    :param servers: list of tuples (annotator number, host, port)
+    :param outfiles: map from annotator number to output file
+    :param export: the path of the export on the servers
+    :param timeout: seconds for each attempt for a server
+    :param retries: number of retries for a server
+    :param idle: if not None, add the throughput (see pipeline.throughput) with this idle gap to the summaries
+    :param now: with idle, the time from which to project the completion
+    :param shard: if not None, save the items in shards of this many items (see dataio.save_items)
+    :return: list of tuples (list of items or None, summary map), if retrieval failed the summary contains "error"
+    """
+    logger = runutils.ensurelogger()
+    with runutils.stage("fetch"):
+        fetched = lshttp.fetch_all(servers, export, timeout=timeout, retries=retries)
+    results = []
+    for (annnr, host, port), (_, tasks, error, seconds) in zip(servers, fetched):
+        source = lshttp.url(host, port, export)
+        outfile = outfiles[annnr]
+        if error is not None:
+            logger.error(f"Could not get the tasks from {source}: {error}")
+            results.append((None, {"annnr": annnr, "indir": source, "outfile": outfile, "error": error}))
+            continue
+        logger.info(f"Got {len(tasks)} tasks from {source} in {seconds:.3f}s")
+        runutils.count("tasks_fetched", len(tasks))
+        with runutils.stage("convert"):
+            data, n_ignored = convert_tasks(tasks, annnr, source)
+        with runutils.stage("write"):
+            # the manifest of an earlier retrieval from the project directory maps the completion files to the
+            # positions of the items in that output, which do not match these items, so it is removed first
+            if os.path.exists(outfile + MANIFEST_EXT):
+                os.remove(outfile + MANIFEST_EXT)
+            dataio.save_items(outfile, data, shard=shard)
+        runutils.count("files_ignored", n_ignored)
+        runutils.count("items_written", len(data))
+        logger.info(f"Saved to file {outfile}")
+        summary = {
+            "annnr": annnr, "indir": source, "outfile": outfile, "files": len(tasks), "ignored": n_ignored,
+            "items": len(data),
+            "nolabel": sum(1 for item in data if not item[f"ann{annnr:02d}_label"]),
+            "noconf": sum(1 for item in data if not item[f"ann{annnr:02d}_conf"]),
+        }
+        if idle is not None:
+            with runutils.stage("throughput"):
+                summary["throughput"] = pipeline.throughput(data, annnr, None, idle, now)
+        results.append((data, summary))
+    return results
+
+
+def append_ledger(path, round, results):
+    """
+    Append the retrieved annotations to the ledger.
+    :param path: ledger file
+    :param round: round number
+    :param results: list of tuples (list of items or None, summary map) as returned by retrieve_project
+    """
+    logger = runutils.ensurelogger()
+    n = 0
+    with runutils.stage("ledger"), ledger.Ledger(path) as led:
+        for data, summary in results:
+            if data is not None and "error" not in summary:
+                n += led.append(ledger.records_from_items(data, summary["annnr"], round))
+        n_items = len(led)
+    runutils.count("ledger_appended", n)
+    logger.info(f"Appended {n} new or changed annotations for round {round} to ledger {path} ({n_items} items)")
+
+
+def retrieve_project(task):
+    """
+    Retrieve one project in batch mode, this runs in the worker processes.
+    :param task: a tuple (indir, outfile, annnr, nocache, threads, flag if the data should be returned, idle, now,
+        shard), see retrieve
+    :return: a tuple (retrieved items or None, summary map), if retrieval failed the summary contains "error",
+        the metrics collected for this project are in the summary under "metrics"
+    """
+    indir, outfile, annnr, nocache, threads, withdata, idle, now, shard = task
+    saved = runutils.reset_metrics()
+    try:
+        data, summary = retrieve(indir, outfile, annnr, nocache=nocache, threads=threads, idle=idle, now=now,
+                                 shard=shard)
+    except Exception as e:
+        data, summary = None, {"annnr": annnr, "indir": indir, "outfile": outfile, "error": str(e)}
+    summary["metrics"] = runutils.reset_metrics(saved)
+    return (data if withdata else None), summary
+
+
+def timestr(seconds):
+    """
+    Format seconds since the epoch as local time for logging, or "-" for None.
+    """
+    if seconds is None:
+        return "-"
+    return datetime.datetime.fromtimestamp(seconds).strftime("%Y-%m-%d %H:%M")
+
+
+def fmt(value, spec=".1f"):
+    """
+    Format a number for logging, or "-" for None.
+    """
+    return "-" if value is None else format(value, spec)
+
+
+def report(summaries, idle, now, outfile):
+    """
+    Log the throughput of each annotator and the totals and save everything to the report file.
+    :param summaries: the summaries returned by retrieve which contain "throughput"
+    :param idle: the idle gap used
+    :param now: the time the projection starts from
+    :param outfile: report file
+    """
+    logger = runutils.ensurelogger()
+    tps = [s["throughput"] for s in summaries if "throughput" in s]
+    for tp in tps:
+        lt = tp["leadtime"] or {}
+        logger.info(f"Annotator {tp['annnr']:02d}: {tp['completed']} completed, {fmt(tp['remaining'], 'd')} remaining, "
+                    f"{fmt(tp['items_per_hour'])} items/hour in {fmt(tp['active_hours'], '.2f')}h active, "
+                    f"lead time p50/p90/p99 {fmt(lt.get('p50'))}/{fmt(lt.get('p90'))}/{fmt(lt.get('p99'))}s, "
+                    f"{tp['idle_gaps']} idle gaps ({fmt(tp['idle_hours'], '.2f')}h, longest {fmt(tp['longest_gap_hours'], '.2f')}h), "
+                    f"last {timestr(tp['last'])}, projected {fmt(tp['projected_hours'], '.2f')}h "
+                    f"until {timestr(tp['projected_finish'])}")
+    rates = [tp["items_per_hour"] for tp in tps if tp["items_per_hour"] is not None]
+    finishes = [tp["projected_finish"] for tp in tps if tp["projected_finish"] is not None]
+    remaining = [tp["remaining"] for tp in tps if tp["remaining"] is not None]
+    total = {
+        "completed": sum(tp["completed"] for tp in tps),
+        "remaining": sum(remaining) if remaining else None,
+        "items_per_hour": sum(rates) if rates else None,
+        "projected_finish": max(finishes) if len(finishes) == len(tps) and finishes else None,
+    }
+    logger.info(f"Total: {total['completed']} completed, {fmt(total['remaining'], 'd')} remaining, "
+                f"{fmt(total['items_per_hour'])} items/hour for all annotators, "
+                f"all projected to be done {timestr(total['projected_finish'])}")
+    with dataio.atomic_open(outfile, "wt") as outfp:
+        json.dump({"idle": idle, "now": now, "annotators": tps, "total": total}, outfp)
+    logger.info(f"Report saved to {outfile}")
 
 
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("indir", help="Project directory")
-    parser.add_argument("outfile", help="Output json file file (should have extension .json) and use proper name pattern")
-    parser.add_argument("annnr", type=int, help="Annotator number of this project")
+    parser.add_argument("indir", help="Project directory, or project directory prefix with --batch")
+    parser.add_argument("outfile", help="Output json file file (should have extension .json) and use proper name pattern, "
+                                        "or output file prefix with --batch")
+    parser.add_argument("annnr", type=int, nargs="?", help="Annotator number of this project (not used with --batch)")
+    parser.add_argument("--nocache", action="store_true",
+                        help="Re-read all completion files, even if unchanged since the last run for the same output file")
+    parser.add_argument("--threads", type=int, default=8, help="Number of threads for reading completion files (8)")
+    parser.add_argument("--batch", action="store_true",
+                        help="Retrieve all projects indir_N, annotator N is saved to outfile_annNN.json")
+    parser.add_argument("--workers", type=int, default=4, help="With --batch, number of worker processes (4)")
+    parser.add_argument("--combined", type=str, default=None,
+                        help="With --batch, also save all retrieved items from all projects to this file")
+    parser.add_argument("--allow-partial", action="store_true",
+                        help="With --batch, save the combined file and add to the ledger even if some projects failed")
+    parser.add_argument("--cols", action="store_true",
+                        help="With --batch, save as columnar stores outfile_annNN.cols instead of JSON")
+    parser.add_argument("--report", type=str, default=None,
+                        help="Save the throughput and latency of each annotator to this JSON file")
+    parser.add_argument("--idle", type=float, default=1800.0,
+                        help="With --report, gaps between completions longer than this many seconds are idle time (1800)")
+    parser.add_argument("--compress", type=str, default=None, choices=dataio.COMPRESS_CHOICES,
+                        help="With --batch, compress the output files with this compressor (no compression)")
+    parser.add_argument("--shard", type=int, default=None,
+                        help="Save outputs with more items in several files of this many items (one file)")
+    parser.add_argument("--http", action="store_true",
+                        help="Pull the tasks from the running label-studio servers on the host given as indir")
+    parser.add_argument("-p", type=int, default=9000,
+                        help="With --http, port number of the server of annotator 0, annotator N uses port + N (9000)")
+    parser.add_argument("--annotators", nargs="+", type=int, default=[],
+                        help="With --http and --batch, the annotator numbers of the servers to pull from")
+    parser.add_argument("--server", nargs="+", default=[],
+                        help="With --http, the server of an annotator as N=HOST:PORT, e.g. 3=otherhost:9003")
+    parser.add_argument("--export", type=str, default=lshttp.DEFAULT_EXPORT,
+                        help=f"With --http, the path of the export on the servers ({lshttp.DEFAULT_EXPORT})")
+    parser.add_argument("--timeout", type=float, default=60.0,
+                        help="With --http, seconds to wait for each attempt to get the export of a server (60)")
+    parser.add_argument("--retries", type=int, default=3,
+                        help="With --http, number of times to retry a server after a failed attempt (3)")
+    parser.add_argument("--ledger", type=str, default=None,
+                        help="Also append the retrieved annotations to this ledger file (see ledger.py)")
+    parser.add_argument("--round", type=int, default=None, help="With --ledger, the number of the annotation round")
+    runutils.add_metrics_args(parser)
     args = parser.parse_args()
+    if args.ledger is not None and args.round is None:
+        parser.error("--round is required with --ledger")
 
     logger = runutils.set_logger(args)
     runutils.run_start()
+    idle = args.idle if args.report else None
+    now = time.time()
 
-    completions = os.path.join(args.indir, "completions")
-    completionspat = completions + "/*.json"
-    files = glob.glob(completionspat)
-    logger.info(f"Found {len(files)} annotations")
-    if len(files) == 0:
-        logger.error("No annotations found!")
-        raise Exception("ERROR")
-    data = []
-    for file in files:
-        with open(file, "rt", encoding="utf8") as infp:
-            item = json.load(infp)
-            try:
-                item = convert(item, args.annnr, file)
-                data.append(item)
-            except Exception as e:
-                logger.warn(f"Ignoring file {infp.name} because of {e}")
-    with open(args.outfile, "wt", encoding="utf8") as outfp:
-        json.dump(data, outfp)
-    logger.info(f"Saved to file {args.outfile}")
+    if args.http:
+        # the servers of the annotators, annotator N on port -p + N of the host unless given with --server
+        servers = {}
+        for annnr in ([] if args.batch else [args.annnr]) + args.annotators:
+            if annnr is None:
+                parser.error("the annotator number is required unless --batch is used")
+            servers[annnr] = (annnr, args.indir, args.p + annnr)
+        for spec in args.server:
+            annnr, _, hostport = spec.partition("=")
+            servers[int(annnr)] = (int(annnr), *lshttp.parse_server(hostport))
+        if not args.batch and len(servers) != 1:
+            parser.error("without --batch, only the server of one annotator can be used")
+        if not servers:
+            parser.error("with --http and --batch, --annotators or --server is required")
+        servers = [servers[annnr] for annnr in sorted(servers)]
+        ext = ".cols" if args.cols else dataio.add_compression(".json", args.compress)
+        outfiles = {annnr: (args.outfile + f"_ann{annnr:02d}" + ext if args.batch else args.outfile)
+                    for annnr, _, _ in servers}
+        logger.info(f"Pulling the tasks from {len(servers)} servers: "
+                    f"{', '.join(f'{annnr}={host}:{port}' for annnr, host, port in servers)}")
+        results = retrieve_http(servers, outfiles, args.export, args.timeout, args.retries, idle, now, args.shard)
+        if not args.batch:
+            if "error" in results[0][1]:
+                raise Exception("ERROR")
+            if args.ledger is not None:
+                append_ledger(args.ledger, args.round, results)
+            if args.report:
+                report([results[0][1]], idle, now, args.report)
+            runutils.run_stop()
+            sys.exit(0)
+    elif not args.batch:
+        if args.annnr is None:
+            parser.error("the annotator number is required unless --batch is used")
+        data, summary = retrieve(args.indir, args.outfile, args.annnr, nocache=args.nocache, threads=args.threads,
+                                 idle=idle, now=now, shard=args.shard)
+        if args.ledger is not None:
+            append_ledger(args.ledger, args.round, [(data, summary)])
+        if args.report:
+            report([summary], idle, now, args.report)
+        runutils.run_stop()
+        sys.exit(0)
+
+    if not args.http:
+        projects = pipeline.find_projects(args.indir)
+        logger.info(f"Found {len(projects)} projects for prefix {args.indir}: {[d for _, d in projects]}")
+        if len(projects) == 0:
+            logger.error("No projects found!")
+            raise Exception("ERROR")
+        ext = ".cols" if args.cols else dataio.add_compression(".json", args.compress)
+        tasks = [(d, args.outfile + f"_ann{annnr:02d}" + ext, annnr, args.nocache, args.threads,
+                  args.combined is not None or args.ledger is not None, idle, now, args.shard)
+                 for annnr, d in projects]
+        results = []
+        for data, summary in runutils.imap_bounded(retrieve_project, tasks, args.workers):
+            runutils.merge_metrics(summary.pop("metrics"))
+            results.append((data, summary))
+    n_failed = sum(1 for _, summary in results if "error" in summary)
+    # without the items of the projects which failed, the combined file and the ledger would be incomplete
+    complete = n_failed == 0 or args.allow_partial
+    if not complete and (args.ledger is not None or args.combined is not None):
+        logger.error(f"Not saving the combined file or adding to the ledger, {n_failed} projects failed "
+                     f"(use --allow-partial to save them anyway)")
+    if args.ledger is not None and complete:
+        append_ledger(args.ledger, args.round, results)
+    combined = []
+    summaries = []
+    for data, summary in results:
+        summaries.append(summary)
+        if data is not None:
+            combined.extend(data)
+    if args.combined is not None and complete:
+        with runutils.stage("write"):
+            dataio.save_items(args.combined, combined, shard=args.shard)
+        logger.info(f"Saved {len(combined)} items from all projects to file {args.combined}")
+    for summary in summaries:
+        if "error" in summary:
+            logger.error(f"Annotator {summary['annnr']:02d} ({summary['indir']}): FAILED, {summary['error']}")
+        else:
+            logger.info(f"Annotator {summary['annnr']:02d} ({summary['indir']}): {summary['items']} items, "
+                        f"{summary['nolabel']} without label, {summary['noconf']} without confidence, "
+                        f"{summary['ignored']} files ignored")
+    ok = [s for s in summaries if "error" not in s]
+    logger.info(f"Total items:               {sum(s['items'] for s in ok)}")
+    logger.info(f"Total without label:       {sum(s['nolabel'] for s in ok)}")
+    logger.info(f"Total without confidence:  {sum(s['noconf'] for s in ok)}")
+    logger.info(f"Total files ignored:       {sum(s['ignored'] for s in ok)}")
+    logger.info(f"Projects failed:           {n_failed}")
+    if args.report:
+        report(ok, idle, now, args.report)
     runutils.run_stop()
+    if n_failed > 0:
+        sys.exit(1)
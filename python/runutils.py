@@ -2,14 +2,30 @@
 """
 Utilities for running code: logging, timing/benchmarking.
 Author: Johann Petrak
+Metrics: the time spent in each stage of a program (see stage and timed), counters (see count) and the memory
+used are collected in the global metrics dict, logged by run_stop and, if the program was run with the option
+--metrics-json (see add_metrics_args), also saved to that file.
 """
 import sys
+import os
+import json
 import logging
 import datetime
 import time
+import collections
+import contextlib
+import functools
+import resource
+import tracemalloc
+import threading
+import concurrent.futures
 
 logger = None
 start = 0
+runargs = None
+metrics = {"stages": {}, "counters": {}, "memory": {}}
+# per thread: for each stage currently entered, the time spent in stages nested in it
+_nested = threading.local()
 
 
 def set_logger(args=None, name=None, file=None):
@@ -22,7 +38,8 @@ def set_logger(args=None, name=None, file=None):
     :param args: if given, an argparser namespace, checks for: "d" and "outpref"
     :return: the logger instance
     """
-    global logger
+    global logger, runargs
+    runargs = args
     if name is None:
         name = sys.argv[0]
     if logger:
@@ -69,6 +86,8 @@ def run_start():
     :return: system time in seconds
     """
     global start
+    if getattr(runargs, "tracemalloc", False):
+        tracemalloc.start()
     start = time.time()
     return start
 
@@ -85,5 +104,183 @@ def run_stop():
     stop = time.time()
     delta = stop - start
     deltastr = str(datetime.timedelta(seconds=delta))
+    for name, st in metrics["stages"].items():
+        logger.info(f"Stage {name}: {st['seconds']:.3f}s ({st['self']:.3f}s without nested stages) in {st['calls']} call(s)")
+    for name, n in metrics["counters"].items():
+        logger.info(f"Counter {name}: {n}")
+    logger.info(f"Peak RSS: {peak_rss()/(1024*1024):.1f} MB")
     logger.info(f"Runtime: {deltastr}")
+    metrics["runtime"] = delta
+    metrics["peak_rss"] = peak_rss()
+    if tracemalloc.is_tracing():
+        memory_snapshot("end")
+    metricsfile = getattr(runargs, "metrics_json", None)
+    if metricsfile:
+        save_metrics(metricsfile)
+        logger.info(f"Metrics saved to {metricsfile}")
     return deltastr, delta
+
+
+def add_metrics_args(parser):
+    """
+    Add the options --metrics-json and --tracemalloc to an argparse parser.
+    """
+    parser.add_argument("--metrics-json", type=str, default=None,
+                        help="Save the stage times, counters and memory use to this JSON file")
+    parser.add_argument("--tracemalloc", action="store_true",
+                        help="Trace Python memory allocations, the current and peak size is recorded after each stage")
+
+
+@contextlib.contextmanager
+def stage(name):
+    """
+    Context manager to measure the time spent in a stage of the program, e.g. with runutils.stage("shuffle"): ...
+    Times of several uses with the same name are added up. Stages can be nested, for each stage both the total
+    time and the time not spent in nested stages ("self") is recorded. If tracemalloc is on, the traced memory
+    at the end of the stage is recorded as well.
+    :param name: name of the stage
+    """
+    st = metrics["stages"].setdefault(name, {"calls": 0, "seconds": 0.0, "self": 0.0})
+    if not hasattr(_nested, "stack"):
+        _nested.stack = []
+    _nested.stack.append(0.0)
+    t0 = time.perf_counter()
+    try:
+        yield st
+    finally:
+        delta = time.perf_counter() - t0
+        nested = _nested.stack.pop()
+        if _nested.stack:
+            _nested.stack[-1] += delta
+        st["seconds"] += delta
+        st["self"] += delta - nested
+        st["calls"] += 1
+        if tracemalloc.is_tracing():
+            memory_snapshot(name, top=0)
+
+
+def timed(name=None):
+    """
+    Decorator to measure the time spent in a function as a stage, by default named like the function.
+    """
+    def decorator(func):
+        stagename = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(stagename):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def timed_iter(name, iterable):
+    """
+    Iterate over the iterable and measure the time spent getting the elements as a stage, e.g. for the time
+    spent reading and parsing input with a generator.
+    """
+    it = iter(iterable)
+    while True:
+        with stage(name):
+            try:
+                elem = next(it)
+            except StopIteration:
+                return
+        yield elem
+
+
+def count(name, n=1):
+    """
+    Increment a counter, e.g. count("items_read", len(chunk)).
+    :return: the new value of the counter
+    """
+    counters = metrics["counters"]
+    counters[name] = counters.get(name, 0) + n
+    return counters[name]
+
+
+def reset_metrics(new=None):
+    """
+    Replace the metrics collected so far by new ones (default: empty), e.g. to collect the metrics of one task
+    separately and then restore the previous ones.
+    :return: the metrics collected so far
+    """
+    global metrics
+    old = metrics
+    metrics = new if new is not None else {"stages": {}, "counters": {}, "memory": {}}
+    return old
+
+
+def merge_metrics(other):
+    """
+    Add the stage times and counters of metrics collected elsewhere, e.g. in a worker process, to the metrics
+    of this process.
+    """
+    for name, st in other["stages"].items():
+        mine = metrics["stages"].setdefault(name, {"calls": 0, "seconds": 0.0, "self": 0.0})
+        for k in mine:
+            mine[k] += st[k]
+    for name, n in other["counters"].items():
+        count(name, n)
+
+
+def peak_rss():
+    """
+    The peak resident set size of this process so far, in bytes.
+    """
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux kilobytes
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+def memory_snapshot(name, top=5):
+    """
+    Record the current and peak memory traced by tracemalloc and the lines which allocated most of the
+    current memory, under the given name. Does nothing if tracemalloc is not on.
+    :param name: name for the snapshot
+    :param top: number of allocation sites to record, taking the snapshot for this is slow so 0 skips it
+    """
+    if not tracemalloc.is_tracing():
+        return
+    current, peak = tracemalloc.get_traced_memory()
+    stats = tracemalloc.take_snapshot().statistics("lineno")[:top] if top > 0 else []
+    metrics["memory"][name] = {
+        "current": current, "peak": peak, "rss": peak_rss(),
+        "top": [{"where": str(s.traceback), "size": s.size, "count": s.count} for s in stats]}
+
+
+def save_metrics(file):
+    """
+    Save the collected metrics, together with the program and its arguments, as JSON.
+    """
+    data = {"program": os.path.basename(sys.argv[0]), "argv": sys.argv[1:],
+            "time": datetime.datetime.now().isoformat()}
+    data.update(metrics)
+    with open(file, "wt", encoding="utf8") as outfp:
+        json.dump(data, outfp, indent=2)
+
+
+def imap_bounded(func, iterable, workers=1, maxpending=None):
+    """
+    Like map(func, iterable), but if workers is more than 1, run func in a pool of that many worker processes.
+    The results are returned in the same order as the input. Unlike with multiprocessing.Pool.imap, the iterable
+    is consumed lazily: at most maxpending (default: twice the number of workers) tasks are submitted at any time.
+    :param func: function to run, must be picklable, i.e. defined at the top level of a module
+    :param iterable: the arguments for func
+    :param workers: number of worker processes
+    :param maxpending: maximum number of tasks submitted but not yet retrieved
+    :return: generator of results
+    """
+    if workers <= 1:
+        yield from map(func, iterable)
+        return
+    if maxpending is None:
+        maxpending = 2 * workers
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = collections.deque()
+        for arg in iterable:
+            pending.append(executor.submit(func, arg))
+            if len(pending) >= maxpending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()